@@ -0,0 +1,109 @@
+"""
+memory budget for uploads
+
+An upload holds several copies of its photo at once: the request body,
+the base64 form argument, the decoded photo and the multipart body sent
+to the provider. Each upload is admitted against a budget of bytes,
+costed at factor times its size (counting photo_url_size for each photo
+it fetches by URL, which can't be known beforehand), and holds that
+until it is done. When the budget is used up, new uploads wait in line
+for up to max_wait seconds; past that, or when max_waiting are already
+in line, they are rejected with scheduler.Busy (a 503 with Retry-After).
+
+An upload bigger than the whole budget is only admitted when nothing
+else is in flight, so it still gets through eventually.
+"""
+
+import time
+import math
+import logging
+import collections
+
+import tornado.ioloop
+
+import scheduler
+
+class MemoryBudget(object):
+
+    def __init__(self, budget, factor=3, photo_url_size=8 * 1024 * 1024, max_wait=10, max_waiting=100,
+                 io_loop=None):
+        self.budget = budget
+        self.factor = factor
+        self.photo_url_size = photo_url_size
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.in_use = 0
+        self.peak = 0
+        self._waiting = collections.deque()     # [cost, callback, on_reject, timeout]
+        self.stats = {'admitted': 0, 'waited': 0, 'rejected': 0}
+
+    def cost(self, size, photo_urls=0):
+        "the bytes charged for an upload of size bytes that fetches photo_urls photos"
+        return int((size + photo_urls * self.photo_url_size) * self.factor)
+
+    def acquire(self, cost, callback, on_reject, cancel_token=None):
+        """
+        call callback() once cost bytes are available, which must then be
+        given back with release(cost); or on_reject(scheduler.Busy) if they
+        aren't soon enough. Nothing is called once cancel_token is cancelled.
+        """
+        if not self._waiting and self._fits(cost):
+            self._admit(cost)
+            callback()
+            return
+
+        if len(self._waiting) >= self.max_waiting:
+            self.stats['rejected'] += 1
+            on_reject(self._busy())
+            return
+
+        self.stats['waited'] += 1
+        entry = [cost, callback, on_reject, None]
+        entry[3] = self.io_loop.add_timeout(time.time() + self.max_wait, lambda: self._expire(entry))
+        self._waiting.append(entry)
+        if cancel_token is not None:
+            cancel_token.add_callback(lambda: self._withdraw(entry))
+
+    def release(self, cost):
+        self.in_use -= cost
+        # first come, first served: a big upload at the front isn't overtaken
+        while self._waiting and self._fits(self._waiting[0][0]):
+            cost, callback, on_reject, timeout = self._waiting.popleft()
+            self.io_loop.remove_timeout(timeout)
+            self._admit(cost)
+            self.io_loop.add_callback(callback)
+
+    def _fits(self, cost):
+        return self.in_use == 0 or self.in_use + cost <= self.budget
+
+    def _admit(self, cost):
+        self.in_use += cost
+        self.peak = max(self.peak, self.in_use)
+        self.stats['admitted'] += 1
+
+    def _busy(self):
+        return scheduler.Busy("uploads are using all the memory they may, try again later",
+                              int(math.ceil(self.max_wait)))
+
+    def _expire(self, entry):
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            self.stats['rejected'] += 1
+            entry[2](self._busy())
+
+    def _withdraw(self, entry):
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            self.io_loop.remove_timeout(entry[3])
+
+    def report(self):
+        mb = 1024.0 * 1024
+        logging.info("upload memory: %.1f MB in use, peak %.1f MB, of %.1f MB; %d waiting; "
+                     "%d admitted, %d waited, %d rejected" %
+                     (self.in_use / mb, self.peak / mb, self.budget / mb, len(self._waiting),
+                      self.stats['admitted'], self.stats['waited'], self.stats['rejected']))
+
+    def start(self, report_seconds=300):
+        "log report() every report_seconds"
+        tornado.ioloop.PeriodicCallback(self.report, report_seconds * 1000, io_loop=self.io_loop).start()
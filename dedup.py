@@ -0,0 +1,76 @@
+"""
+upload deduplication by content hash
+
+Clients often send the same photo to the same photoset more than once
+(retries, re-shares). The index maps (provider, user, photoset, SHA-1 of
+the photo) to what the provider returned the first time, so a repeat
+can be answered without uploading again. A user is their user_id and
+their credentials' fingerprint, since some providers give every user the
+same user_id. It is kept in SQLite so it
+survives restarts, and holds at most max_entries uploads, dropping the
+least recently used first.
+"""
+
+import time
+import sqlite3
+
+import simplejson
+
+SCHEMA = """
+create table if not exists uploads (
+  provider text not null,
+  user_id text not null,
+  fingerprint text not null,
+  photoset_id text not null,
+  sha1 text not null,
+  result text not null,
+  last_used real not null,
+  primary key (provider, user_id, fingerprint, photoset_id, sha1)
+)
+"""
+
+class DedupIndex(object):
+
+    def __init__(self, db_path, max_entries=100000):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(db_path)
+        # an index from before users were told apart by fingerprint can't be
+        # trusted; it is only a cache, so start over
+        columns = [row[1] for row in self.db.execute("pragma table_info(uploads)")]
+        if columns and 'fingerprint' not in columns:
+            self.db.execute("drop table uploads")
+        self.db.execute(SCHEMA)
+        self.db.execute("create index if not exists uploads_last_used on uploads (last_used)")
+        self.db.commit()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def lookup(self, provider, user_id, fingerprint, photoset_id, sha1):
+        "what the provider returned when this photo was uploaded here before, or None"
+        key = (provider, user_id, fingerprint, photoset_id, sha1)
+        row = self.db.execute("select result from uploads where provider = ? and user_id = ? "
+                              "and fingerprint = ? and photoset_id = ? and sha1 = ?", key).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        self.db.execute("update uploads set last_used = ? where provider = ? and user_id = ? "
+                        "and fingerprint = ? and photoset_id = ? and sha1 = ?", (time.time(),) + key)
+        self.db.commit()
+        return simplejson.loads(row[0])
+
+    def record(self, provider, user_id, fingerprint, photoset_id, sha1, result):
+        "remember a successful upload"
+        self.db.execute("insert or replace into uploads (provider, user_id, fingerprint, photoset_id, sha1, "
+                        "result, last_used) values (?, ?, ?, ?, ?, ?, ?)",
+                        (provider, user_id, fingerprint, photoset_id, sha1, simplejson.dumps(result),
+                         time.time()))
+        excess = self.db.execute("select count(*) from uploads").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.db.execute("delete from uploads where rowid in "
+                            "(select rowid from uploads order by last_used limit ?)", (excess,))
+            self.stats['evicted'] += excess
+        self.db.commit()
+
+    def size(self):
+        return self.db.execute("select count(*) from uploads").fetchone()[0]
@@ -0,0 +1,177 @@
+"""
+incremental photo listings
+
+/get/photos?since=<cursor> answers with what changed in a photoset since
+the listing that issued the cursor, instead of the whole photoset. Each
+photoset has a snapshot here: for every photo, a fingerprint and the
+snapshot versions at which it was added, last changed and removed.
+Every fresh listing is compared against the snapshot, and any difference
+moves the photoset to a new version.
+
+A photo's fingerprint is the provider's own update stamp when it has one
+(Flickr lastupdate, Picasa updated, SmugMug LastUpdated, as 'updated' in
+the listing), or else a hash of the whole listing entry.
+
+A cursor is "<generation>-<version>". The generation is picked when a
+photoset's snapshot is created, so a cursor from a lost or different
+snapshot isn't trusted. Removed photos are remembered for tombstone_age
+seconds; a cursor older than that gets the whole photoset again, with
+reset set.
+"""
+
+import time
+import uuid
+import hashlib
+import sqlite3
+
+import simplejson
+
+SCHEMA = """
+create table if not exists photosets (
+  provider text not null,
+  user_id text not null,
+  photoset_id text not null,
+  generation text not null,
+  version integer not null,
+  pruned integer not null default 0,
+  primary key (provider, user_id, photoset_id)
+);
+create table if not exists photos (
+  provider text not null,
+  user_id text not null,
+  photoset_id text not null,
+  photo_id text not null,
+  fingerprint text not null,
+  added integer not null,
+  changed integer not null,
+  removed integer,
+  removed_at real,
+  primary key (provider, user_id, photoset_id, photo_id)
+);
+"""
+
+def fingerprint(photo):
+    "what changes when the photo does"
+    if photo.get('updated'):
+        return "u:%s" % photo['updated']
+    return "h:%s" % hashlib.sha1(simplejson.dumps(photo, sort_keys=True)).hexdigest()
+
+class Snapshots(object):
+
+    def __init__(self, db_path, tombstone_age=30 * 24 * 3600):
+        self.tombstone_age = tombstone_age
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.stats = {'full': 0, 'delta': 0, 'reset': 0}
+
+    def delta(self, provider, user_id, photoset_id, photos, since):
+        """
+        compare a fresh listing of a photoset with its snapshot, and return
+        {cursor, added, changed, removed, reset}.
+
+        added and changed hold whole photos, removed holds photo ids, all
+        since the cursor in since. With no usable cursor (empty, unknown or
+        too old) everything is in added, and reset is set when the client
+        passed a cursor it should throw away, along with its copy.
+        """
+        key = (provider, user_id, photoset_id)
+        generation, version, pruned = self._update(key, photos)
+        cursor = "%s-%d" % (generation, version)
+
+        since_version = None
+        if since:
+            since_generation, _, since_version = since.partition('-')
+            try:
+                since_version = int(since_version)
+            except ValueError:
+                since_version = None
+            if since_generation != generation or since_version is None \
+                    or since_version < pruned or since_version > version:
+                since_version = None
+
+        if since_version is None:
+            self.stats['reset' if since else 'full'] += 1
+            return {'cursor': cursor, 'added': photos, 'changed': [], 'removed': [], 'reset': bool(since)}
+
+        self.stats['delta'] += 1
+        rows = dict((row[0], row[1:]) for row in
+                    self.db.execute("select photo_id, added, changed, removed from photos "
+                                    "where provider = ? and user_id = ? and photoset_id = ? "
+                                    "and (changed > ? or removed > ?)", key + (since_version, since_version)))
+        added, changed = [], []
+        for photo in photos:
+            row = rows.get(str(photo['id']))
+            if row is None:
+                continue
+            if row[0] > since_version:
+                added.append(photo)
+            else:
+                changed.append(photo)
+        # a photo both added and removed since the cursor was never seen by the client
+        removed = [photo_id for photo_id, (added_version, _, removed_version) in rows.items()
+                   if removed_version is not None and removed_version > since_version and added_version <= since_version]
+
+        return {'cursor': cursor, 'added': added, 'changed': changed, 'removed': removed, 'reset': False}
+
+    def _update(self, key, photos):
+        "bring the snapshot up to date with photos, and return (generation, version, pruned)"
+        row = self.db.execute("select generation, version, pruned from photosets "
+                              "where provider = ? and user_id = ? and photoset_id = ?", key).fetchone()
+        if row is None:
+            generation, version, pruned = uuid.uuid4().hex[:12], 0, 0
+            self.db.execute("insert into photosets (provider, user_id, photoset_id, generation, version, pruned) "
+                            "values (?, ?, ?, ?, ?, ?)", key + (generation, version, pruned))
+        else:
+            generation, version, pruned = row
+
+        known = dict((row[0], row[1:]) for row in
+                     self.db.execute("select photo_id, fingerprint, removed from photos "
+                                     "where provider = ? and user_id = ? and photoset_id = ?", key))
+        # only move to a new version if something actually changed, so that
+        # a client polling an unchanged photoset keeps its cursor
+        new_version = version + 1
+        changes = 0
+        seen = set()
+        now = time.time()
+
+        for photo in photos:
+            photo_id = str(photo['id'])
+            seen.add(photo_id)
+            stamp = fingerprint(photo)
+            previous = known.get(photo_id)
+            if previous is None or previous[1] is not None:
+                self.db.execute("insert or replace into photos (provider, user_id, photoset_id, photo_id, "
+                                "fingerprint, added, changed, removed, removed_at) "
+                                "values (?, ?, ?, ?, ?, ?, ?, null, null)",
+                                key + (photo_id, stamp, new_version, new_version))
+                changes += 1
+            elif previous[0] != stamp:
+                self.db.execute("update photos set fingerprint = ?, changed = ? where provider = ? "
+                                "and user_id = ? and photoset_id = ? and photo_id = ?",
+                                (stamp, new_version) + key + (photo_id,))
+                changes += 1
+
+        for photo_id, (_, removed) in known.items():
+            if removed is None and photo_id not in seen:
+                self.db.execute("update photos set removed = ?, removed_at = ? where provider = ? "
+                                "and user_id = ? and photoset_id = ? and photo_id = ?",
+                                (new_version, now) + key + (photo_id,))
+                changes += 1
+
+        if changes:
+            version = new_version
+
+        # forget old removals; cursors from before them can no longer be answered
+        expired = self.db.execute("select max(removed) from photos where provider = ? and user_id = ? "
+                                  "and photoset_id = ? and removed_at < ?",
+                                  key + (now - self.tombstone_age,)).fetchone()[0]
+        if expired is not None:
+            self.db.execute("delete from photos where provider = ? and user_id = ? and photoset_id = ? "
+                            "and removed_at < ?", key + (now - self.tombstone_age,))
+            pruned = max(pruned, expired)
+
+        self.db.execute("update photosets set version = ?, pruned = ? where provider = ? "
+                        "and user_id = ? and photoset_id = ?", (version, pruned) + key)
+        self.db.commit()
+        return generation, version, pruned
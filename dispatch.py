@@ -0,0 +1,293 @@
+"""
+front dispatcher: one user, one worker
+
+With several server processes, each has its own caches, upstream state
+and upload sessions. In dispatcher mode (server.py -dispatch) one process
+takes all requests and forwards each to a worker chosen by consistent
+hashing of its user_id, so a user's requests keep landing on the same
+worker while it is up. Requests without a user_id are hashed by client
+address.
+
+The ring has replicas points per worker, so adding or removing a worker
+only moves the users whose points it takes over or gives up. Loads are
+bounded: no worker gets more than load_factor times the average number
+of requests in flight; past that, a user spills over to the next worker
+round the ring.
+
+Workers are probed every probe_seconds. One that can't be reached is
+taken off the ring, and put back once it answers again.
+
+A request whose client goes away has its forwarded request to the worker
+aborted, so the worker drops it as well.
+
+A forwarded request is given up on after request_timeout seconds, except
+for the paths in untimed_paths: /post/photos has no overall deadline, as
+a batch can take many minutes. Responses are buffered here and written
+out once complete, so in dispatch mode the lines /post/photos streams as
+each photo finishes all arrive together at the end.
+
+Every forwarded request and probe goes through one curl client of
+max_clients handles (DISPATCH_MAX_CLIENTS); past that they wait in
+curl's queue, so it needs to be well above the number of requests the
+workers can have in flight between them.
+"""
+
+import sys
+import bisect
+import hashlib
+import logging
+import math
+import datetime
+import email.utils
+import Cookie
+
+import pycurl
+import tornado.ioloop
+import tornado.web
+import tornado.httpserver
+import tornado.httpclient
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+def _watch(cancelled):
+    """
+    a prepare_curl_callback that aborts the transfer once cancelled() is
+    true; curl checks about once a second. Curl handles are reused, so every
+    request made here sets this, with cancelled None for one never aborted.
+    """
+    def prepare(curl):
+        if cancelled is None:
+            curl.setopt(pycurl.NOPROGRESS, 1)
+        else:
+            curl.setopt(pycurl.NOPROGRESS, 0)
+            curl.setopt(pycurl.PROGRESSFUNCTION, lambda *progress: cancelled() and 1 or 0)
+    return prepare
+
+class HashRing(object):
+
+    def __init__(self, workers=(), replicas=100, load_factor=1.25):
+        self.replicas = replicas
+        self.load_factor = load_factor
+        self._points = []       # sorted (hash, worker)
+        self.load = {}          # worker -> requests in flight
+        self.stats = {'routed': 0, 'spilled': 0}
+        for worker in workers:
+            self.add(worker)
+
+    def add(self, worker):
+        if worker in self.load:
+            return
+        self.load[worker] = 0
+        for i in range(self.replicas):
+            bisect.insort(self._points, (_hash("%s#%d" % (worker, i)), worker))
+
+    def remove(self, worker):
+        if worker not in self.load:
+            return
+        del self.load[worker]
+        self._points = [point for point in self._points if point[1] != worker]
+
+    def workers(self):
+        return self.load.keys()
+
+    def _walk(self, key):
+        "each worker once, in ring order from key's point"
+        if not self._points:
+            return
+        seen = set()
+        start = bisect.bisect(self._points, (_hash(key), ))
+        for i in range(len(self._points)):
+            worker = self._points[(start + i) % len(self._points)][1]
+            if worker not in seen:
+                seen.add(worker)
+                yield worker
+                if len(seen) == len(self.load):
+                    return
+
+    def lookup(self, key):
+        "the worker key belongs to, ignoring load"
+        for worker in self._walk(key):
+            return worker
+        return None
+
+    def acquire(self, key, exclude=()):
+        """
+        the worker to send a request for key to, counted as in flight until
+        release(worker); None if there is no worker outside exclude
+        """
+        if not self.load:
+            return None
+        capacity = int(math.ceil(self.load_factor * (sum(self.load.values()) + 1) / len(self.load)))
+        for i, worker in enumerate(self._walk(key)):
+            if worker in exclude or self.load[worker] >= capacity:
+                continue
+            self.load[worker] += 1
+            self.stats['routed'] += 1
+            if i > 0:
+                self.stats['spilled'] += 1
+            return worker
+        return None
+
+    def release(self, worker):
+        # the worker may have been taken off the ring meanwhile
+        if worker in self.load:
+            self.load[worker] -= 1
+
+class Dispatcher(object):
+
+    def __init__(self, workers, replicas=100, load_factor=1.25, probe_seconds=5, request_timeout=180,
+                 untimed_paths=('/post/photos',), io_loop=None):
+        self.all_workers = list(workers)
+        self.ring = HashRing(workers, replicas, load_factor)
+        self.probe_seconds = probe_seconds
+        self.request_timeout = request_timeout
+        self.untimed_paths = untimed_paths
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+    def start(self):
+        tornado.ioloop.PeriodicCallback(self.probe_all, self.probe_seconds * 1000, io_loop=self.io_loop).start()
+
+    def probe_all(self):
+        for worker in self.all_workers:
+            self.probe(worker)
+
+    def probe(self, worker):
+        "take worker off the ring if it can't be reached, and back on when it can"
+        def on_response(response):
+            # any HTTP answer at all means the worker is up
+            if response.code == 599:
+                if worker in self.ring.load:
+                    logging.warning("dispatch: %s is down: %s" % (worker, response.error))
+                    self.ring.remove(worker)
+            elif worker not in self.ring.load:
+                logging.warning("dispatch: %s is back" % worker)
+                self.ring.add(worker)
+
+        http = tornado.httpclient.AsyncHTTPClient()
+        http.fetch(tornado.httpclient.HTTPRequest(worker + "/xrds", connect_timeout=2, request_timeout=5,
+                                                  follow_redirects=False, prepare_curl_callback=_watch(None)),
+                   callback=on_response)
+
+# hop-by-hop, or recomputed when the body is written again. curl asks the
+# worker for compression itself and hands the body back decompressed.
+_SKIP_HEADERS = set(['connection', 'keep-alive', 'transfer-encoding', 'content-length', 'set-cookie',
+                     'accept-encoding', 'content-encoding'])
+
+class DispatchHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "PUT", "DELETE")
+
+    def initialize(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.client_gone = False
+
+    def on_connection_close(self):
+        self.client_gone = True
+
+    @tornado.web.asynchronous
+    def get(self, *args):
+        self.forward(self.get_argument("user_id", None) or self.request.remote_ip)
+
+    head = post = put = delete = get
+
+    def forward(self, key, tried=()):
+        worker = self.dispatcher.ring.acquire(key, exclude=tried)
+        if worker is None:
+            self.set_status(503)
+            self.set_header("Retry-After", str(self.dispatcher.probe_seconds))
+            self.finish("no worker available")
+            return
+
+        headers = dict((name, value) for name, value in self.request.headers.items()
+                       if name.lower() not in _SKIP_HEADERS)
+        headers['X-Real-Ip'] = self.request.remote_ip
+        body = None
+        if self.request.method in ("POST", "PUT"):
+            body = self.request.body or ''
+
+        request_timeout = self.dispatcher.request_timeout
+        if self.request.path in self.dispatcher.untimed_paths:
+            # curl: no limit
+            request_timeout = 0
+
+        request = tornado.httpclient.HTTPRequest(worker + self.request.uri, method=self.request.method,
+                                                 headers=headers, body=body, follow_redirects=False,
+                                                 request_timeout=request_timeout,
+                                                 prepare_curl_callback=_watch(lambda: self.client_gone))
+        http = tornado.httpclient.AsyncHTTPClient()
+        http.fetch(request, callback=lambda response: self.on_response(key, worker, tried, response))
+
+    def on_response(self, key, worker, tried, response):
+        self.dispatcher.ring.release(worker)
+        if self.client_gone:
+            return
+
+        if response.code == 599:
+            self.dispatcher.probe(worker)
+            # only requests that can't change anything are tried elsewhere:
+            # a timed out upload may well have happened
+            if self.request.method in ("GET", "HEAD"):
+                self.forward(key, tried + (worker,))
+            else:
+                self.set_status(502)
+                self.finish("worker unavailable")
+            return
+
+        self.set_status(response.code)
+        for name in response.headers.keys():
+            if name.lower() not in _SKIP_HEADERS:
+                self.set_header(name, response.headers[name])
+        # set_header would merge several cookies into one header
+        for value in response.headers.get_list('Set-Cookie'):
+            self.copy_cookie(value)
+        if response.body:
+            self.write(response.body)
+        self.finish()
+
+    def copy_cookie(self, header):
+        "set the cookies of a worker's Set-Cookie header on our response"
+        cookie = Cookie.SimpleCookie()
+        cookie.load(header)
+        for name, morsel in cookie.items():
+            attributes = dict((attribute, value) for attribute, value in morsel.items() if value)
+            expires = attributes.pop('expires', None)
+            if expires:
+                expires = datetime.datetime(*email.utils.parsedate(expires)[:6])
+            self.set_cookie(name, morsel.value, domain=attributes.pop('domain', None), expires=expires,
+                            path=attributes.pop('path', None), **attributes)
+
+def run(config, local_workers=0, server_script=None):
+    """
+    forward requests on config.PORT to workers by user: the ones listed in
+    DISPATCH_WORKERS, or local_workers new server_script processes on the
+    ports after PORT
+    """
+    import subprocess
+    import atexit
+
+    workers = getattr(config, 'DISPATCH_WORKERS', [])
+    if local_workers:
+        workers = []
+        for i in range(local_workers):
+            port = config.PORT + 1 + i
+            process = subprocess.Popen([sys.executable, server_script, '-port', str(port), '-worker', str(i)])
+            atexit.register(process.terminate)
+            workers.append("http://127.0.0.1:%d" % port)
+
+    # AsyncHTTPClient is one per IOLoop, sized by whoever makes it first
+    tornado.httpclient.AsyncHTTPClient(max_clients=getattr(config, 'DISPATCH_MAX_CLIENTS', 500))
+
+    deadlines = getattr(config, 'UPSTREAM_DEADLINES', {'listing': 20, 'upload': 120})
+    dispatcher = Dispatcher(workers,
+                            replicas = getattr(config, 'DISPATCH_REPLICAS', 100),
+                            load_factor = getattr(config, 'DISPATCH_LOAD_FACTOR', 1.25),
+                            probe_seconds = getattr(config, 'DISPATCH_PROBE_SECONDS', 5),
+                            request_timeout = max(deadlines.values()) + 30)
+    front = tornado.web.Application([(r".*", DispatchHandler, dict(dispatcher=dispatcher))])
+    tornado.httpserver.HTTPServer(front, xheaders=True).listen(config.PORT)
+    dispatcher.start()
+
+    print "Dispatching on %s to %s" % (config.PORT, ", ".join(workers))
+    tornado.ioloop.IOLoop.instance().start()
@@ -7,6 +7,7 @@ exposes an interface that should be generalizable to Flickr, Picasa, etc.
 import config
 import urlparse, urllib
 import tornado
+import tornado.httpclient
 import simplejson
 import hashlib
 import cStringIO
@@ -37,6 +38,22 @@ def _sign_request(request):
 def _sign_request_url_only(request):
     return _sign_request(request)[1]
 
+def _fetch(request, deadline, callback, on_error):
+    "fetch a URL or HTTPRequest, with timeouts taken from what is left of deadline"
+    try:
+        timeouts = utils.timeout_args(deadline)
+    except utils.DeadlineExceeded, e:
+        on_error(e)
+        return
+
+    if not isinstance(request, tornado.httpclient.HTTPRequest):
+        request = tornado.httpclient.HTTPRequest(request)
+    for name, value in timeouts.items():
+        setattr(request, name, value)
+
+    http = tornado.httpclient.AsyncHTTPClient()
+    http.fetch(request, callback=callback)
+
 def generate_authorize_url(web_handler, url_callback, on_success, on_error):
     """
     When it's time to authorize a connection to a user's photo store,
@@ -105,7 +122,7 @@ def complete_authorization(web_handler, request_token, on_success, on_error):
     http = tornado.httpclient.AsyncHTTPClient()
     http.fetch(url, callback=on_response)
 
-def get_photosets(user_id, credentials, on_success, on_error):
+def get_photosets(user_id, credentials, on_success, on_error, cancel_token=None, deadline=None):
     """
     list the user's photosets
     
@@ -113,6 +130,12 @@ def get_photosets(user_id, credentials, on_success, on_error):
     id, name, num_photos
 
     on_error called with an error message
+
+    cancel_token (a utils.CancelToken) is cancelled if the result is no longer
+    wanted; the provider should then stop work and call neither callback
+
+    deadline (a utils.Deadline) bounds the upstream request: connect and read
+    timeouts come from deadline.timeouts()
     """
 
     request = {
@@ -126,6 +149,9 @@ def get_photosets(user_id, credentials, on_success, on_error):
     url = "http://api.flickr.com/services/rest/?%s" % _sign_request_url_only(request)
 
     def on_response(response):
+        # tornado can't abort the fetch, but we can skip the parse
+        if utils.is_cancelled(cancel_token):
+            return
         if response.error:
             on_error(response.error)
             return
@@ -138,16 +164,16 @@ def get_photosets(user_id, credentials, on_success, on_error):
 
         on_success(photosets)
 
-    http = tornado.httpclient.AsyncHTTPClient()
-    http.fetch(url, callback=on_response)
+    _fetch(url, deadline, on_response, on_error)
 
 
-def get_photos(user_id, credentials, photoset_id, on_success, on_error):
+def get_photos(user_id, credentials, photoset_id, on_success, on_error, cancel_token=None, deadline=None):
     """
     List a photoset's photos
     
     on_success is called with a list of dictionaries, each one including
-    id, name, description, and sizes a list of size dictionaries including: {size, url}
+    id, name, description, tags, updated (when the photo last changed, if the
+    provider says), and sizes a list of size dictionaries including: {size, url}
 
     on_error is called with an error message
     """
@@ -156,7 +182,7 @@ def get_photos(user_id, credentials, photoset_id, on_success, on_error):
         'method' : 'flickr.photosets.getPhotos',
         'user_id' : user_id,
         "photoset_id": photoset_id,
-        "extras": "url_sq,url_t,url_s,url_m,url_z,url_l,url_o,icon_server,tags",
+        "extras": "url_sq,url_t,url_s,url_m,url_z,url_l,url_o,icon_server,tags,last_update",
         'format' : 'json',
         'nojsoncallback': "1",
         'auth_token': credentials,
@@ -165,6 +191,8 @@ def get_photos(user_id, credentials, photoset_id, on_success, on_error):
     url = "http://api.flickr.com/services/rest/?%s" % _sign_request_url_only(request)
 
     def on_response(response):
+        if utils.is_cancelled(cancel_token):
+            return
         if response.error:
             on_error(response.error)
             return
@@ -174,6 +202,8 @@ def get_photos(user_id, credentials, photoset_id, on_success, on_error):
         photos = [{
                 'id': photo['id'],
                 'name': photo['title'],
+                'updated': photo.get('lastupdate'),
+                'tags': photo.get('tags', '').split(),
                 'sizes': [
                     {
                         'size': 'thumbnail',
@@ -204,11 +234,11 @@ def get_photos(user_id, credentials, photoset_id, on_success, on_error):
 
         on_success(photos)
 
-    http = tornado.httpclient.AsyncHTTPClient()
-    http.fetch(url, callback=on_response)
+    _fetch(url, deadline, on_response, on_error)
 
-def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error):
-    photoFile = cStringIO.StringIO(base64.b64decode(photo))
+def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error, cancel_token=None, deadline=None):
+    # photo is base64, or a utils.SpooledPhoto
+    photoFile = utils.photo_file(photo)
 
     request = {
         "auth_token": credentials
@@ -232,6 +262,8 @@ def store_photo(user_id, credentials, photoset_id, photo, title, description, ta
         )
 
     def on_response(response):
+        if utils.is_cancelled(cancel_token):
+            return
         if response.error:
             on_error(response.error)
             return
@@ -274,6 +306,5 @@ def store_photo(user_id, credentials, photoset_id, photo, title, description, ta
         else:
             on_success(response.body)
 
-    http = tornado.httpclient.AsyncHTTPClient()      
-    http.fetch(httpRequest, callback=on_response)
+    _fetch(httpRequest, deadline, on_response, on_error)
     
@@ -0,0 +1,263 @@
+"""
+recent photoset and photo listings
+
+upstream keeps each listing it fetches here, by upstream key. A listing
+younger than ttl seconds is served instead of calling the provider; older
+ones are kept for stale_ttl seconds so an open circuit can still be
+answered (see upstream.stale_cache).
+
+Where the listings are kept is up to the backend:
+
+  MemoryBackend  in this process, at most max_entries listings
+  SQLiteBackend  in a SQLite file that every server process on the host
+                 can share, at most max_bytes of compressed listings
+
+Either drops the least recently used listings first. A backend has
+get(key, touch) returning (stored, prefetched, value) or None,
+set(key, stored, prefetched, value, expires), delete(key),
+mark_used(key), size(), and wasted: how many prefetched listings it has
+dropped unused, whether replaced, evicted, expired or deleted.
+
+Listings fetched ahead of time by the prefetcher are marked, so we can
+tell how many of them were used before they were replaced or dropped.
+"""
+
+import time
+import zlib
+import sqlite3
+import collections
+
+import simplejson
+
+class MemoryBackend(object):
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self.wasted = 0
+
+    def get(self, key, touch=True):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] < time.time():
+            del self._entries[key]
+            if entry[1]:
+                self.wasted += 1
+            return None
+        if touch:
+            # most recently used last
+            del self._entries[key]
+            self._entries[key] = entry
+        return entry[:3]
+
+    def set(self, key, stored, prefetched, value, expires):
+        previous = self._entries.pop(key, None)
+        if previous is not None and previous[1]:
+            self.wasted += 1
+        self._entries[key] = (stored, prefetched, value, expires)
+
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            if evicted[1]:
+                self.wasted += 1
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[1]:
+            self.wasted += 1
+
+    def mark_used(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (entry[0], False) + entry[2:]
+
+    def size(self):
+        return len(self._entries)
+
+SCHEMA = """
+create table if not exists listings (
+  key text primary key,
+  stored real not null,
+  expires real not null,
+  last_used real not null,
+  prefetched integer not null,
+  size integer not null,
+  value blob not null
+);
+create index if not exists listings_last_used on listings (last_used);
+create index if not exists listings_expires on listings (expires);
+
+-- the total size of the listings, kept up to date by every process
+create table if not exists listings_size (bytes integer not null);
+insert into listings_size select coalesce(sum(size), 0) from listings
+  where not exists (select 1 from listings_size);
+create trigger if not exists listings_added after insert on listings
+  begin update listings_size set bytes = bytes + new.size; end;
+create trigger if not exists listings_removed after delete on listings
+  begin update listings_size set bytes = bytes - old.size; end;
+"""
+
+class SQLiteBackend(object):
+    """
+    listings as zlib-compressed JSON in a SQLite file. Several processes can
+    use the same file; write-ahead logging lets them read while one writes.
+
+    The queries run on the IOLoop, so none of them waits long for another
+    process's lock: a listing that can't be read in time is a miss, and one
+    that can't be written isn't cached.
+    """
+
+    # last_used is only written back this often, so most hits don't write
+    TOUCH_SECONDS = 10
+    # seconds to wait for another process's lock
+    BUSY_TIMEOUT = 0.05
+
+    def __init__(self, db_path, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.wasted = 0
+        self.db = sqlite3.connect(db_path, timeout=5)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        # waiting is fine while setting up, but not once serving
+        self.db.execute("pragma busy_timeout = %d" % (self.BUSY_TIMEOUT * 1000))
+
+    def _key(self, key):
+        return simplejson.dumps(list(key), separators=(',', ':'))
+
+    def get(self, key, touch=True):
+        key = self._key(key)
+        now = time.time()
+        try:
+            row = self.db.execute("select stored, prefetched, value, expires, last_used from listings "
+                                  "where key = ?", (key,)).fetchone()
+            if row is None or row[3] < now:
+                return None
+            if touch and now - row[4] > self.TOUCH_SECONDS:
+                self.db.execute("update listings set last_used = ? where key = ?", (now, key))
+                self.db.commit()
+        except sqlite3.OperationalError:
+            # locked by another process
+            self.db.rollback()
+            return None
+        return row[0], bool(row[1]), simplejson.loads(zlib.decompress(row[2]))
+
+    def set(self, key, stored, prefetched, value, expires):
+        key = self._key(key)
+        value = zlib.compress(simplejson.dumps(value, separators=(',', ':')))
+        try:
+            self._set(key, stored, prefetched, value, expires)
+        except sqlite3.OperationalError:
+            self.db.rollback()
+
+    def _set(self, key, stored, prefetched, value, expires):
+        wasted = self.db.execute("select count(*) from listings where key = ? and prefetched",
+                                 (key,)).fetchone()[0]
+        # rather than insert or replace, which doesn't fire the delete trigger
+        self.db.execute("delete from listings where key = ?", (key,))
+        self.db.execute("insert into listings (key, stored, expires, last_used, prefetched, size, value) "
+                        "values (?, ?, ?, ?, ?, ?, ?)",
+                        (key, stored, expires, stored, int(prefetched), len(value), sqlite3.Binary(value)))
+        now = time.time()
+        wasted += self.db.execute("select count(*) from listings where expires < ? and prefetched",
+                                  (now,)).fetchone()[0]
+        self.db.execute("delete from listings where expires < ?", (now,))
+
+        excess = self.db.execute("select bytes from listings_size").fetchone()[0] - self.max_bytes
+        if excess > 0:
+            evicted = []
+            for row_key, size, row_prefetched in self.db.execute(
+                    "select key, size, prefetched from listings order by last_used"):
+                if excess <= 0:
+                    break
+                evicted.append((row_key,))
+                excess -= size
+                wasted += row_prefetched
+            self.db.executemany("delete from listings where key = ?", evicted)
+        self.db.commit()
+        self.wasted += wasted
+
+    def delete(self, key):
+        key = self._key(key)
+        try:
+            wasted = self.db.execute("select count(*) from listings where key = ? and prefetched",
+                                     (key,)).fetchone()[0]
+            self.db.execute("delete from listings where key = ?", (key,))
+            self.db.commit()
+        except sqlite3.OperationalError:
+            # locked by another process; the listing lives out its ttl
+            self.db.rollback()
+            return
+        self.wasted += wasted
+
+    def mark_used(self, key):
+        try:
+            self.db.execute("update listings set prefetched = 0 where key = ?", (self._key(key),))
+            self.db.commit()
+        except sqlite3.OperationalError:
+            self.db.rollback()
+
+    def size(self):
+        return self.db.execute("select count(*) from listings").fetchone()[0]
+
+class ListingCache(object):
+
+    def __init__(self, ttl, stale_ttl=3600, backend=None):
+        self.ttl = ttl
+        self.stale_ttl = max(ttl, stale_ttl)
+        self.backend = backend or MemoryBackend()
+        self.stats = {'hits': 0, 'misses': 0, 'stale_hits': 0,
+                      'prefetched': 0, 'prefetch_used': 0, 'prefetch_wasted': 0}
+
+    def get(self, key, max_age=None):
+        """
+        the listing stored under key, if it is no older than max_age seconds
+        (or stale_ttl, if max_age is None); otherwise None
+        """
+        entry = self.backend.get(key)
+        self.stats['prefetch_wasted'] = self.backend.wasted
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        stored, prefetched, value = entry
+        age = time.time() - stored
+        if max_age is not None and age > max_age:
+            self.stats['misses'] += 1
+            return None
+
+        if age > self.ttl:
+            self.stats['stale_hits'] += 1
+        else:
+            self.stats['hits'] += 1
+        if prefetched:
+            self.stats['prefetch_used'] += 1
+            self.backend.mark_used(key)
+        return value
+
+    def fresh(self, key):
+        "the listing stored under key, if it is younger than ttl"
+        return self.get(key, self.ttl)
+
+    def contains_fresh(self, key):
+        "whether fresh(key) would hit, without counting it as a use"
+        entry = self.backend.get(key, touch=False)
+        self.stats['prefetch_wasted'] = self.backend.wasted
+        return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def set(self, key, value, prefetched=False):
+        if prefetched:
+            self.stats['prefetched'] += 1
+        now = time.time()
+        self.backend.set(key, now, prefetched, value, now + self.stale_ttl)
+        self.stats['prefetch_wasted'] = self.backend.wasted
+
+    def delete(self, key):
+        "forget the listing stored under key, which is known to be out of date"
+        self.backend.delete(key)
+        self.stats['prefetch_wasted'] = self.backend.wasted
+
+    def size(self):
+        return self.backend.size()
@@ -11,6 +11,8 @@ import tornado
 import simplejson
 import cStringIO, base64
 import utils
+import sessions
+import streamjson
 
 from xml.sax.saxutils import escape as xml_escape
 
@@ -20,7 +22,15 @@ ACCESS_TOKEN_URL = 'https://www.google.com/accounts/OAuthGetAccessToken'
 
 CONSUMER = oauth.Consumer(config.KEYS['api_key'], config.KEYS['api_secret'])
 
-def _signed_request(method, url, params, oauth_extra_params, credentials, on_success, on_error, headers={}):
+# the oauth2 client blocks, so requests are made on these threads
+_pool = utils.WorkerPool(getattr(config, 'PROVIDER_THREADS', 8))
+
+def _new_client(credentials):
+    "an oauth client for the user's requests, to be kept in their session"
+    token = oauth.Token(credentials['oauth_token'], credentials['oauth_token_secret'])
+    return oauth.Client(CONSUMER, token)
+
+def _signed_request(method, url, params, oauth_extra_params, credentials, on_success, on_error, headers={}, cancel_token=None, deadline=None):
     """
     sign a request and make it.
     This is an internal method, it should not be called from outside of this file
@@ -32,15 +42,15 @@ def _signed_request(method, url, params, oauth_extra_params, credentials, on_suc
 
     credentials is a dictionary of oauth_token and oauth_token_secret. It can be null.
 
-    The goal is to make this asynchronous at some point soon.
-    """
+    The request itself runs on the worker pool; on_success / on_error are
+    called back on the IOLoop. on_error gets a utils.UpstreamError with the
+    status and response body, or the exception if there was no response (a
+    DeadlineExceeded, say). If cancel_token is cancelled before the request
+    starts it is dropped, and once cancelled nothing is called back.
 
-    # do we need an OAuth token, or just the consumer?
-    if credentials:
-        token = oauth.Token(credentials['oauth_token'], credentials['oauth_token_secret'])
-        client = oauth.Client(CONSUMER, token)
-    else:
-        client = oauth.Client(CONSUMER)
+    deadline, if given, sets the socket timeout from what is left of it when
+    the request actually starts.
+    """
 
     full_url = url
 
@@ -60,15 +70,37 @@ def _signed_request(method, url, params, oauth_extra_params, credentials, on_suc
             else:
                 body = params
             
-    resp, content = client.request(full_url, method, body = body,
-                                   headers = headers,
-                                   oauth_extra_params=oauth_extra_params)
-
-    if resp['status'] not in ['200', '201', '202']:
-        on_error(content)
-    else:
-        on_success(content)
+    def do_request():
+        # the oauth2 client (httplib2) has a single timeout for connect and reads
+        timeout = None
+        if deadline is not None:
+            timeout = deadline.timeouts()[1]
+
+        # do we need an OAuth token, or just the consumer?
+        if not credentials:
+            client = oauth.Client(CONSUMER, timeout=timeout)
+            return client.request(full_url, method, body = body,
+                                  headers = headers,
+                                  oauth_extra_params=oauth_extra_params)
+
+        # the user's session keeps signing clients (and their connections) between requests
+        client = sessions.borrow(credentials, 'oauth_client', lambda: _new_client(credentials))
+        sessions.set_http_timeout(client, timeout)
+        result = client.request(full_url, method, body = body,
+                                headers = headers,
+                                oauth_extra_params=oauth_extra_params)
+        # a client that failed mid-request isn't given back
+        sessions.give_back(credentials, 'oauth_client', client, sessions.close_http)
+        return result
+
+    def on_response(result):
+        resp, content = result
+        if resp['status'] not in ['200', '201', '202']:
+            on_error(utils.UpstreamError(int(resp['status']), content))
+        else:
+            on_success(content)
 
+    _pool.submit(do_request, on_response, on_error, cancel_token)
 
 def generate_authorize_url(web_handler, url_callback, on_success, on_error):
     """
@@ -90,7 +122,7 @@ def generate_authorize_url(web_handler, url_callback, on_success, on_error):
                     oauth_extra_params={'oauth_callback': url_callback},
                     credentials = None,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get a request token - %s" % content))
+                    on_error = utils.with_error_prefix(on_error, "couldn't get a request token - "))
 
 def complete_authorization(web_handler, request_token, on_success, on_error):
     """
@@ -112,10 +144,10 @@ def complete_authorization(web_handler, request_token, on_success, on_error):
                     oauth_extra_params = None,
                     credentials = request_token,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get an access token %s" % content))
+                    on_error = utils.with_error_prefix(on_error, "couldn't get an access token "))
 
 
-def get_photosets(user_id, credentials, on_success, on_error):
+def get_photosets(user_id, credentials, on_success, on_error, cancel_token=None, deadline=None):
     """
     list the user's photosets
     
@@ -139,15 +171,18 @@ def get_photosets(user_id, credentials, on_success, on_error):
                     oauth_extra_params = None,
                     credentials = credentials,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get photosets: %s" % content))
+                    on_error = utils.with_error_prefix(on_error, "couldn't get photosets: "),
+                    cancel_token = cancel_token,
+                    deadline = deadline)
 
 
-def get_photos(user_id, credentials, photoset_id, on_success, on_error):
+def get_photos(user_id, credentials, photoset_id, on_success, on_error, cancel_token=None, deadline=None):
     """
     List a photoset's photos
     
     on_success is called with a list of dictionaries, each one including
-    id, name, description, and sizes a list of size dictionaries including: {size, url}
+    id, name, description, tags, updated (when the photo last changed, if the
+    provider says), and sizes a list of size dictionaries including: {size, url}
 
     on_error is called with an error message
     """
@@ -165,40 +200,42 @@ def get_photos(user_id, credentials, photoset_id, on_success, on_error):
         second = min(photo_el['width'], photo_el['height'])
         return PICASA_SIZE_TAGS.get("%sx%s" % (first,second), 'width-%s' % photo_el['width'])
         
-    def internal_on_success(content):
-        photo_feed = simplejson.loads(content)
-
-        photos = [{'id': photo['gphoto$id']['$t'],
-                   'name': photo['summary']['$t'],
-                   'description': photo['summary']['$t'],
-                   # combine the master and content and thumbnails
-                   'sizes': [{
-                        'size': 'master',
-                        'width': photo['gphoto$width']['$t'],
-                        'height': photo['gphoto$height']['$t'],
-                        'url': photo['content']['src']}] + [{
-                        'size': picasa_size_tag(content),
-                        'width': content['width'],
-                        'height': content['height'],
-                        'url' : content['url']
-                        } for content in photo['media$group']['media$content']] + [{
-                        'size': picasa_size_tag(thumbnail),
-                        'width': thumbnail['width'],
-                        'height': thumbnail['height'],
-                        'url' : thumbnail['url']
-                        } for thumbnail in photo['media$group']['media$thumbnail']]
-                   } for photo in photo_feed['feed']['entry']]
-        
-        # navigate to the part of the feed that is needed
-        on_success(photos)
-
-    _signed_request("GET","https://picasaweb.google.com/data/feed/api/user/default/albumid/%s" % photoset_id, params={"alt":"json"},
-                    oauth_extra_params = None,
-                    credentials = credentials,
-                    on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get photos: %s" % content))
-
-def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error):
+    # each entry is made into a photo as soon as it has been read
+    def make_photo(photo):
+        return {'id': photo['gphoto$id']['$t'],
+                'name': photo['summary']['$t'],
+                'description': photo['summary']['$t'],
+                'updated': photo.get('updated', {}).get('$t'),
+                'tags': utils.split_tags(photo['media$group'].get('media$keywords', {}).get('$t')),
+                # combine the master and content and thumbnails
+                'sizes': [{
+                     'size': 'master',
+                     'width': photo['gphoto$width']['$t'],
+                     'height': photo['gphoto$height']['$t'],
+                     'url': photo['content']['src']}] + [{
+                     'size': picasa_size_tag(content),
+                     'width': content['width'],
+                     'height': content['height'],
+                     'url' : content['url']
+                     } for content in photo['media$group']['media$content']] + [{
+                     'size': picasa_size_tag(thumbnail),
+                     'width': thumbnail['width'],
+                     'height': thumbnail['height'],
+                     'url' : thumbnail['url']
+                     } for thumbnail in photo['media$group']['media$thumbnail']]
+                }
+
+    # an empty album's feed has no entry at all
+    streamjson.get_items(_pool, credentials, _new_client, "https://picasaweb.google.com/data/feed/api/user/default/albumid/%s" % photoset_id, params={"alt":"json"},
+                         path = ['feed', 'entry'],
+                         make_item = make_photo,
+                         on_success = on_success,
+                         on_error = utils.with_error_prefix(on_error, "couldn't get photos: "),
+                         required = False,
+                         cancel_token = cancel_token,
+                         deadline = deadline)
+
+def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error, cancel_token=None, deadline=None):
     """
     this will call on_success with a dictionary of the new image,
     including 'id' and 'url'
@@ -208,9 +245,6 @@ def store_photo(user_id, credentials, photoset_id, photo, title, description, ta
         "it's XML, let's just pass it for now"
         on_success(content)
     
-    def internal_on_error(error):
-        on_error("couldn't upload image: %s" % error)
-
     # prepare a multipart-mime message
         
     # first the Atom description (FIXME: XML inline is kinda ugly)
@@ -224,7 +258,7 @@ def store_photo(user_id, credentials, photoset_id, photo, title, description, ta
 """ % (xml_escape(title), xml_escape(description))
 
     # treat the photo as a file
-    photo_file = cStringIO.StringIO(base64.b64decode(photo))
+    photo_file = utils.photo_file(photo)
 
     boundary, body = utils.multipart_encode(
         vars={},
@@ -247,8 +281,10 @@ Media multipart posting
                     oauth_extra_params = None,
                     credentials = credentials,
                     on_success = internal_on_success,
-                    on_error = internal_on_error,
-                    headers = headers)
+                    on_error = utils.with_error_prefix(on_error, "couldn't upload image: "),
+                    headers = headers,
+                    cancel_token = cancel_token,
+                    deadline = deadline)
         
 
 
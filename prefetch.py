@@ -0,0 +1,94 @@
+"""
+fetching photo listings ahead of time
+
+The picker lists a user's photosets and then, nearly always, opens one
+of the first few. After a photoset listing has been served, the
+prefetcher asks for the photos of the first top_n non-empty photosets
+at the lowest scheduler priority, so the listing cache already has them
+when the user picks one.
+
+Prefetching is bounded: at most per_user prefetches per user every
+window seconds, and at most max_in_flight at a time over all users.
+Whether the prefetched listings get used is counted by the listing
+cache; report() logs both sets of numbers.
+"""
+
+import time
+import logging
+
+import tornado.ioloop
+
+import upstream
+import utils
+
+class Prefetcher(object):
+
+    def __init__(self, top_n=3, per_user=10, window=60, max_in_flight=4, seconds=30, io_loop=None):
+        self.top_n = top_n
+        self.per_user = per_user
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.seconds = seconds
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.in_flight = 0
+        self._windows = {}      # user key -> (window start, prefetches started in it)
+        self.stats = {'started': 0, 'cached': 0, 'over_budget': 0, 'failed': 0}
+
+    def photosets_listed(self, user_id, credentials, photosets):
+        "a user was just shown this photoset listing"
+        candidates = [photoset for photoset in photosets if photoset.get('num_photos') != 0][:self.top_n]
+        for photoset in candidates:
+            if upstream.has_fresh_photos(user_id, credentials, photoset['id']):
+                self.stats['cached'] += 1
+                continue
+            if not self._take_budget((user_id, upstream.credentials_fingerprint(credentials))):
+                self.stats['over_budget'] += 1
+                continue
+            self._prefetch(user_id, credentials, photoset['id'])
+
+    def _take_budget(self, user_key):
+        if self.in_flight >= self.max_in_flight:
+            return False
+
+        now = time.time()
+        started, count = self._windows.get(user_key, (now, 0))
+        if now - started >= self.window:
+            started, count = now, 0
+        if count >= self.per_user:
+            return False
+        self._windows[user_key] = (started, count + 1)
+
+        # forget windows that are over, so this doesn't grow with every user ever seen
+        if len(self._windows) > 10000:
+            self._windows = dict((key, value) for key, value in self._windows.items()
+                                 if now - value[0] < self.window)
+        return True
+
+    def _prefetch(self, user_id, credentials, photoset_id):
+        self.in_flight += 1
+        self.stats['started'] += 1
+
+        def on_success(photos):
+            self.in_flight -= 1
+
+        def on_error(error):
+            self.in_flight -= 1
+            self.stats['failed'] += 1
+            logging.debug("prefetch of %s failed: %s" % (photoset_id, error))
+
+        upstream.get_photos(user_id, credentials, photoset_id, on_success, on_error,
+                            deadline=utils.Deadline(self.seconds), prefetch=True)
+
+    def report(self):
+        cache = upstream.listing_cache.stats
+        used = cache['prefetch_used']
+        done = used + cache['prefetch_wasted']
+        logging.info("prefetch: %d started, %d already cached, %d over budget, %d failed; "
+                     "%d of %d prefetched listings used (%s)" %
+                     (self.stats['started'], self.stats['cached'], self.stats['over_budget'],
+                      self.stats['failed'], used, done,
+                      "%d%%" % (100 * used / done) if done else "n/a"))
+
+    def start(self, report_seconds=300):
+        "log report() every report_seconds"
+        tornado.ioloop.PeriodicCallback(self.report, report_seconds * 1000, io_loop=self.io_loop).start()
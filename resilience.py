@@ -0,0 +1,233 @@
+"""
+retries, circuit breaking and hedging for idempotent upstream calls
+
+Listing calls that fail transiently -- no answer, or a 5xx -- are
+retried with jittered exponential backoff. Every provider has a circuit
+breaker: once the recent rate of such failures crosses a threshold,
+calls fail fast (or are answered from a stale copy, when the caller has
+one) until a cooldown has passed and a trial call gets through.
+Optionally, a call that is slower than the observed p95 for its method
+gets a duplicate "hedged" request, and whichever answers first wins.
+
+Only use this for calls that are safe to repeat -- never for uploads.
+"""
+
+import collections
+import random
+import time
+import logging
+
+import tornado.ioloop
+
+import scheduler
+import utils
+
+def transient(error):
+    """
+    whether error is the provider (or the way to it) failing, rather than an
+    answer about this request: a 401 for revoked credentials, a 404 for an
+    unknown photoset, or a message, won't go any differently if repeated
+    """
+    if isinstance(error, (scheduler.Busy, utils.DeadlineExceeded)):
+        # never got as far as the provider
+        return False
+    # tornado's HTTPError, or a utils.UpstreamError; 599 is no answer at all
+    code = getattr(error, 'code', None)
+    if code is not None:
+        return code >= 500
+    # anything else raised is the connection failing
+    return isinstance(error, Exception)
+
+class CircuitOpen(scheduler.Busy):
+    "the provider is failing, so we aren't sending it anything for a while"
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=20, min_calls=10, error_rate=0.5, cooldown=30):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        "may a call go upstream right now?"
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.time() >= self._opened_at + self.cooldown:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record(self, ok):
+        """
+        record the outcome of a call: True, False, or None when the call never
+        reached the provider (so it says nothing about the provider's health)
+        """
+        if self.state == self.HALF_OPEN:
+            self._trial = False
+            if ok:
+                logging.info("circuit for %s closed" % self.name)
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            elif ok is not None:
+                self._open()
+            return
+
+        if ok is None:
+            return
+        self._outcomes.append(ok)
+        if len(self._outcomes) >= self.min_calls:
+            errors = self._outcomes.count(False)
+            if errors >= self.error_rate * len(self._outcomes):
+                self._open()
+
+    def retry_after(self):
+        if self._opened_at is None:
+            return 1
+        return max(1, int(self._opened_at + self.cooldown - time.time()) + 1)
+
+    def _open(self):
+        logging.warning("circuit for %s opened" % self.name)
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        self._outcomes.clear()
+
+class LatencyTracker(object):
+    "latencies of recent successful calls"
+
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        "None until we've seen enough calls to say"
+        if len(self._samples) < self.min_samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+class Resilient(object):
+    """
+    wraps the idempotent calls of one provider.
+    fn is always called as fn(on_success, on_error, cancel_token, deadline).
+    """
+
+    def __init__(self, name, attempts=3, base_delay=0.2, max_delay=2.0,
+                 breaker=None, hedge=False, min_hedge_delay=0.05, io_loop=None):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(name, **(breaker or {}))
+        self.hedge = hedge
+        self.min_hedge_delay = min_hedge_delay
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.latency = {}
+        self.stats = {'retries': 0, 'hedged': 0, 'hedge_wins': 0, 'short_circuited': 0, 'stale': 0}
+
+    def call(self, method, fn, on_success, on_error, fallback=None, cancel_token=None, deadline=None):
+        """
+        fallback, if given, returns a stale result (or None) to serve while
+        the circuit is open. Once cancel_token is cancelled no more attempts
+        are made, and no retry or hedge is started that wouldn't fit in
+        what is left of deadline.
+        """
+        state = {'attempt': 0}
+
+        def attempt():
+            if utils.is_cancelled(cancel_token):
+                return
+            if not self.breaker.allow():
+                self.stats['short_circuited'] += 1
+                stale = fallback() if fallback else None
+                if stale is not None:
+                    self.stats['stale'] += 1
+                    on_success(stale)
+                else:
+                    on_error(CircuitOpen("%s is unavailable, try again later" % self.name,
+                                         self.breaker.retry_after()))
+                return
+            state['attempt'] += 1
+            self._hedged(method, fn, on_success, failed, cancel_token, deadline)
+
+        def failed(error):
+            # being over quota, out of time or turned down isn't something a retry would help
+            if not transient(error) or state['attempt'] >= self.attempts:
+                on_error(error)
+                return
+            backoff = min(self.max_delay, self.base_delay * 2 ** (state['attempt'] - 1))
+            delay = random.uniform(0, backoff)
+            if deadline is not None and deadline.remaining() <= delay:
+                on_error(error)
+                return
+            self.stats['retries'] += 1
+            timeout = self.io_loop.add_timeout(time.time() + delay, attempt)
+            if cancel_token is not None:
+                cancel_token.add_callback(lambda: self.io_loop.remove_timeout(timeout))
+
+        attempt()
+
+    def _hedged(self, method, fn, on_success, on_error, cancel_token, deadline):
+        tracker = self.latency.setdefault(method, LatencyTracker())
+        state = {'done': False, 'pending': 0, 'timeout': None}
+
+        def finish():
+            state['done'] = True
+            if state['timeout'] is not None:
+                self.io_loop.remove_timeout(state['timeout'])
+                state['timeout'] = None
+
+        def launch(hedge):
+            state['pending'] += 1
+            started = time.time()
+
+            def success(result):
+                state['pending'] -= 1
+                tracker.add(time.time() - started)
+                if state['done']:
+                    return
+                finish()
+                if hedge:
+                    self.stats['hedge_wins'] += 1
+                self.breaker.record(True)
+                on_success(result)
+
+            def error(e):
+                state['pending'] -= 1
+                # the other leg may still come through
+                if state['done'] or state['pending'] > 0:
+                    return
+                finish()
+                # only the provider failing counts against it
+                self.breaker.record(False if transient(e) else None)
+                on_error(e)
+
+            fn(success, error, cancel_token, deadline)
+
+        def send_hedge():
+            state['timeout'] = None
+            if not state['done'] and not utils.is_cancelled(cancel_token):
+                self.stats['hedged'] += 1
+                launch(True)
+
+        launch(False)
+
+        hedge_after = tracker.percentile(95) if self.hedge else None
+        if deadline is not None and hedge_after is not None and hedge_after >= deadline.remaining():
+            hedge_after = None
+        if hedge_after is not None and not state['done']:
+            state['timeout'] = self.io_loop.add_timeout(
+                time.time() + max(hedge_after, self.min_hedge_delay), send_hedge)
@@ -0,0 +1,138 @@
+"""
+resumable, chunked photo uploads
+
+A client creates an upload session, PUTs the photo in chunks at byte
+offsets, and finalizes it. Each chunk carries a SHA-1 that is checked
+before it is written to the session's spool file, so nothing but the
+chunk being received is ever in memory. After a dropped connection the
+client asks for the session's offset and carries on from there. On
+finalize the whole file is checked against its SHA-1 and handed on as a
+utils.SpooledPhoto.
+
+Sessions live on disk, so they survive a restart; abandoned ones are
+removed after max_age seconds.
+"""
+
+import os
+import re
+import time
+import uuid
+import hashlib
+
+import simplejson
+
+import upstream
+import utils
+
+SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadNotFound(Exception):
+    "no such upload session, or not this user's"
+
+class BadChunk(Exception):
+    "a chunk (or the finished file) doesn't match its checksum or offset"
+
+class UploadSessions(object):
+
+    def __init__(self, spool_dir, max_age=24 * 3600):
+        self.dir = os.path.join(spool_dir, 'sessions')
+        self.max_age = max_age
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+    def create(self, user_id, credentials):
+        "start a session, returning its id"
+        self.expire()
+
+        upload_id = uuid.uuid4().hex
+        open(self._data_path(upload_id), 'wb').close()
+        f = open(self._meta_path(upload_id), 'w')
+        try:
+            simplejson.dump({'user_id': user_id,
+                             'fingerprint': upstream.credentials_fingerprint(credentials),
+                             'created': time.time()}, f)
+        finally:
+            f.close()
+        return upload_id
+
+    def offset(self, upload_id, user_id, credentials):
+        "how many bytes of the photo we have so far"
+        self._check(upload_id, user_id, credentials)
+        return os.path.getsize(self._data_path(upload_id))
+
+    def write(self, upload_id, user_id, credentials, offset, data, sha1):
+        """
+        write a chunk at offset, returning the new offset. Writing before the
+        end (resending a chunk) drops whatever came after it.
+        """
+        self._check(upload_id, user_id, credentials)
+        if not sha1 or hashlib.sha1(data).hexdigest() != sha1.lower():
+            raise BadChunk("chunk checksum doesn't match")
+
+        path = self._data_path(upload_id)
+        size = os.path.getsize(path)
+        if offset < 0 or offset > size:
+            raise BadChunk("offset %s is past what we have (%s)" % (offset, size))
+
+        f = open(path, 'r+b')
+        try:
+            f.seek(offset)
+            f.write(data)
+            f.truncate(offset + len(data))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        return offset + len(data)
+
+    def finish(self, upload_id, user_id, credentials, sha1):
+        "check the whole photo against sha1, and return it as a utils.SpooledPhoto"
+        self._check(upload_id, user_id, credentials)
+        path = self._data_path(upload_id)
+        if not os.path.getsize(path):
+            raise BadChunk("nothing was uploaded")
+
+        digest = hashlib.sha1()
+        f = open(path, 'rb')
+        try:
+            for block in iter(lambda: f.read(64 * 1024), ''):
+                digest.update(block)
+        finally:
+            f.close()
+        if not sha1 or digest.hexdigest() != sha1.lower():
+            raise BadChunk("photo checksum doesn't match")
+
+        return utils.SpooledPhoto(path, sha1=digest.hexdigest())
+
+    def discard(self, upload_id):
+        for path in (self._data_path(upload_id), self._meta_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def expire(self):
+        "remove sessions nobody has touched for max_age"
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.dir):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            data_path = self._data_path(upload_id)
+            if not os.path.exists(data_path) or os.path.getmtime(data_path) < cutoff:
+                self.discard(upload_id)
+
+    def _check(self, upload_id, user_id, credentials):
+        if not SESSION_ID.match(upload_id or '') or not os.path.exists(self._meta_path(upload_id)):
+            raise UploadNotFound(upload_id)
+        f = open(self._meta_path(upload_id))
+        try:
+            meta = simplejson.load(f)
+        finally:
+            f.close()
+        if meta['user_id'] != user_id or meta['fingerprint'] != upstream.credentials_fingerprint(credentials):
+            raise UploadNotFound(upload_id)
+
+    def _data_path(self, upload_id):
+        return os.path.join(self.dir, upload_id)
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.dir, upload_id + '.json')
@@ -0,0 +1,196 @@
+"""
+rate limiting and prioritisation of upstream provider calls
+
+Flickr and SmugMug enforce per-key quotas, so each provider + API key
+gets a token bucket and every upstream call waits for a token. Waiting
+calls are queued by priority class, so interactive browsing goes ahead
+of bulk uploads, and listings fetched ahead of time go last. Queues are
+bounded, both in length and in how long a call may wait; past either
+limit the call is rejected right away with Busy, which carries a
+Retry-After estimate for the client.
+"""
+
+import collections
+import math
+import time
+import logging
+
+import tornado.ioloop
+
+import config
+import utils
+
+# highest priority first
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PREFETCH = 'prefetch'
+PRIORITIES = [INTERACTIVE, BULK, PREFETCH]
+
+# per priority class: (max queued calls, max seconds a call may sit in the queue)
+DEFAULT_QUEUES = {
+    INTERACTIVE: (100, 10),
+    BULK: (50, 60),
+    PREFETCH: (20, 30),
+}
+
+class Busy(Exception):
+    "the upstream is over quota; retry_after is a whole number of seconds"
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+class TokenBucket(object):
+    "rate tokens per second, holding at most burst of them"
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        "seconds until the next token is available"
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class Scheduler(object):
+
+    def __init__(self, name, rate, burst, queues=None, io_loop=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limits = dict(DEFAULT_QUEUES)
+        self.limits.update(queues or {})
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._queues = dict((priority, collections.deque()) for priority in PRIORITIES)
+        self._timeout = None
+        self.stats = dict((priority, {'run': 0, 'queued': 0, 'rejected': 0, 'expired': 0, 'cancelled': 0})
+                          for priority in PRIORITIES)
+
+    def submit(self, priority, run, on_reject, cancel_token=None, deadline=None):
+        """
+        call run() once the quota allows it, or on_reject(Busy) if the
+        queue for this priority is full or the call waits too long.
+        a call cancelled while queued is dropped without using a token.
+
+        a call never waits past its deadline; if that is what stops it,
+        on_reject gets utils.DeadlineExceeded instead.
+        """
+        if utils.is_cancelled(cancel_token):
+            return
+        if deadline is not None and deadline.expired():
+            on_reject(utils.DeadlineExceeded("timed out before reaching %s" % self.name))
+            return
+
+        stats = self.stats[priority]
+        if not self._queued_ahead(priority) and self.bucket.take():
+            stats['run'] += 1
+            run()
+            return
+
+        queue = self._queues[priority]
+        max_queued, max_wait = self.limits[priority]
+        if len(queue) >= max_queued:
+            stats['rejected'] += 1
+            on_reject(Busy("%s is busy, try again later" % self.name, self.retry_after(priority)))
+            return
+
+        stats['queued'] += 1
+        expires = time.time() + max_wait
+        by_deadline = deadline is not None and deadline.expires < expires
+        if by_deadline:
+            expires = deadline.expires
+        entry = (expires, run, on_reject, by_deadline)
+        queue.append(entry)
+        if cancel_token is not None:
+            cancel_token.add_callback(lambda: self._withdraw(priority, entry))
+        self._schedule()
+
+    def queue_length(self, priority):
+        return len(self._queues[priority])
+
+    def retry_after(self, priority):
+        "rough number of seconds until a new call at this priority would get a token"
+        ahead = sum(len(self._queues[p]) for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        return max(1, int(math.ceil(ahead / self.bucket.rate + self.bucket.wait_time())))
+
+    def _withdraw(self, priority, entry):
+        try:
+            self._queues[priority].remove(entry)
+        except ValueError:
+            # already run, expired or rejected
+            return
+        self.stats[priority]['cancelled'] += 1
+
+    def _queued_ahead(self, priority):
+        for p in PRIORITIES[:PRIORITIES.index(priority) + 1]:
+            if self._queues[p]:
+                return True
+        return False
+
+    def _drain(self):
+        self._timeout = None
+        now = time.time()
+
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            # entries cut short by a deadline may expire out of order
+            for entry in [entry for entry in queue if entry[0] <= now]:
+                expires, run, on_reject, by_deadline = entry
+                queue.remove(entry)
+                self.stats[priority]['expired'] += 1
+                if by_deadline:
+                    error = utils.DeadlineExceeded("timed out waiting for %s" % self.name)
+                else:
+                    error = Busy("%s is busy, gave up waiting" % self.name, self.retry_after(priority))
+                self._call(on_reject, error)
+
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and self.bucket.take():
+                expires, run, on_reject, by_deadline = queue.popleft()
+                self.stats[priority]['run'] += 1
+                self._call(run)
+            if queue:
+                break
+
+        self._schedule()
+
+    def _call(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            logging.exception("scheduled upstream call failed")
+
+    def _schedule(self):
+        if self._timeout is not None:
+            return
+        waits = [self.bucket.wait_time()]
+        waits += [min(entry[0] for entry in queue) - time.time() for queue in self._queues.values() if queue]
+        if len(waits) == 1:
+            return
+        self._timeout = self.io_loop.add_timeout(time.time() + max(0, min(waits)), self._drain)
+
+_schedulers = {}
+
+def get(provider, api_key):
+    "the scheduler for this provider and API key, created on first use"
+    key = (provider, api_key)
+    if key not in _schedulers:
+        _schedulers[key] = Scheduler(provider,
+                                     rate = getattr(config, 'UPSTREAM_RATE', 1.0),
+                                     burst = getattr(config, 'UPSTREAM_BURST', 10),
+                                     queues = getattr(config, 'UPSTREAM_QUEUES', None))
+    return _schedulers[key]
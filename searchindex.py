@@ -0,0 +1,183 @@
+"""
+in-memory photo search
+
+Every photo listing that comes back from the provider is added to an
+inverted index of its user's photos: the words of each photo's name,
+description, tags and the names of the photosets it is in. /search
+answers from the index alone, so it only finds photos in photosets that
+have been listed since the process started.
+
+Users are kept in least recently used order, and whole users are dropped
+once there are more than max_users, or more than max_photos photos over
+all users.
+"""
+
+import re
+import bisect
+import collections
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+def words(text):
+    if not text:
+        return []
+    return WORD.findall(unicode(text).lower())
+
+class _UserIndex(object):
+
+    def __init__(self):
+        self.photos = {}            # photo id -> photo
+        self.memberships = {}       # photo id -> set of photoset ids
+        self.photoset_names = {}    # photoset id -> name
+        self.photo_terms = {}       # photo id -> set of terms
+        self.postings = {}          # term -> set of photo ids
+        self._sorted_terms = None
+
+    def set_photosets(self, photosets):
+        for photoset in photosets:
+            photoset_id = str(photoset['id'])
+            if self.photoset_names.get(photoset_id) != photoset.get('name'):
+                self.photoset_names[photoset_id] = photoset.get('name')
+                for photo_id, memberships in self.memberships.items():
+                    if photoset_id in memberships:
+                        self._index(photo_id)
+
+    def set_photos(self, photoset_id, photos):
+        "photos is the whole of the photoset, replacing what was there"
+        photoset_id = str(photoset_id)
+        current = set()
+        for photo in photos:
+            photo_id = str(photo['id'])
+            current.add(photo_id)
+            self.photos[photo_id] = photo
+            self.memberships.setdefault(photo_id, set()).add(photoset_id)
+            self._index(photo_id)
+
+        for photo_id, memberships in self.memberships.items():
+            if photoset_id in memberships and photo_id not in current:
+                memberships.discard(photoset_id)
+                if memberships:
+                    self._index(photo_id)
+                else:
+                    self._forget(photo_id)
+
+    def _terms(self, photo_id):
+        photo = self.photos[photo_id]
+        terms = set(words(photo.get('name')))
+        terms.update(words(photo.get('description')))
+        for tag in photo.get('tags') or []:
+            terms.update(words(tag))
+        for photoset_id in self.memberships[photo_id]:
+            terms.update(words(self.photoset_names.get(photoset_id)))
+        return terms
+
+    def _index(self, photo_id):
+        terms = self._terms(photo_id)
+        previous = self.photo_terms.get(photo_id, set())
+        for term in previous - terms:
+            self._unpost(term, photo_id)
+        for term in terms - previous:
+            if term not in self.postings:
+                self.postings[term] = set()
+                self._sorted_terms = None
+            self.postings[term].add(photo_id)
+        self.photo_terms[photo_id] = terms
+
+    def _forget(self, photo_id):
+        for term in self.photo_terms.pop(photo_id, ()):
+            self._unpost(term, photo_id)
+        del self.photos[photo_id]
+        del self.memberships[photo_id]
+
+    def _unpost(self, term, photo_id):
+        photo_ids = self.postings[term]
+        photo_ids.discard(photo_id)
+        if not photo_ids:
+            del self.postings[term]
+            self._sorted_terms = None
+
+    def matching(self, word, prefix):
+        "ids of photos with the term word, or with any term starting with it"
+        if not prefix:
+            return self.postings.get(word, set())
+
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        matches = set()
+        i = bisect.bisect_left(self._sorted_terms, word)
+        while i < len(self._sorted_terms) and self._sorted_terms[i].startswith(word):
+            matches.update(self.postings[self._sorted_terms[i]])
+            i += 1
+        return matches
+
+class SearchIndex(object):
+
+    def __init__(self, max_users=1000, max_photos=200000):
+        self.max_users = max_users
+        self.max_photos = max_photos
+        self._users = collections.OrderedDict()
+        self._photo_count = 0
+        self.stats = {'searches': 0, 'evicted_users': 0}
+
+    def _user(self, user_key, create=False):
+        index = self._users.pop(user_key, None)
+        if index is None and create:
+            index = _UserIndex()
+        if index is not None:
+            # most recently used last
+            self._users[user_key] = index
+        return index
+
+    def _update(self, user_key, change):
+        index = self._user(user_key, create=True)
+        before = len(index.photos)
+        change(index)
+        self._photo_count += len(index.photos) - before
+
+        while self._users and (len(self._users) > self.max_users or self._photo_count > self.max_photos):
+            _, evicted = self._users.popitem(last=False)
+            self._photo_count -= len(evicted.photos)
+            self.stats['evicted_users'] += 1
+
+    def add_photosets(self, user_key, photosets):
+        "a user's photoset listing, for the photoset names"
+        self._update(user_key, lambda index: index.set_photosets(photosets))
+
+    def add_photos(self, user_key, photoset_id, photos):
+        "a photoset's photo listing"
+        self._update(user_key, lambda index: index.set_photos(photoset_id, photos))
+
+    def search(self, user_key, query, photoset_id=None, limit=50):
+        """
+        photos matching every word of query; a word ending in * matches any
+        word starting with it. Each photo gets a photoset_ids list.
+        """
+        self.stats['searches'] += 1
+        index = self._user(user_key)
+        if index is None:
+            return []
+
+        matches = None
+        for part in query.split():
+            prefix = part.endswith('*')
+            for word in words(part):
+                # only the last word of something like "new-yo*" is a prefix
+                found = index.matching(word, prefix and part.lower().rstrip('*').endswith(word))
+                matches = found if matches is None else matches & found
+        if not matches:
+            return []
+
+        results = []
+        for photo_id in sorted(matches):
+            memberships = index.memberships[photo_id]
+            if photoset_id is not None and str(photoset_id) not in memberships:
+                continue
+            photo = dict(index.photos[photo_id])
+            photo['photoset_ids'] = sorted(memberships)
+            results.append(photo)
+            if len(results) >= limit:
+                break
+        return results
+
+    def size(self):
+        return {'users': len(self._users), 'photos': self._photo_count}
@@ -24,6 +24,21 @@ elif os.path.exists(os.path.join("..", CONFIG_FILE_NAME)):
 else:
   raise RuntimeError('no configuration file found: %s' % CONFIG_FILE_NAME)
 
+def command_line_option(name, default=None):
+  "the value after -name on the command line"
+  if name in sys.argv[:-1]:
+    return sys.argv[sys.argv.index(name) + 1]
+  return default
+
+# a dispatcher (-dispatch) only forwards requests to workers, so it starts
+# before anything a worker needs (databases, spool directories) is set up
+if __name__ == '__main__' and '-dispatch' in sys.argv:
+  import logging
+  import dispatch
+  logging.basicConfig(level = logging.DEBUG)
+  dispatch.run(config, int(command_line_option('-workers', 0)), os.path.abspath(__file__))
+  sys.exit()
+
 # photo provider stuff
 # dynamically import the right module
 
@@ -32,9 +47,134 @@ DOMAIN = "https://%s.mozillalabs.com" % APP_NAME
 
 photosite = __import__(config.PHOTO_SITE.lower())
 
+# listing and upload calls go through here rather than straight to photosite
+import upstream
+import scheduler
+import utils
+
+# time budget of a whole API request, in seconds, by kind of request
+DEADLINES = getattr(config, 'UPSTREAM_DEADLINES', {'listing': 20, 'upload': 120})
+CONNECT_TIMEOUT = getattr(config, 'UPSTREAM_CONNECT_TIMEOUT', 5)
+
+# a worker started by a local dispatcher (-worker N) has its own upload queue
+# and spool, since those assume a single process
+WORKER = command_line_option('-worker')
+def worker_path(path):
+  if WORKER is None:
+    return path
+  return "%s.%s" % (path, WORKER)
+
+# bytes of memory uploads may use between them, in this process
+import admission
+upload_memory = admission.MemoryBudget(getattr(config, 'UPLOAD_MEMORY_BUDGET', 256 * 1024 * 1024),
+                                       factor = getattr(config, 'UPLOAD_MEMORY_FACTOR', 3),
+                                       photo_url_size = getattr(config, 'UPLOAD_PHOTO_URL_SIZE', 8 * 1024 * 1024),
+                                       max_wait = getattr(config, 'UPLOAD_MEMORY_WAIT', 10),
+                                       max_waiting = getattr(config, 'UPLOAD_MEMORY_MAX_WAITING', 100))
+
+# background uploads (/post/photo?background=1)
+import uploadqueue
+uploads = uploadqueue.UploadQueue(worker_path(getattr(config, 'UPLOAD_DB', 'uploads.db')),
+                                  worker_path(getattr(config, 'UPLOAD_SPOOL_DIR', 'spool')),
+                                  workers = getattr(config, 'UPLOAD_WORKERS', 4),
+                                  upload_seconds = DEADLINES['upload'],
+                                  max_busy = getattr(config, 'UPLOAD_MAX_BUSY', 20),
+                                  memory = upload_memory)
+
+# resumable uploads (/post/photo/upload)
+import resumable
+upload_sessions = resumable.UploadSessions(worker_path(getattr(config, 'UPLOAD_SPOOL_DIR', 'spool')),
+                                           max_age = getattr(config, 'UPLOAD_SESSION_MAX_AGE', 24 * 3600))
+
+# how many of a user's photos /post/photos uploads at once, across all their requests
+bulk_slots = utils.KeyedLimiter(getattr(config, 'BULK_UPLOADS_PER_USER', 4))
+
+# optional: after /get/photosets, fetch the first few photosets' photos ahead of time
+import prefetch
+if getattr(config, 'PREFETCH_PHOTOSETS', 0) and upstream.listing_cache is not None:
+  prefetcher = prefetch.Prefetcher(top_n = config.PREFETCH_PHOTOSETS,
+                                   per_user = getattr(config, 'PREFETCH_PER_USER', 10),
+                                   window = getattr(config, 'PREFETCH_WINDOW', 60),
+                                   max_in_flight = getattr(config, 'PREFETCH_MAX_IN_FLIGHT', 4),
+                                   seconds = DEADLINES['listing'])
+else:
+  prefetcher = None
+
+# parsed credentials and provider signing objects, reused across a user's requests
+import sessions
+user_sessions = sessions.SessionRegistry(upstream.credentials_fingerprint,
+                                         max_sessions = getattr(config, 'SESSION_MAX', 10000),
+                                         max_idle = getattr(config, 'SESSION_MAX_IDLE', 200))
+
+# per-photoset snapshots behind /get/photos?since=
+import deltasync
+snapshots = deltasync.Snapshots(getattr(config, 'SNAPSHOT_DB', 'snapshots.db'),
+                                tombstone_age = getattr(config, 'SNAPSHOT_TOMBSTONE_AGE', 30 * 24 * 3600))
+
 class WebHandler(tornado.web.RequestHandler):
   "base handler for this entire app"
 
+  def initialize(self):
+    # cancelled if the client goes away before we finish
+    self.cancel_token = utils.CancelToken()
+    self.deadline = None
+    self._deadline_timeout = None
+    self._upload_memory = 0
+
+  def on_connection_close(self):
+    "abandon any upstream work still going on for a client that has gone away"
+    self._clear_deadline()
+    self._release_upload_memory()
+    self.cancel_token.cancel()
+
+  def admit_upload(self, size, callback, photo_urls=0):
+    """
+    call callback once the upload memory budget has room for an upload of
+    size bytes (fetching photo_urls photos), held until this request is over;
+    if it doesn't in time, the client gets a 503
+    """
+    def admitted():
+      if self.cancel_token.cancelled:
+        upload_memory.release(cost)
+        return
+      self._upload_memory = cost
+      callback()
+
+    cost = upload_memory.cost(size, photo_urls)
+    upload_memory.acquire(cost, admitted, self.write_upstream_error, self.cancel_token)
+
+  def request_size(self):
+    return int(self.request.headers.get("Content-Length", len(self.request.body or '')))
+
+  def _release_upload_memory(self):
+    if self._upload_memory:
+      upload_memory.release(self._upload_memory)
+      self._upload_memory = 0
+
+  def start_deadline(self, kind):
+    """
+    give this request its time budget ('listing' or 'upload'), shared by every
+    upstream step it takes. If it runs out, the steps are cancelled and the
+    client gets a 504 straight away.
+    """
+    self.deadline = utils.Deadline(DEADLINES[kind], CONNECT_TIMEOUT)
+    self._deadline_timeout = tornado.ioloop.IOLoop.instance().add_timeout(self.deadline.expires, self.on_deadline)
+
+  def on_deadline(self):
+    self._deadline_timeout = None
+    self.cancel_token.cancel()
+    self.write_upstream_error(utils.DeadlineExceeded("timed out"))
+
+  def _clear_deadline(self):
+    if self._deadline_timeout is not None:
+      tornado.ioloop.IOLoop.instance().remove_timeout(self._deadline_timeout)
+      self._deadline_timeout = None
+
+  def finish(self, chunk=None):
+    self._clear_deadline()
+    tornado.web.RequestHandler.finish(self, chunk)
+    self._release_upload_memory()
+
   def get_error_html(self, status_code, **kwargs):
     return """
 <html><title>Error!</title><style>.box {margin:16px;padding:8px;border:1px solid black;font:14pt Helvetica,arial}
@@ -50,11 +190,24 @@ you should <a href='/'>return to the front page.</a><br><br><div class='small'>%
       raise Exception("missing user_id and credentials")
 
     try:
-      credentials = simplejson.loads(credentials_json)
+      session = user_sessions.get(user_id, credentials_json)
     except:
       raise Exception("bad credentials -- JSON")
       
-    return user_id, credentials
+    return user_id, session.credentials
+
+  def write_upstream_error(self, error):
+    """
+    finish with an upstream error; if the provider quota is used up, tell the
+    client when to retry, and if we ran out of time, say so
+    """
+    if isinstance(error, scheduler.Busy):
+      self.set_status(503)
+      self.set_header("Retry-After", str(error.retry_after))
+    elif isinstance(error, utils.DeadlineExceeded):
+      self.set_status(504)
+    self.write("error: %s" % error)
+    self.finish()
     
   def render_platform(self, file, templates=False, **kwargs):
     target_file = file
@@ -104,6 +257,20 @@ class XRDSHandler(WebHandler):
 class Connect(WebHandler):
   @tornado.web.asynchronous
   def get(self):
+    # the credentials this connection replaces, if the client still has
+    # them: ConnectDone drops what we kept for them. Picasa and SmugMug
+    # have no real user_id to go by, so without these the old sessions
+    # stay until they are evicted.
+    replaces = self.get_argument("credentials", None)
+    if replaces:
+      try:
+        replaces = upstream.credentials_fingerprint(simplejson.loads(replaces))
+      except ValueError:
+        replaces = None
+    if replaces:
+      self.set_secure_cookie('replaces', replaces)
+    else:
+      self.clear_cookie('replaces')
     photosite.generate_authorize_url(self, "%s/connect/done" % config.URL_BASE, self.on_response, self.on_error)
 
   def on_response(self, request_token, authorize_url):
@@ -114,7 +281,7 @@ class Connect(WebHandler):
     self.redirect(authorize_url)
   
   def on_error(self, error):
-    self.write("error: " + error)
+    self.write("error: %s" % error)
     self.finish()
 
 class ConnectDone(WebHandler):
@@ -124,45 +291,85 @@ class ConnectDone(WebHandler):
     photosite.complete_authorization(self, request_token, self.on_success, self.on_error)
 
   def on_success(self, user_id, full_name, credentials):
+    # whatever we kept for the old credentials is no good now
+    if upstream.PROVIDER == 'flickr':
+      user_sessions.invalidate(user_id=user_id)
+    replaces = self.get_secure_cookie('replaces')
+    if replaces:
+      user_sessions.invalidate(fingerprint=replaces)
+      self.clear_cookie('replaces')
     self.render_platform("setcredentials", user_info={'user_id': user_id, 'full_name' : full_name, 'credentials' : simplejson.dumps(credentials)}, app_name=APP_NAME)
   
   def on_error(self, message):
-    self.write(message)
+    self.write("%s" % message)
     self.finish()
 
 class Photosets(WebHandler):
   @tornado.web.asynchronous
   def get(self):
-    user_id, credentials = self.get_user_id_and_credentials()
-    photosite.get_photosets(user_id, credentials, self.on_success, self.on_error)
+    self.user_id, self.credentials = self.get_user_id_and_credentials()
+    self.start_deadline('listing')
+    upstream.get_photosets(self.user_id, self.credentials, self.on_success, self.on_error,
+                           cancel_token=self.cancel_token, deadline=self.deadline)
 
   def on_success(self, photosets):
     self.write(simplejson.dumps(photosets))
     self.finish()
+    if prefetcher is not None:
+      prefetcher.photosets_listed(self.user_id, self.credentials, photosets)
 
   def on_error(self, message):
     import logging
     logging.error("error: %s" % message)
-    self.write("error: %s" % message)
-    self.finish()
+    self.write_upstream_error(message)
 
 class Photos(WebHandler):
+  """
+  the photos of a photoset, as a list.
+
+  With since (a cursor; pass it empty the first time) the answer is instead
+  {cursor, added, changed, removed, reset}: only what changed since the
+  listing that gave out the cursor. added and changed are photos to store
+  or replace, removed are photo ids. If reset is set, the cursor was too old
+  and added holds the whole photoset, which replaces the client's copy.
+  """
   @tornado.web.asynchronous
   def get(self):
-    user_id, credentials = self.get_user_id_and_credentials()
-    photoset_id = self.get_argument("photoset_id", None)
-    if not photoset_id:
+    self.user_id, credentials = self.get_user_id_and_credentials()
+    self.photoset_id = self.get_argument("photoset_id", None)
+    if not self.photoset_id:
       raise Exception("Missing required photosetid")
+    self.since = self.get_argument("since", None)
       
-    photosite.get_photos(user_id, credentials, photoset_id, self.on_success, self.on_error)
+    self.start_deadline('listing')
+    upstream.get_photos(self.user_id, credentials, self.photoset_id, self.on_success, self.on_error,
+                        cancel_token=self.cancel_token, deadline=self.deadline)
 
   def on_success(self, photos):
+    if self.since is not None:
+      photos = snapshots.delta(upstream.PROVIDER, self.user_id, self.photoset_id, photos, self.since)
     self.write(simplejson.dumps(photos))
     self.finish()
 
   def on_error(self, message):
-    self.write("error: %s" % message)
-    self.finish()
+    self.write_upstream_error(message)
+
+
+class Search(WebHandler):
+  """
+  the user's photos matching q (words; end one with * to match by prefix),
+  optionally only in photoset_id. Only photosets listed through this server
+  are searched, and no provider is called.
+  """
+  def get(self):
+    user_id, credentials = self.get_user_id_and_credentials()
+    query = self.get_argument("q", "")
+    photoset_id = self.get_argument("photoset_id", None)
+    try:
+      limit = int(self.get_argument("limit", 50))
+    except ValueError:
+      raise tornado.web.HTTPError(400, "limit must be a number")
+    self.write(simplejson.dumps(upstream.search(user_id, credentials, query, photoset_id, limit)))
 
 
 class GetPhotoSizes(WebHandler):
@@ -199,54 +406,317 @@ class GetPhotoSizes(WebHandler):
 class PostPhoto(WebHandler):
   @tornado.web.asynchronous
   def post(self):
-    user_id, credentials = self.get_user_id_and_credentials()
+    self.read_upload_arguments()
 
-    photo = self.get_argument("photo", None) #base64ed?
+    self.photo = self.get_argument("photo", None) #base64ed?
     photo_url = self.get_argument("photo_url", None) #base64ed?
-    title = self.get_argument("title", None)
-    description = self.get_argument("description", None)
-    tags = self.get_argument("tags", None) # space-separated
     
     # did we get a photo_url instead?
-    if not photo and not photo_url:
+    if not self.photo and not photo_url:
       raise Exception("no photo")
 
-    if photo and photo_url:
+    if self.photo and photo_url:
       raise Exception("only submit photo or photo_url")
 
-    def do_it(photoset_id, photo_data):
-      photosite.store_photo(user_id, credentials, photoset_id,
-                            photo_data, title, description, tags,
-                            on_success= self.on_success,
-                            on_error= self.on_error)
-    
-    def get_photoset_id(photo_data):
-      photoset_id = self.get_argument("photoset_id", None)
+    self.admit_upload(self.request_size(), lambda: self.upload(photo_url), photo_urls=photo_url and 1 or 0)
+
+  def read_upload_arguments(self):
+    self.user_id, self.credentials = self.get_user_id_and_credentials()
+    self.title = self.get_argument("title", None)
+    self.description = self.get_argument("description", None)
+    self.tags = self.get_argument("tags", None) # space-separated
+
+  def upload(self, photo_url=None):
+    "upload self.photo, or whatever is at photo_url"
+    if self.get_argument("background", None):
+      # spool it and answer right away; progress is at /post/photo/status
+      job_id = uploads.enqueue(self.user_id, self.credentials, self.get_argument("photoset_id", None),
+                               self.title, self.description, self.tags,
+                               photo=self.photo, photo_url=photo_url)
+      self.write(simplejson.dumps({'job_id': job_id, 'state': uploadqueue.PENDING}))
+      self.finish()
+      return
+
+    # one budget for fetching the photo, finding the photoset and uploading
+    self.start_deadline('upload')
+
+    # fetching the photo and finding the default photoset don't depend on
+    # each other, so do both at once and upload when both are done
+    steps = utils.Join(self.on_ready, self.on_error, self.cancel_token)
+    if photo_url:
+      self.fetch_photo(photo_url, *steps.add('photo'))
+    if not self.get_argument("photoset_id", None):
+      self.get_default_photoset(*steps.add('photoset_id'))
+    steps.start()
+
+  def fetch_photo(self, photo_url, on_success, on_error):
+    def on_photo_fetched(response):
+      if self.cancel_token.cancelled:
+        return
+      if response.error:
+        on_error("couldn't fetch photo_url: %s" % response.error)
+        return
+      self.photo = base64.b64encode(response.body)
+      on_success(None)
 
-      if photoset_id:
-        do_it(photoset_id, photo_data)
-      else:
-        # go get the first photoset
-        photosite.get_photosets(user_id, credentials,
-                                on_success= lambda photosets: do_it(photo_data, photosets[0]['id']),
-                                on_error= lambda content: on_error("couldn't get photosets to upload image"))
+    http = tornado.httpclient.AsyncHTTPClient()
+    http.fetch(tornado.httpclient.HTTPRequest(photo_url, **utils.timeout_args(self.deadline)),
+               callback=on_photo_fetched)
 
-    if photo_url:
-      # we have to go fetch it
-      http = tornado.httpclient.AsyncHTTPClient()
-      
-      # assume success for now
-      http.fetch(photo_url, callback=lambda response: get_photoset_id(base64.b64encode(response.body)))
-    else:
-      get_photoset_id(photo)
+  def get_default_photoset(self, on_success, on_error):
+    def on_photosets(photosets):
+      if not photosets:
+        on_error("no photoset to upload to")
+      else:
+        on_success(photosets[0]['id'])
+
+    # go get the first photoset
+    upstream.get_photosets(self.user_id, self.credentials,
+                           on_success= on_photosets,
+                           on_error= on_error,
+                           cancel_token= self.cancel_token,
+                           deadline= self.deadline)
+
+  def on_ready(self, results):
+    self.do_it(results.get('photoset_id') or self.get_argument("photoset_id"))
+
+  def do_it(self, photoset_id):
+    upstream.store_photo(self.user_id, self.credentials, photoset_id,
+                         self.photo, self.title, self.description, self.tags,
+                         on_success= self.on_success,
+                         on_error= self.on_error,
+                         cancel_token= self.cancel_token,
+                         deadline= self.deadline)
+
+  def on_connection_close(self):
+    WebHandler.on_connection_close(self)
+    # let go of the photo now, rather than whenever the upstream work notices
+    self.photo = None
+    self.request.arguments.pop("photo", None)
+    self.request.body = None
 
   def on_success(self, response_xml):
     self.write(response_xml)
     self.finish()
 
   def on_error(self, message):
-    self.write("error: %s" % message)
-    self.finish()
+    self.write_upstream_error(message)
+
+
+class PostPhotos(WebHandler):
+  """
+  upload many photos (files named "photo", and/or photo_url arguments) in
+  one request. The photoset is resolved once, uploads run in parallel up to
+  the user's limit, and a line of JSON is streamed back as each one finishes.
+  """
+
+  @tornado.web.asynchronous
+  def post(self):
+    self.user_id, self.credentials = self.get_user_id_and_credentials()
+    self.title = self.get_argument("title", None)
+    self.description = self.get_argument("description", None)
+    self.tags = self.get_argument("tags", None) # space-separated
+
+    # (name, photo, photo_url) for each photo; a photo is only base64-encoded
+    # once its upload starts, well after admission
+    self.items = [(f['filename'], f['body'], None) for f in self.request.files.get("photo", [])]
+    self.items += [(url, None, url) for url in self.get_arguments("photo_url")]
+    if not self.items:
+      raise Exception("no photos")
+    # the photos are in self.items now, each a copy of its part of the
+    # body, so let go of the batch as sent and of the parsed files
+    size = self.request_size()
+    self.request.body = None
+    self.request.files = {}
+
+    self.remaining = len(self.items)
+    self.uploaded = 0
+    self.holding = set()
+    # index -> bytes charged for a photo_url being fetched and uploaded
+    self.url_memory = {}
+
+    # photo_urls are charged for one at a time, in upload
+    self.admit_upload(size, self.resolve_photoset)
+
+  def resolve_photoset(self):
+    photoset_id = self.get_argument("photoset_id", None)
+    if photoset_id:
+      self.start_uploads(photoset_id)
+    else:
+      # go get the first photoset, once for the whole batch
+      upstream.get_photosets(self.user_id, self.credentials,
+                             on_success= self.on_photosets,
+                             on_error= self.write_upstream_error,
+                             cancel_token= self.cancel_token,
+                             deadline= utils.Deadline(DEADLINES['listing'], CONNECT_TIMEOUT))
+
+  def on_photosets(self, photosets):
+    if not photosets:
+      self.write_upstream_error("no photoset to upload to")
+      return
+    self.start_uploads(photosets[0]['id'])
+
+  def start_uploads(self, photoset_id):
+    self.photoset_id = photoset_id
+    self.set_header("Content-Type", "text/plain; charset=UTF-8")
+    for index in range(len(self.items)):
+      bulk_slots.acquire(self.user_id, lambda index=index: self.upload(index), self.cancel_token)
+
+  def upload(self, index):
+    self.holding.add(index)
+    name, photo, photo_url = self.items[index]
+    # don't hold on to the photo any longer than its upload
+    self.items[index] = None
+
+    # each photo gets its own budget, starting when its upload does
+    deadline = utils.Deadline(DEADLINES['upload'], CONNECT_TIMEOUT)
+
+    def store(photo):
+      upstream.store_photo(self.user_id, self.credentials, self.photoset_id,
+                           photo, self.title, self.description, self.tags,
+                           on_success= lambda result: self.item_done(index, name, result=result),
+                           on_error= lambda error: self.item_done(index, name, error=error),
+                           cancel_token= self.cancel_token,
+                           deadline= deadline)
+
+    def on_photo_fetched(response):
+      if self.cancel_token.cancelled:
+        return
+      if response.error:
+        self.item_done(index, name, error="couldn't fetch photo_url: %s" % response.error)
+      else:
+        store(base64.b64encode(response.body))
+
+    def fetch():
+      if self.cancel_token.cancelled:
+        upload_memory.release(cost)
+        return
+      self.url_memory[index] = cost
+      http = tornado.httpclient.AsyncHTTPClient()
+      http.fetch(tornado.httpclient.HTTPRequest(photo_url, **utils.timeout_args(deadline)),
+                 callback=on_photo_fetched)
+
+    if photo_url:
+      # only the photos holding a bulk slot are in memory, so each is
+      # charged for while it does
+      cost = upload_memory.cost(0, photo_urls=1)
+      upload_memory.acquire(cost, fetch, lambda error: self.item_done(index, name, error=error),
+                            self.cancel_token)
+    else:
+      store(base64.b64encode(photo))
+
+  def item_done(self, index, name, result=None, error=None):
+    self.holding.discard(index)
+    bulk_slots.release(self.user_id)
+    if index in self.url_memory:
+      upload_memory.release(self.url_memory.pop(index))
+
+    line = {'index': index, 'name': name}
+    if error is None:
+      self.uploaded += 1
+      line['result'] = result
+    else:
+      line['error'] = "%s" % error
+      if isinstance(error, scheduler.Busy):
+        line['retry_after'] = error.retry_after
+    self.write(simplejson.dumps(line) + "\n")
+    self.flush()
+
+    self.remaining -= 1
+    if not self.remaining:
+      self.write(simplejson.dumps({'done': True,
+                                   'uploaded': self.uploaded,
+                                   'failed': len(self.items) - self.uploaded}) + "\n")
+      self.finish()
+
+  def on_connection_close(self):
+    WebHandler.on_connection_close(self)
+    # uploads in progress won't call back any more, so give their slots back now
+    for index in self.holding:
+      bulk_slots.release(self.user_id)
+    self.holding.clear()
+    for cost in self.url_memory.values():
+      upload_memory.release(cost)
+    self.url_memory.clear()
+    self.items = []
+    self.request.body = None
+
+
+class UploadSession(WebHandler):
+  "POST here to start a resumable upload"
+  def post(self):
+    user_id, credentials = self.get_user_id_and_credentials()
+    upload_id = upload_sessions.create(user_id, credentials)
+    self.write(simplejson.dumps({'upload_id': upload_id, 'offset': 0}))
+
+def upload_session_error(e):
+  "the HTTP error for a failed resumable upload step"
+  if isinstance(e, resumable.UploadNotFound):
+    return tornado.web.HTTPError(404)
+  return tornado.web.HTTPError(400, "%s" % e)
+
+class UploadChunk(WebHandler):
+  """
+  GET: how much of the photo we have (where to resume from)
+  PUT: a chunk of the photo at ?offset=, with its SHA-1 in X-Chunk-SHA1
+  """
+
+  def get(self, upload_id):
+    user_id, credentials = self.get_user_id_and_credentials()
+    try:
+      offset = upload_sessions.offset(upload_id, user_id, credentials)
+    except resumable.UploadNotFound, e:
+      raise upload_session_error(e)
+    self.write(simplejson.dumps({'upload_id': upload_id, 'offset': offset}))
+
+  def put(self, upload_id):
+    user_id, credentials = self.get_user_id_and_credentials()
+    try:
+      offset = upload_sessions.write(upload_id, user_id, credentials,
+                                     int(self.get_argument("offset")),
+                                     self.request.body,
+                                     self.request.headers.get("X-Chunk-SHA1"))
+    except (resumable.UploadNotFound, resumable.BadChunk, ValueError), e:
+      raise upload_session_error(e)
+    self.write(simplejson.dumps({'upload_id': upload_id, 'offset': offset}))
+
+class UploadFinalize(PostPhoto):
+  "POST here with the photo's sha1 (and the usual /post/photo arguments) to upload it"
+
+  @tornado.web.asynchronous
+  def post(self, upload_id):
+    self.upload_id = upload_id
+    self.read_upload_arguments()
+    try:
+      self.photo = upload_sessions.finish(upload_id, self.user_id, self.credentials, self.get_argument("sha1", None))
+    except (resumable.UploadNotFound, resumable.BadChunk), e:
+      raise upload_session_error(e)
+    self.admit_upload(self.photo.size(), self.upload)
+
+  # the session is only done with once the photo is safely elsewhere; after
+  # anything else going wrong, the client can still resume or finalize again
+
+  def upload(self, photo_url=None):
+    PostPhoto.upload(self, photo_url)
+    if self.get_argument("background", None):
+      # the queue has moved the photo into its own spool
+      upload_sessions.discard(self.upload_id)
+
+  def on_success(self, response_xml):
+    upload_sessions.discard(self.upload_id)
+    PostPhoto.on_success(self, response_xml)
+
+class PostPhotoStatus(WebHandler):
+  def get(self):
+    user_id, credentials = self.get_user_id_and_credentials()
+    job_id = self.get_argument("job_id", None)
+    if not job_id:
+      raise Exception("Missing required job_id")
+
+    status = uploads.status(job_id, user_id, credentials)
+    if status is None:
+      raise tornado.web.HTTPError(404)
+    self.write(simplejson.dumps(status))
 
 
 class Service_GetImage(WebHandler):
@@ -283,7 +753,13 @@ application = tornado.web.Application([
     (r"/get/photosets", Photosets),
     (r"/get/photos", Photos),
     (r"/get/photosizes", GetPhotoSizes),
+    (r"/search", Search),
     (r"/post/photo", PostPhoto),
+    (r"/post/photo/status", PostPhotoStatus),
+    (r"/post/photos", PostPhotos),
+    (r"/post/photo/upload", UploadSession),
+    (r"/post/photo/upload/([0-9a-f]+)", UploadChunk),
+    (r"/post/photo/upload/([0-9a-f]+)/finalize", UploadFinalize),
     (r"/service/getImage", Service_GetImage),
     (r"/service/sendImage", Service_SendImage),
     (r"/xrds", XRDSHandler),
@@ -292,13 +768,18 @@ application = tornado.web.Application([
 	], **settings)
 
 
-def run():
+def run(port=None):
+    port = port or config.PORT
     http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(config.PORT)
+    http_server.listen(port)
+    uploads.start()
+    upload_memory.start(getattr(config, 'UPLOAD_MEMORY_REPORT_SECONDS', 300))
+    if prefetcher is not None:
+      prefetcher.start(getattr(config, 'PREFETCH_REPORT_SECONDS', 300))
     
-    print "Starting server on %s" % config.PORT
+    print "Starting server on %s" % port
     tornado.ioloop.IOLoop.instance().start()
-		
+
 import logging
 import sys
 if __name__ == '__main__':
@@ -307,6 +788,5 @@ if __name__ == '__main__':
 		doctest.testmod()
 	else:
 		logging.basicConfig(level = logging.DEBUG)
-		run()
-	
-	
+		port = command_line_option('-port')
+		run(port and int(port))
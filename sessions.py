@@ -0,0 +1,183 @@
+"""
+per-user sessions
+
+Every API request carries the user's credentials as JSON. The registry
+keeps what we make from them, so repeat requests skip the work: the
+parsed credentials, and objects the provider module builds from them
+(for Picasa and SmugMug, oauth clients with their signing token and
+open connections). Sessions are keyed by user_id and a digest of the
+credentials JSON, hold at most max_sessions, dropping the least recently
+used, and are dropped when the user authorizes again (see invalidate).
+
+Idle objects hold sockets, so there are at most max_idle of them across
+all sessions; past that, whatever is given back is closed instead of
+kept. A dropped session closes its idle objects straight away.
+
+Parsed credentials that are a dictionary come back as Credentials, which
+knows its session and fingerprint; anything else is returned as parsed.
+"""
+
+import hashlib
+import threading
+import collections
+
+import simplejson
+
+class Credentials(dict):
+    "parsed credentials, tied to their session"
+
+    def __init__(self, values, session, fingerprint):
+        dict.__init__(self, values)
+        self.session = session
+        self.fingerprint = fingerprint
+
+class IdleLimit(object):
+    "how many idle objects all sessions may keep between them"
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        "room for one more idle object? if so, it is counted until put_back"
+        with self._lock:
+            if self.count >= self.limit:
+                return False
+            self.count += 1
+            return True
+
+    def put_back(self, n=1):
+        with self._lock:
+            self.count -= n
+
+class Session(object):
+
+    # idle objects kept per name; more than this at once are built and thrown away
+    MAX_IDLE = 2
+
+    def __init__(self, user_id, fingerprint=None, idle_limit=None):
+        self.user_id = user_id
+        self.fingerprint = fingerprint
+        self.credentials = None
+        self.idle_limit = idle_limit
+        self.closed = False
+        self._idle = {}         # name -> [(value, close)]
+        # borrow / give_back are called from provider threads
+        self._lock = threading.Lock()
+
+    def borrow(self, name, create):
+        "an idle object made by create(), or a new one; give it back when done"
+        with self._lock:
+            idle = self._idle.get(name)
+            if idle:
+                value, close = idle.pop()
+                if self.idle_limit is not None:
+                    self.idle_limit.put_back()
+                return value
+        return create()
+
+    def give_back(self, name, value, close=None):
+        "keep value for the next borrow, or if there's no room, close(value)"
+        with self._lock:
+            idle = self._idle.setdefault(name, [])
+            if not self.closed and len(idle) < self.MAX_IDLE and \
+                    (self.idle_limit is None or self.idle_limit.take()):
+                idle.append((value, close))
+                return
+        if close is not None:
+            close(value)
+
+    def close(self):
+        "close every idle object; anything given back from now on is closed too"
+        with self._lock:
+            self.closed = True
+            idle = [entry for entries in self._idle.values() for entry in entries]
+            self._idle = {}
+        if self.idle_limit is not None:
+            self.idle_limit.put_back(len(idle))
+        for value, close in idle:
+            if close is not None:
+                close(value)
+
+def borrow(credentials, name, create):
+    "session.borrow for credentials that have a session, or else just create()"
+    session = getattr(credentials, 'session', None)
+    if session is None:
+        return create()
+    return session.borrow(name, create)
+
+def give_back(credentials, name, value, close=None):
+    "session.give_back for credentials that have a session, or else just close(value)"
+    session = getattr(credentials, 'session', None)
+    if session is not None:
+        session.give_back(name, value, close)
+    elif close is not None:
+        close(value)
+
+def set_http_timeout(http, timeout):
+    "apply timeout to an httplib2.Http (an oauth.Client is one), including its open connections"
+    http.timeout = timeout
+    for connection in http.connections.values():
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+def close_http(http):
+    "close an httplib2.Http's open connections"
+    for connection in http.connections.values():
+        connection.close()
+    http.connections.clear()
+
+class SessionRegistry(object):
+
+    def __init__(self, fingerprint, max_sessions=10000, max_idle=200):
+        # fingerprint(credentials) is the digest used in upstream keys
+        self.fingerprint = fingerprint
+        self.max_sessions = max_sessions
+        self.idle_limit = IdleLimit(max_idle)
+        self._sessions = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0, 'invalidated': 0}
+
+    def get(self, user_id, credentials_json):
+        "the session for these credentials; ValueError if they aren't JSON"
+        key = (user_id, hashlib.sha1(credentials_json.encode('utf-8')).hexdigest())
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self.stats['hits'] += 1
+            self._sessions[key] = session
+            return session
+
+        self.stats['misses'] += 1
+        credentials = simplejson.loads(credentials_json)
+        session = Session(user_id, self.fingerprint(credentials), self.idle_limit)
+        if isinstance(credentials, dict):
+            credentials = Credentials(credentials, session, session.fingerprint)
+        session.credentials = credentials
+
+        self._sessions[key] = session
+        while len(self._sessions) > self.max_sessions:
+            _, evicted = self._sessions.popitem(last=False)
+            evicted.close()
+            self.stats['evicted'] += 1
+        return session
+
+    def invalidate(self, user_id=None, fingerprint=None):
+        """
+        drop the sessions of user_id, or of the credentials with this
+        fingerprint, once the user has authorized again and the old
+        credentials are no good. Only by user_id where the provider gives
+        out real ones; Picasa and SmugMug give everyone the same.
+        """
+        for key, session in self._sessions.items():
+            if (user_id is not None and session.user_id == user_id) or \
+               (fingerprint is not None and session.fingerprint == fingerprint):
+                del self._sessions[key]
+                session.close()
+                self.stats['invalidated'] += 1
+
+    def idle(self):
+        "how many idle objects the sessions are keeping"
+        return self.idle_limit.count
+
+    def size(self):
+        return len(self._sessions)
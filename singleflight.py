@@ -0,0 +1,86 @@
+"""
+request coalescing ("singleflight") for upstream provider calls
+
+concurrent calls with the same key share one in-flight call, and every
+caller waiting on it gets the same result or the same error. Nothing is
+kept once the call completes, so errors are never cached.
+"""
+
+import logging
+
+import utils
+
+class _Flight(object):
+
+    def __init__(self, deadline):
+        self.waiters = []
+        self.cancel_token = utils.CancelToken()
+        self.deadline = deadline
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._calls = {}
+        self.stats = {'calls': 0, 'coalesced': 0, 'abandoned': 0}
+
+    def in_flight(self):
+        return len(self._calls)
+
+    def has(self, key):
+        "whether a call for key is in flight"
+        return key in self._calls
+
+    def do(self, key, fn, on_success, on_error, cancel_token=None, deadline=None):
+        """
+        call fn(on_success, on_error, cancel_token, deadline) for this key, unless
+        an identical call is already in flight, in which case just wait for that one.
+
+        a caller whose cancel_token is cancelled stops waiting; when every
+        caller has gone, the shared call is cancelled too. The shared call
+        runs to the latest deadline of its callers.
+        """
+        flight = self._calls.get(key)
+        if flight is not None:
+            self.stats['coalesced'] += 1
+            if flight.deadline is not None and deadline is not None:
+                flight.deadline.extend_to(deadline)
+        else:
+            self.stats['calls'] += 1
+            flight = self._calls[key] = _Flight(deadline and deadline.copy())
+
+        waiter = (on_success, on_error)
+        flight.waiters.append(waiter)
+        if cancel_token is not None:
+            cancel_token.add_callback(lambda: self._leave(key, flight, waiter))
+
+        if len(flight.waiters) > 1 or flight.cancel_token.cancelled:
+            return
+
+        def finish(index):
+            def callback(value):
+                # ignore a provider calling back twice
+                if self._calls.get(key) is not flight:
+                    return
+                del self._calls[key]
+                for waiter in flight.waiters:
+                    try:
+                        waiter[index](value)
+                    except Exception:
+                        # one broken waiter shouldn't starve the others
+                        logging.exception("singleflight waiter failed for %r" % (key,))
+            return callback
+
+        try:
+            fn(finish(0), finish(1), flight.cancel_token, flight.deadline)
+        except Exception, e:
+            logging.exception("singleflight call failed for %r" % (key,))
+            finish(1)(e)
+
+    def _leave(self, key, flight, waiter):
+        if self._calls.get(key) is not flight:
+            return
+        flight.waiters.remove(waiter)
+        if not flight.waiters:
+            self.stats['abandoned'] += 1
+            del self._calls[key]
+            flight.cancel_token.cancel()
@@ -9,6 +9,9 @@ import oauth2 as oauth
 import urlparse, urllib
 import tornado
 import simplejson
+import utils
+import sessions
+import streamjson
 
 REQUEST_TOKEN_URL = 'http://api.smugmug.com/services/oauth/getRequestToken.mg'
 AUTHORIZE_URL = 'http://api.smugmug.com/services/oauth/authorize.mg'
@@ -16,9 +19,17 @@ ACCESS_TOKEN_URL = 'http://api.smugmug.com/services/oauth/getAccessToken.mg'
 
 CONSUMER = oauth.Consumer(config.KEYS['api_key'], config.KEYS['api_secret'])
 
+# the oauth2 client blocks, so requests are made on these threads
+_pool = utils.WorkerPool(getattr(config, 'PROVIDER_THREADS', 8))
+
 API_BASE = 'http://api.smugmug.com/services/api/json/1.3.0/'
 
-def _signed_request(method, url, params, oauth_extra_params, credentials, on_success, on_error):
+def _new_client(credentials):
+    "an oauth client for the user's requests, to be kept in their session"
+    token = oauth.Token(credentials['oauth_token'], credentials['oauth_token_secret'])
+    return oauth.Client(CONSUMER, token)
+
+def _signed_request(method, url, params, oauth_extra_params, credentials, on_success, on_error, cancel_token=None, deadline=None):
     """
     sign a request and make it.
     This is an internal method, it should not be called from outside of this file
@@ -28,15 +39,15 @@ def _signed_request(method, url, params, oauth_extra_params, credentials, on_suc
 
     credentials is a dictionary of oauth_token and oauth_token_secret. It can be null.
 
-    The goal is to make this asynchronous at some point soon.
-    """
+    The request itself runs on the worker pool; on_success / on_error are
+    called back on the IOLoop. on_error gets a utils.UpstreamError with the
+    status and response body, or the exception if there was no response (a
+    DeadlineExceeded, say). If cancel_token is cancelled before the request
+    starts it is dropped, and once cancelled nothing is called back.
 
-    # do we need an OAuth token, or just the consumer?
-    if credentials:
-        token = oauth.Token(credentials['oauth_token'], credentials['oauth_token_secret'])
-        client = oauth.Client(CONSUMER, token)
-    else:
-        client = oauth.Client(CONSUMER)
+    deadline, if given, sets the socket timeout from what is left of it when
+    the request actually starts.
+    """
 
     full_url = url
     body = ''
@@ -49,13 +60,35 @@ def _signed_request(method, url, params, oauth_extra_params, credentials, on_suc
         else:
             body = encoded_params
 
-    resp, content = client.request(full_url, method, body = body, oauth_extra_params=oauth_extra_params)
-
-    if resp['status'] != '200':
-        on_error(content)
-    else:
-        on_success(content)
+    def do_request():
+        # the oauth2 client (httplib2) has a single timeout for connect and reads
+        timeout = None
+        if deadline is not None:
+            timeout = deadline.timeouts()[1]
+
+        # do we need an OAuth token, or just the consumer?
+        if not credentials:
+            client = oauth.Client(CONSUMER, timeout=timeout)
+            return client.request(full_url, method, body = body,
+                                  oauth_extra_params=oauth_extra_params)
+
+        # the user's session keeps signing clients (and their connections) between requests
+        client = sessions.borrow(credentials, 'oauth_client', lambda: _new_client(credentials))
+        sessions.set_http_timeout(client, timeout)
+        result = client.request(full_url, method, body = body,
+                                oauth_extra_params=oauth_extra_params)
+        # a client that failed mid-request isn't given back
+        sessions.give_back(credentials, 'oauth_client', client, sessions.close_http)
+        return result
+
+    def on_response(result):
+        resp, content = result
+        if resp['status'] != '200':
+            on_error(utils.UpstreamError(int(resp['status']), content))
+        else:
+            on_success(content)
 
+    _pool.submit(do_request, on_response, on_error, cancel_token)
 
 def generate_authorize_url(web_handler, url_callback, on_success, on_error):
     """
@@ -81,7 +114,7 @@ def generate_authorize_url(web_handler, url_callback, on_success, on_error):
                     oauth_extra_params={'oauth_callback': url_callback},
                     credentials = None,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get a request token - %s" % content))
+                    on_error = utils.with_error_prefix(on_error, "couldn't get a request token - "))
 
 def complete_authorization(web_handler, request_token, on_success, on_error):
     """
@@ -104,10 +137,10 @@ def complete_authorization(web_handler, request_token, on_success, on_error):
                     oauth_extra_params = None,
                     credentials = request_token,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get an access token %s" % content))
+                    on_error = utils.with_error_prefix(on_error, "couldn't get an access token "))
 
 
-def get_photosets(user_id, credentials, on_success, on_error):
+def get_photosets(user_id, credentials, on_success, on_error, cancel_token=None, deadline=None):
     """
     list the user's photosets
     
@@ -133,61 +166,65 @@ def get_photosets(user_id, credentials, on_success, on_error):
                     oauth_extra_params = None,
                     credentials = credentials,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get photosets: %s" % content))
+                    on_error = utils.with_error_prefix(on_error, "couldn't get photosets: "),
+                    cancel_token = cancel_token,
+                    deadline = deadline)
 
 
-def get_photos(user_id, credentials, photoset_id, on_success, on_error):
+def get_photos(user_id, credentials, photoset_id, on_success, on_error, cancel_token=None, deadline=None):
     """
     List a photoset's photos
     
     on_success is called with a list of dictionaries, each one including
-    id, name, description, and sizes a list of size dictionaries including: {size, url}
+    id, name, description, tags, updated (when the photo last changed, if the
+    provider says), and sizes a list of size dictionaries including: {size, url}
 
     on_error is called with an error message
     """
         
-    def internal_on_success(content):
-        photo_feed = simplejson.loads(content)
-
-        photos = [{'id': photo['id'],
-                   'name': photo['FileName'],
-                   'description': photo['Caption'],
-                   # combine the master and content and thumbnails
-                   'sizes': [{
-                        'size': 'master',
-                        'width': photo['Width'],
-                        'height': photo['Height'],
-                        'url': photo['OriginalURL']},
-                             {
-                        'size': 'small',
-                        'url': photo['SmallURL']},
-                             {
-                        'size': 'medium',
-                        'url': photo['MediumURL']},
-                             {
-                        'size': 'large',
-                        'url': photo['LargeURL']},
-                             {
-                        'size': 'tiny',
-                        'url': photo['TinyURL']},
-                             {
-                        'size': 'thumbnail',
-                        'url': photo['ThumbURL']},
-                             ]
-                   } for photo in photo_feed['Album']['Images']]
-
-        # navigate to the part of the feed that is needed
-        on_success(photos)
-
+    # each image is made into a photo as soon as it has been read
+    def make_photo(photo):
+        return {'id': photo['id'],
+                'name': photo['FileName'],
+                'description': photo['Caption'],
+                'updated': photo.get('LastUpdated'),
+                'tags': utils.split_tags(photo.get('Keywords')),
+                # combine the master and content and thumbnails
+                'sizes': [{
+                     'size': 'master',
+                     'width': photo['Width'],
+                     'height': photo['Height'],
+                     'url': photo['OriginalURL']},
+                          {
+                     'size': 'small',
+                     'url': photo['SmallURL']},
+                          {
+                     'size': 'medium',
+                     'url': photo['MediumURL']},
+                          {
+                     'size': 'large',
+                     'url': photo['LargeURL']},
+                          {
+                     'size': 'tiny',
+                     'url': photo['TinyURL']},
+                          {
+                     'size': 'thumbnail',
+                     'url': photo['ThumbURL']},
+                          ]
+                }
+
+    # an error comes back as a 200 without Album, which parse_items reports
     album_id, album_key = photoset_id.split("/")
-    _signed_request("GET",API_BASE, params={"method":"smugmug.images.get", "AlbumID": album_id, "AlbumKey": album_key, "Heavy" : "true"},
-                    oauth_extra_params = None,
-                    credentials = credentials,
-                    on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't get photos: %s" % content))
+    streamjson.get_items(_pool, credentials, _new_client, API_BASE, params={"method":"smugmug.images.get", "AlbumID": album_id, "AlbumKey": album_key, "Heavy" : "true"},
+                         path = ['Album', 'Images'],
+                         make_item = make_photo,
+                         on_success = on_success,
+                         on_error = utils.with_error_prefix(on_error, "couldn't get photos: "),
+                         cancel_token = cancel_token,
+                         deadline = deadline)
 
 
-def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error):
+def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error, cancel_token=None, deadline=None):
     """
     this will call on_success with a dictionary of the new image,
     including 'id' and 'url'
@@ -199,14 +236,16 @@ def store_photo(user_id, credentials, photoset_id, photo, title, description, ta
                     'url': result['Image']['URL']})
 
     _signed_request("POST",API_BASE, params= {'method': "smugmug.images.upload",
-                                              'Data': photo,
+                                              'Data': utils.photo_base64(photo),
                                               'AlbumID': photoset_id.split("/")[0],
                                               'Caption': title or '',
                                               'Keywords': tags or ''},
                     oauth_extra_params = None,
                     credentials = credentials,
                     on_success = internal_on_success,
-                    on_error = lambda content: on_error("couldn't upload image"))
+                    on_error = utils.with_error_prefix(on_error, "couldn't upload image: "),
+                    cancel_token = cancel_token,
+                    deadline = deadline)
         
 
 
@@ -0,0 +1,262 @@
+"""
+streaming parse of large JSON listings
+
+Provider feeds are mostly one big array of photo entries, of which we
+keep a few fields. ItemParser is fed the response a chunk at a time as
+it comes off the network. Outside the array it only keeps track of
+where it is; once inside, each entry is decoded (by simplejson, so at C
+speed) as soon as it is complete, handed to make_item, and dropped. At
+no point is more than one chunk and one entry held, however big the
+feed is.
+
+get_items makes the signed GET for such a feed and parses the response
+as it is read. It goes through the oauth client and kept-alive
+connection that the user's session lends out, as the providers' other
+requests do, and asks for the feed gzipped. httplib2 itself only hands
+back whole bodies, so the request is made on the client's connection
+directly.
+"""
+
+import re
+import zlib
+import socket
+import httplib
+import urllib
+import urlparse
+
+import httplib2
+import oauth2 as oauth
+import simplejson
+
+import sessions
+import utils
+
+# outside the array: the characters that matter, and the rest of a string
+_STRUCTURE = re.compile(r'["{}\[\],:]')
+_STRING_REST = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_decoder = simplejson.JSONDecoder()
+
+class ItemParser(object):
+    """
+    items of the array at path (a list of object keys from the top of the
+    document), each passed through make_item. If required is false, a
+    document without that array has no items rather than being an error.
+    """
+
+    def __init__(self, path, make_item, required=True):
+        self.path = list(path)
+        self.make_item = make_item
+        self.required = required
+        self.items = []
+        self.head = ''
+        self._buf = ''
+        self._pos = 0
+        self._keys = []             # for each open container, its key in its parent
+        self._key = None            # key of the value being read, in an object
+        self._string = None         # last string read, in case it is a key
+        self._in_array = False
+        self._found = False
+
+    def feed(self, data):
+        if len(self.head) < 512:
+            self.head += data[:512 - len(self.head)]
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        while self._pos < len(self._buf):
+            if self._in_array:
+                if not self._array_item():
+                    break
+            elif not self._structure():
+                break
+
+    def _array_item(self):
+        "read the next item, or the end of the array; False if more data is needed"
+        buf = self._buf
+        pos = _WHITESPACE.match(buf, self._pos).end()
+        if pos == len(buf):
+            self._pos = pos
+            return False
+        if buf[pos] == ',':
+            self._pos = pos + 1
+            return True
+        if buf[pos] == ']':
+            self._in_array = False
+            self._keys.pop()
+            self._pos = pos + 1
+            return True
+
+        try:
+            item, end = _decoder.raw_decode(buf, pos)
+        except ValueError:
+            # most likely cut off by the end of the chunk; try again with more
+            self._pos = pos
+            return False
+        self.items.append(self.make_item(item))
+        self._pos = end
+        return True
+
+    def _structure(self):
+        "read up to the next structural character; False if more data is needed"
+        match = _STRUCTURE.search(self._buf, self._pos)
+        if match is None:
+            self._pos = len(self._buf)
+            return False
+
+        char = match.group()
+        if char == '"':
+            rest = _STRING_REST.match(self._buf, match.end())
+            if rest is None:
+                self._pos = match.start()
+                return False
+            self._string = self._buf[match.start():rest.end()]
+            self._pos = rest.end()
+            return True
+
+        self._pos = match.end()
+        if char == ':':
+            self._key = simplejson.loads(self._string)
+        elif char == ',':
+            self._key = None
+        elif char in '{[':
+            self._keys.append(self._key)
+            self._key = None
+            if char == '[' and not self._found and self._keys[1:] == self.path:
+                self._found = self._in_array = True
+        else:
+            self._keys.pop()
+        return True
+
+    def close(self):
+        "the items; ValueError if the array wasn't there or the document was cut short"
+        if not self._found and self.required:
+            raise ValueError("no %s in response: %s" % ("/".join(self.path), self.head))
+        if self._in_array or self._keys:
+            raise ValueError("response ended early")
+        return self.items
+
+def parse_items(stream, path, make_item, required=True, cancel_token=None, chunk_size=64 * 1024):
+    """
+    read the JSON document from stream (anything with read(size)) and return
+    ItemParser(path, make_item, required)'s items; None if cancel_token is
+    cancelled first
+    """
+    parser = ItemParser(path, make_item, required)
+    while True:
+        if utils.is_cancelled(cancel_token):
+            return None
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return parser.close()
+        parser.feed(chunk)
+
+class _Decoded(object):
+    "an httplib response, read with its gzip or deflate content-encoding undone"
+
+    def __init__(self, response):
+        self.response = response
+        self.decompressor = None
+        if response.getheader('content-encoding', '') in ('gzip', 'deflate'):
+            # either header, gzip or zlib
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def read(self, size):
+        while True:
+            data = self.response.read(size)
+            if self.decompressor is None:
+                return data
+            if not data:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(data)
+            if data:
+                return data
+
+def _connection(http, scheme, authority):
+    "http's (an httplib2.Http) kept-alive connection to authority, made the way httplib2 would"
+    key = scheme + ":" + authority
+    connection = http.connections.get(key)
+    if connection is None:
+        proxy_info = http.proxy_info
+        if callable(proxy_info):
+            proxy_info = proxy_info(scheme)
+        if scheme == 'https':
+            connection = httplib2.HTTPSConnectionWithTimeout(
+                authority, timeout=http.timeout, proxy_info=proxy_info, ca_certs=http.ca_certs,
+                disable_ssl_certificate_validation=http.disable_ssl_certificate_validation)
+        else:
+            connection = httplib2.HTTPConnectionWithTimeout(authority, timeout=http.timeout, proxy_info=proxy_info)
+        http.connections[key] = connection
+    return connection
+
+def _stream(client, url, path, make_item, required, cancel_token):
+    """
+    signed GET of url with client (an oauth.Client), on its kept-alive
+    connection: (items, None), or (None, utils.UpstreamError) for an error
+    response, or None if cancelled. Blocks.
+    """
+    request = oauth.Request.from_consumer_and_token(client.consumer, token=client.token,
+                                                    http_method="GET", http_url=url)
+    request.sign_request(client.method, client.consumer, client.token)
+    scheme, authority, request_path, query, _ = urlparse.urlsplit(request.to_url())
+    connection = _connection(client, scheme, authority)
+    headers = {'accept-encoding': 'gzip, deflate'}
+
+    try:
+        try:
+            connection.request("GET", request_path + "?" + query, headers=headers)
+            response = connection.getresponse()
+        except (socket.error, httplib.HTTPException):
+            # the provider may have closed the kept-alive connection; one more go on a new one
+            connection.close()
+            connection.request("GET", request_path + "?" + query, headers=headers)
+            response = connection.getresponse()
+
+        body = _Decoded(response)
+        if response.status != 200:
+            result = None, utils.UpstreamError(response.status, ''.join(iter(lambda: body.read(64 * 1024), '')))
+        else:
+            result = parse_items(body, path, make_item, required, cancel_token)
+            if result is not None:
+                result = result, None
+    except:
+        connection.close()
+        raise
+    if result is None:
+        # cancelled with the response half read: the connection can't be used again
+        connection.close()
+    return result
+
+def get_items(pool, credentials, new_client, url, params, path, make_item, on_success, on_error,
+              required=True, cancel_token=None, deadline=None):
+    """
+    GET url?params, signed with the oauth client the credentials' session
+    lends out (or new_client(credentials)), on pool (a utils.WorkerPool),
+    and parse the JSON response as it comes in. on_success is called back
+    on the IOLoop with ItemParser(path, make_item, required)'s items;
+    on_error with a utils.UpstreamError for an error response, or the
+    exception if there was none.
+    cancel_token and deadline are as for the providers' _signed_request.
+    """
+    full_url = "%s?%s" % (url, urllib.urlencode(params))
+
+    def do_request():
+        timeout = None
+        if deadline is not None:
+            timeout = deadline.timeouts()[1]
+
+        client = sessions.borrow(credentials, 'oauth_client', lambda: new_client(credentials))
+        sessions.set_http_timeout(client, timeout)
+        result = _stream(client, full_url, path, make_item, required, cancel_token)
+        # a client that failed mid-request isn't given back
+        sessions.give_back(credentials, 'oauth_client', client, sessions.close_http)
+        return result
+
+    def on_response(result):
+        items, error = result
+        if error is not None:
+            on_error(error)
+        else:
+            on_success(items)
+
+    pool.submit(do_request, on_response, on_error, cancel_token)
@@ -0,0 +1,57 @@
+"""
+shared by the tests: puts the server's modules on the path, stands in
+config.py.sample for a missing config.py, and a hand-driven IOLoop
+
+run the tests from the top of the tree with
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import imp
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+try:
+    import config
+except ImportError:
+    config = imp.new_module('config')
+    execfile(os.path.join(ROOT, 'config.py.sample'), config.__dict__)
+    sys.modules['config'] = config
+
+# the tests make calls fail on purpose; that needn't be logged
+logging.disable(logging.CRITICAL)
+
+class FakeIOLoop(object):
+    "records callbacks and timeouts; the test runs them when it likes"
+
+    def __init__(self):
+        self.callbacks = []
+        self.timeouts = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        timeout = [deadline, callback]
+        self.timeouts.append(timeout)
+        return timeout
+
+    def remove_timeout(self, timeout):
+        if timeout in self.timeouts:
+            self.timeouts.remove(timeout)
+
+    def run_callbacks(self):
+        while self.callbacks:
+            self.callbacks.pop(0)()
+
+    def run_timeouts(self):
+        "fire every timeout set so far, whenever it was due"
+        timeouts, self.timeouts = self.timeouts, []
+        for deadline, callback in timeouts:
+            callback()
+        self.run_callbacks()
@@ -0,0 +1,78 @@
+import unittest
+
+from support import FakeIOLoop
+
+import admission
+import scheduler
+import utils
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = FakeIOLoop()
+        self.budget = admission.MemoryBudget(100, factor=2, photo_url_size=10, max_wait=5, max_waiting=2,
+                                             io_loop=self.io_loop)
+        self.admitted = []
+        self.rejected = []
+
+    def acquire(self, cost, name, cancel_token=None):
+        self.budget.acquire(cost, lambda: self.admitted.append(name),
+                            lambda error: self.rejected.append((name, error)), cancel_token)
+
+    def test_cost(self):
+        self.assertEqual(self.budget.cost(30), 60)
+        self.assertEqual(self.budget.cost(30, photo_urls=2), 100)
+
+    def test_waits_for_room_in_order(self):
+        self.acquire(60, 'a')
+        self.acquire(60, 'b')
+        self.acquire(10, 'c')
+        # c would fit, but doesn't jump the line
+        self.assertEqual(self.admitted, ['a'])
+        self.budget.release(60)
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.admitted, ['a', 'b', 'c'])
+        self.assertEqual(self.budget.in_use, 70)
+        self.assertEqual(self.io_loop.timeouts, [])
+
+    def test_too_many_waiting_is_busy(self):
+        for name in 'abcd':
+            self.acquire(60, name)
+        self.assertEqual([name for name, _ in self.rejected], ['d'])
+        self.assertTrue(isinstance(self.rejected[0][1], scheduler.Busy))
+        self.assertEqual(self.rejected[0][1].retry_after, 5)
+
+    def test_waiting_too_long_is_busy(self):
+        self.acquire(60, 'a')
+        self.acquire(60, 'b')
+        self.io_loop.run_timeouts()
+        self.assertEqual([name for name, _ in self.rejected], ['b'])
+        self.budget.release(60)
+        self.assertEqual(self.budget.in_use, 0)
+
+    def test_cancelled_waiter_is_dropped(self):
+        token = utils.CancelToken()
+        self.acquire(60, 'a')
+        self.acquire(60, 'b', token)
+        token.cancel()
+        self.assertEqual(self.io_loop.timeouts, [])
+        self.budget.release(60)
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.admitted, ['a'])
+        self.assertEqual(self.rejected, [])
+
+    def test_upload_bigger_than_the_budget_goes_alone(self):
+        self.acquire(500, 'big')
+        self.assertEqual(self.admitted, ['big'])
+        self.acquire(10, 'small')
+        self.acquire(500, 'big again')
+        self.budget.release(500)
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.admitted, ['big', 'small'])
+        self.budget.release(10)
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.admitted, ['big', 'small', 'big again'])
+        self.assertEqual(self.budget.peak, 500)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import base64
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import unittest
+
+import support
+
+import dedup
+import utils
+
+class DedupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dedup.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_repeat_upload_is_found(self):
+        index = dedup.DedupIndex(self.path)
+        self.assertEqual(index.lookup('flickr', 'u', 'f', 'set', 'abc'), None)
+        index.record('flickr', 'u', 'f', 'set', 'abc', {'id': 'p1'})
+        self.assertEqual(index.lookup('flickr', 'u', 'f', 'set', 'abc'), {'id': 'p1'})
+        self.assertEqual(index.stats['hits'], 1)
+
+    def test_users_with_the_same_id_are_kept_apart(self):
+        index = dedup.DedupIndex(self.path)
+        index.record('smugmug', 'u', 'f1', 'set', 'abc', {'id': 'p1'})
+        self.assertEqual(index.lookup('smugmug', 'u', 'f2', 'set', 'abc'), None)
+        self.assertEqual(index.lookup('smugmug', 'u', 'f1', 'other', 'abc'), None)
+
+    def test_least_recently_used_go_first(self):
+        index = dedup.DedupIndex(self.path, max_entries=2)
+        index.record('flickr', 'u', 'f', 'set', 'a', 1)
+        index.record('flickr', 'u', 'f', 'set', 'b', 2)
+        index.db.execute("update uploads set last_used = 0 where sha1 = 'b'")
+        index.record('flickr', 'u', 'f', 'set', 'c', 3)
+        self.assertEqual(index.size(), 2)
+        self.assertEqual(index.lookup('flickr', 'u', 'f', 'set', 'b'), None)
+        self.assertEqual(index.lookup('flickr', 'u', 'f', 'set', 'a'), 1)
+
+    def test_index_without_fingerprints_is_dropped(self):
+        db = sqlite3.connect(self.path)
+        db.execute("create table uploads (provider, user_id, photoset_id, sha1, result, last_used)")
+        db.execute("insert into uploads values ('flickr', 'u', 'set', 'a', '1', 0)")
+        db.commit()
+        db.close()
+        index = dedup.DedupIndex(self.path)
+        self.assertEqual(index.size(), 0)
+        index.record('flickr', 'u', 'f', 'set', 'a', 1)
+        self.assertEqual(index.lookup('flickr', 'u', 'f', 'set', 'a'), 1)
+
+class PhotoSha1Test(unittest.TestCase):
+
+    def test_base64_in_blocks(self):
+        photo = os.urandom(200 * 1024 + 7)
+        encoded = base64.encodestring(photo)
+        # line breaks put the block edges in the middle of 4-character groups
+        self.assertTrue(len(encoded) > 64 * 1024)
+        self.assertEqual(utils.photo_sha1(encoded), hashlib.sha1(photo).hexdigest())
+        self.assertEqual(utils.photo_sha1(base64.b64encode(photo)), hashlib.sha1(photo).hexdigest())
+
+    def test_spooled(self):
+        f = tempfile.NamedTemporaryFile()
+        f.write('photo')
+        f.flush()
+        self.assertEqual(utils.photo_sha1(utils.SpooledPhoto(f.name)), hashlib.sha1('photo').hexdigest())
+        self.assertEqual(utils.photo_sha1(utils.SpooledPhoto(f.name, sha1='known')), 'known')
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
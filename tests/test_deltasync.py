@@ -0,0 +1,78 @@
+import time
+import unittest
+
+import support
+
+import deltasync
+
+def photo(photo_id, name='', updated=None):
+    result = {'id': photo_id, 'name': name}
+    if updated is not None:
+        result['updated'] = updated
+    return result
+
+class SnapshotsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshots = deltasync.Snapshots(':memory:')
+
+    def delta(self, photos, since=None):
+        return self.snapshots.delta('flickr', 'user', 'set', photos, since)
+
+    def test_first_listing_is_whole(self):
+        result = self.delta([photo(1), photo(2)])
+        self.assertEqual([p['id'] for p in result['added']], [1, 2])
+        self.assertFalse(result['reset'])
+        self.assertEqual(self.snapshots.stats['full'], 1)
+
+    def test_changes_since_a_cursor(self):
+        cursor = self.delta([photo(1), photo(2, 'old'), photo(3)])['cursor']
+        result = self.delta([photo(1), photo(2, 'new'), photo(4)], cursor)
+        self.assertEqual([p['id'] for p in result['added']], [4])
+        self.assertEqual([p['id'] for p in result['changed']], [2])
+        self.assertEqual(result['removed'], ['3'])
+        self.assertNotEqual(result['cursor'], cursor)
+
+    def test_unchanged_photoset_keeps_its_cursor(self):
+        cursor = self.delta([photo(1)])['cursor']
+        result = self.delta([photo(1)], cursor)
+        self.assertEqual(result['cursor'], cursor)
+        self.assertEqual((result['added'], result['changed'], result['removed']), ([], [], []))
+
+    def test_provider_stamp_is_the_fingerprint(self):
+        cursor = self.delta([photo(1, 'a', updated='10')])['cursor']
+        # same stamp: whatever else differs, it hasn't changed
+        self.assertEqual(self.delta([photo(1, 'b', updated='10')], cursor)['changed'], [])
+        self.assertEqual(len(self.delta([photo(1, 'b', updated='11')], cursor)['changed']), 1)
+
+    def test_photo_added_and_removed_since_the_cursor_is_not_reported(self):
+        cursor = self.delta([photo(1)])['cursor']
+        self.delta([photo(1), photo(2)])
+        result = self.delta([photo(1)], cursor)
+        self.assertEqual(result['removed'], [])
+        self.assertEqual(result['added'], [])
+
+    def test_readded_photo_is_added(self):
+        self.delta([photo(1), photo(2)])
+        cursor = self.delta([photo(1)])['cursor']
+        result = self.delta([photo(1), photo(2)], cursor)
+        self.assertEqual([p['id'] for p in result['added']], [2])
+
+    def test_unusable_cursor_resets(self):
+        cursor = self.delta([photo(1)])['cursor']
+        generation, version = cursor.split('-')
+        for since in ['nonsense', 'other-1', '%s-x' % generation, '%s-99' % generation]:
+            result = self.delta([photo(1)], since)
+            self.assertTrue(result['reset'], since)
+            self.assertEqual(len(result['added']), 1)
+
+    def test_cursor_from_before_forgotten_removals_resets(self):
+        snapshots = deltasync.Snapshots(':memory:', tombstone_age=0)
+        cursor = snapshots.delta('flickr', 'user', 'set', [photo(1), photo(2)], None)['cursor']
+        snapshots.delta('flickr', 'user', 'set', [photo(1)], None)
+        time.sleep(0.01)
+        result = snapshots.delta('flickr', 'user', 'set', [photo(1)], cursor)
+        self.assertTrue(result['reset'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import support
+
+import dispatch
+
+WORKERS = ['http://127.0.0.1:%d' % port for port in range(8411, 8415)]
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = dispatch.HashRing(WORKERS)
+        self.keys = ['user%d' % i for i in range(1000)]
+
+    def test_keys_spread_over_workers(self):
+        owners = [self.ring.lookup(key) for key in self.keys]
+        for worker in WORKERS:
+            self.assertTrue(owners.count(worker) > 100, worker)
+
+    def test_removing_a_worker_only_moves_its_keys(self):
+        before = dict((key, self.ring.lookup(key)) for key in self.keys)
+        self.ring.remove(WORKERS[0])
+        for key in self.keys:
+            if before[key] != WORKERS[0]:
+                self.assertEqual(self.ring.lookup(key), before[key])
+            else:
+                self.assertNotEqual(self.ring.lookup(key), WORKERS[0])
+
+        self.ring.add(WORKERS[0])
+        self.assertEqual(dict((key, self.ring.lookup(key)) for key in self.keys), before)
+
+    def test_unicode_key(self):
+        self.assertEqual(self.ring.lookup(u'\xe9t\xe9'), self.ring.lookup(u'\xe9t\xe9'.encode('utf-8')))
+
+    def test_acquire_spills_over_a_loaded_worker(self):
+        owner = self.ring.lookup('user')
+        acquired = [self.ring.acquire('user') for i in range(4)]
+        # with the others idle, the owner may only take its share
+        self.assertEqual(acquired[0], owner)
+        self.assertTrue(acquired.count(owner) < 4)
+        self.assertEqual(sum(self.ring.load.values()), 4)
+        self.assertTrue(self.ring.stats['spilled'] > 0)
+
+        for worker in acquired:
+            self.ring.release(worker)
+        self.assertEqual(sum(self.ring.load.values()), 0)
+
+    def test_acquire_excludes(self):
+        self.assertNotEqual(self.ring.acquire('user', exclude=[self.ring.lookup('user')]), self.ring.lookup('user'))
+        self.assertEqual(self.ring.acquire('user', exclude=WORKERS), None)
+        self.assertEqual(dispatch.HashRing().acquire('user'), None)
+
+    def test_release_after_removal(self):
+        worker = self.ring.acquire('user')
+        self.ring.remove(worker)
+        self.ring.release(worker)
+        self.assertFalse(worker in self.ring.load)
+
+if __name__ == '__main__':
+    unittest.main()
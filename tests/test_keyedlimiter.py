@@ -0,0 +1,69 @@
+import unittest
+
+from support import FakeIOLoop
+
+import utils
+
+class KeyedLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = FakeIOLoop()
+        self.limiter = utils.KeyedLimiter(2, io_loop=self.io_loop)
+        self.got = []
+
+    def acquire(self, key, name, cancel_token=None):
+        self.limiter.acquire(key, lambda: self.got.append(name), cancel_token)
+
+    def test_limit_is_per_key(self):
+        for name in 'abc':
+            self.acquire('user', name)
+        self.acquire('other', 'd')
+        self.assertEqual(self.got, ['a', 'b', 'd'])
+        self.assertEqual(self.limiter.active('user'), 2)
+
+    def test_release_hands_the_slot_over_in_order(self):
+        for name in 'abcd':
+            self.acquire('user', name)
+        self.limiter.release('user')
+        # on the IOLoop, not inside release
+        self.assertEqual(self.got, ['a', 'b'])
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.got, ['a', 'b', 'c'])
+        self.assertEqual(self.limiter.active('user'), 2)
+
+        for i in range(3):
+            self.limiter.release('user')
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.got, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.limiter.active('user'), 0)
+
+    def test_cancelled_waiter_is_skipped(self):
+        token = utils.CancelToken()
+        self.acquire('user', 'a')
+        self.acquire('user', 'b')
+        self.acquire('user', 'c', token)
+        self.acquire('user', 'd')
+        token.cancel()
+        self.limiter.release('user')
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.got, ['a', 'b', 'd'])
+
+    def test_slot_on_its_way_to_a_cancelled_waiter_is_passed_on(self):
+        token = utils.CancelToken()
+        self.acquire('user', 'a')
+        self.acquire('user', 'b')
+        self.acquire('user', 'c', token)
+        self.acquire('user', 'd')
+        self.limiter.release('user')
+        token.cancel()
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.got, ['a', 'b', 'd'])
+        self.assertEqual(self.limiter.active('user'), 2)
+
+        self.limiter.release('user')
+        self.limiter.release('user')
+        self.io_loop.run_callbacks()
+        self.assertEqual(self.limiter.active('user'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
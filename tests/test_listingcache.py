@@ -0,0 +1,147 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import support
+
+import listingcache
+
+class MemoryCacheTest(unittest.TestCase):
+
+    def backend(self):
+        return listingcache.MemoryBackend(max_entries=2)
+
+    def setUp(self):
+        self.cache = listingcache.ListingCache(ttl=60, stale_ttl=3600, backend=self.backend())
+
+    def age(self, key, seconds):
+        "make key's listing seconds older"
+        stored, prefetched, value, expires = self.cache.backend._entries[key]
+        self.cache.backend._entries[key] = (stored - seconds, prefetched, value, expires - seconds)
+
+    def test_fresh_and_stale(self):
+        self.cache.set(('photos', 'a'), [1, 2])
+        self.assertEqual(self.cache.fresh(('photos', 'a')), [1, 2])
+        self.assertTrue(self.cache.contains_fresh(('photos', 'a')))
+
+        self.age(('photos', 'a'), 120)
+        self.assertEqual(self.cache.fresh(('photos', 'a')), None)
+        self.assertFalse(self.cache.contains_fresh(('photos', 'a')))
+        self.assertEqual(self.cache.get(('photos', 'a')), [1, 2])
+        self.assertEqual(self.cache.stats['stale_hits'], 1)
+
+        self.age(('photos', 'a'), 3600)
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+
+    def test_prefetch_used(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.assertTrue(self.cache.contains_fresh(('photos', 'a')))
+        self.assertEqual(self.cache.stats['prefetch_used'], 0)
+        self.cache.fresh(('photos', 'a'))
+        self.cache.fresh(('photos', 'a'))
+        self.assertEqual(self.cache.stats['prefetch_used'], 1)
+        self.cache.set(('photos', 'a'), [2])
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 0)
+
+    def test_prefetch_wasted_when_replaced_or_expired(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.cache.set(('photos', 'a'), [2], prefetched=True)
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 1)
+
+        self.age(('photos', 'a'), 4000)
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 2)
+
+    def test_prefetch_wasted_when_replaced_or_expired(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.cache.set(('photos', 'a'), [2], prefetched=True)
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 1)
+
+        self.age(('photos', 'a'), 4000)
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+        # expired listings are dropped by the next write
+        self.cache.set(('photos', 'b'), [3])
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 2)
+
+    def test_delete(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.cache.set(('photos', 'b'), [2])
+        self.cache.delete(('photos', 'a'))
+        self.cache.delete(('photos', 'none'))
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+        self.assertEqual(self.cache.get(('photos', 'b')), [2])
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 1)
+
+    def test_least_recently_used_go_first(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.cache.set(('photos', 'b'), [2])
+        self.cache.set(('photos', 'c'), [3])
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+        self.assertEqual(self.cache.get(('photos', 'c')), [3])
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 1)
+
+class SQLiteCacheTest(MemoryCacheTest):
+
+    def backend(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'listings.db')
+        # each listing here compresses to about 10 bytes
+        return listingcache.SQLiteBackend(self.path, max_bytes=25)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def age(self, key, seconds):
+        self.cache.backend.db.execute("update listings set stored = stored - ?, expires = expires - ? "
+                                      "where key = ?", (seconds, seconds, self.cache.backend._key(key)))
+        self.cache.backend.db.commit()
+
+    def test_prefetch_wasted_when_replaced_or_expired(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.cache.set(('photos', 'a'), [2], prefetched=True)
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 1)
+
+        self.age(('photos', 'a'), 4000)
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+        # expired listings are dropped by the next write
+        self.cache.set(('photos', 'b'), [3])
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 2)
+
+    def test_least_recently_used_go_first(self):
+        self.cache.set(('photos', 'a'), [1], prefetched=True)
+        self.cache.set(('photos', 'b'), [2])
+        self.cache.backend.db.execute("update listings set last_used = 0 where key = ?",
+                                      (self.cache.backend._key(('photos', 'a')),))
+        self.cache.set(('photos', 'c'), [3])
+        self.assertEqual(self.cache.get(('photos', 'a')), None)
+        self.assertEqual(self.cache.get(('photos', 'c')), [3])
+        self.assertEqual(self.cache.stats['prefetch_wasted'], 1)
+
+    def test_shared_between_processes(self):
+        other = listingcache.SQLiteBackend(self.path)
+        self.cache.set(('photos', 'a'), [1])
+        self.assertEqual(other.get(('photos', 'a'))[2], [1])
+        other.set(('photos', 'b'), time.time(), False, [2], time.time() + 60)
+        self.assertEqual(self.cache.get(('photos', 'b')), [2])
+        total = self.cache.backend.db.execute("select sum(size) from listings").fetchone()[0]
+        self.assertEqual(self.cache.backend.db.execute("select bytes from listings_size").fetchone()[0], total)
+
+    def test_listing_is_not_cached_while_another_process_writes(self):
+        self.cache.set(('photos', 'a'), [1])
+        other = sqlite3.connect(self.path)
+        other.execute("begin immediate")
+        try:
+            started = time.time()
+            self.cache.set(('photos', 'b'), [2])
+            self.assertTrue(time.time() - started < 1)
+            # readers aren't held up by a writer
+            self.assertEqual(self.cache.get(('photos', 'a')), [1])
+        finally:
+            other.rollback()
+        self.assertEqual(self.cache.get(('photos', 'b')), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from support import FakeIOLoop
+
+import prefetch
+import upstream
+
+CREDENTIALS = {'oauth_token': 'token', 'oauth_token_secret': 'secret'}
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prefetcher = prefetch.Prefetcher(top_n=2, per_user=3, window=60, max_in_flight=2,
+                                              io_loop=FakeIOLoop())
+        self.fetched = []
+        self.fresh = set()
+        self.get_photos = upstream.get_photos
+        self.has_fresh_photos = upstream.has_fresh_photos
+        upstream.get_photos = self.fake_get_photos
+        upstream.has_fresh_photos = lambda user_id, credentials, photoset_id: photoset_id in self.fresh
+
+    def tearDown(self):
+        upstream.get_photos = self.get_photos
+        upstream.has_fresh_photos = self.has_fresh_photos
+
+    def fake_get_photos(self, user_id, credentials, photoset_id, on_success, on_error, deadline=None,
+                        prefetch=False):
+        self.assertTrue(prefetch)
+        self.fetched.append((photoset_id, on_success, on_error))
+
+    def listed(self, *photosets):
+        self.prefetcher.photosets_listed('user', CREDENTIALS, list(photosets))
+
+    def test_first_non_empty_photosets(self):
+        self.listed({'id': 'empty', 'num_photos': 0}, {'id': 'a', 'num_photos': 5}, {'id': 'b'}, {'id': 'c'})
+        self.assertEqual([photoset_id for photoset_id, _, _ in self.fetched], ['a', 'b'])
+
+    def test_cached_photosets_are_skipped(self):
+        self.fresh.add('a')
+        self.listed({'id': 'a'}, {'id': 'b'})
+        self.assertEqual([photoset_id for photoset_id, _, _ in self.fetched], ['b'])
+        self.assertEqual(self.prefetcher.stats['cached'], 1)
+
+    def test_in_flight_limit(self):
+        self.listed({'id': 'a'}, {'id': 'b'})
+        self.listed({'id': 'c'})
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(self.prefetcher.stats['over_budget'], 1)
+
+        self.fetched[0][1]([])
+        self.fetched[1][2]('failed')
+        self.assertEqual(self.prefetcher.in_flight, 0)
+        self.assertEqual(self.prefetcher.stats['failed'], 1)
+        self.listed({'id': 'c'})
+        self.assertEqual(len(self.fetched), 3)
+
+    def test_per_user_limit(self):
+        for photoset_id in 'abcd':
+            self.listed({'id': photoset_id})
+            self.fetched[-1][1]([])
+        self.assertEqual(len(self.fetched), 3)
+        # a different user has their own budget
+        self.prefetcher.photosets_listed('other', CREDENTIALS, [{'id': 'a'}])
+        self.assertEqual(len(self.fetched), 4)
+
+if __name__ == '__main__':
+    unittest.main()
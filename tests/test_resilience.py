@@ -0,0 +1,152 @@
+import unittest
+
+from support import FakeIOLoop
+
+import resilience
+import scheduler
+import utils
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_on_errors_and_closes_after_a_good_trial(self):
+        breaker = resilience.CircuitBreaker('test', window=4, min_calls=4, error_rate=0.5, cooldown=0)
+        for ok in [True, False, True]:
+            breaker.record(ok)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # one trial call at a time once the cooldown is over
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_calls_that_never_reached_the_provider_dont_count(self):
+        breaker = resilience.CircuitBreaker('test', window=4, min_calls=2, cooldown=60)
+        breaker.record(None)
+        breaker.record(None)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(False)
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.retry_after() > 1)
+
+class LatencyTrackerTest(unittest.TestCase):
+
+    def test_percentile(self):
+        tracker = resilience.LatencyTracker(min_samples=10)
+        for i in range(9):
+            tracker.add(i)
+        self.assertEqual(tracker.percentile(95), None)
+        for i in range(9, 100):
+            tracker.add(i)
+        self.assertEqual(tracker.percentile(95), 95)
+
+class ResilientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = FakeIOLoop()
+        self.resilient = resilience.Resilient('test', attempts=3, base_delay=0, io_loop=self.io_loop,
+                                              breaker={'min_calls': 100})
+        self.calls = []
+        self.results = []
+
+    def fn(self, on_success, on_error, cancel_token, deadline):
+        self.calls.append((on_success, on_error))
+
+    def call(self, **kwargs):
+        self.resilient.call('get_photos', self.fn, lambda result: self.results.append(result),
+                            lambda error: self.results.append(('error', error)), **kwargs)
+
+    def test_retries_then_gives_up(self):
+        self.call()
+        self.calls[0][1](utils.UpstreamError(503, 'unavailable'))
+        self.io_loop.run_timeouts()
+        self.calls[1][1](IOError('connection reset'))
+        self.io_loop.run_timeouts()
+        self.assertEqual(self.results, [])
+        error = utils.UpstreamError(500, 'failed again')
+        self.calls[2][1](error)
+        self.assertEqual(self.results, [('error', error)])
+        self.assertEqual(self.resilient.stats['retries'], 2)
+
+    def test_retry_succeeds(self):
+        self.call()
+        self.calls[0][1](utils.UpstreamError(599, 'no answer'))
+        self.io_loop.run_timeouts()
+        self.calls[1][0]('listing')
+        self.assertEqual(self.results, ['listing'])
+
+    def test_what_a_retry_wouldnt_help_is_passed_on(self):
+        errors = [scheduler.Busy('busy', 1), utils.DeadlineExceeded('timed out'),
+                  utils.UpstreamError(401, 'token revoked'), utils.UpstreamError(404, 'no such album'),
+                  "couldn't get photos"]
+        for error in errors:
+            self.call()
+            self.calls[-1][1](error)
+            self.assertEqual(self.results[-1], ('error', error))
+        self.assertEqual(self.io_loop.timeouts, [])
+
+    def test_client_errors_dont_open_the_circuit(self):
+        self.resilient.breaker = resilience.CircuitBreaker('test', min_calls=2)
+        for i in range(5):
+            self.call()
+            self.calls[-1][1](utils.UpstreamError(401, 'token revoked'))
+        self.assertEqual(self.resilient.breaker.state, resilience.CircuitBreaker.CLOSED)
+
+        self.resilient.attempts = 1
+        for i in range(2):
+            self.call()
+            self.calls[-1][1](utils.UpstreamError(502, 'bad gateway'))
+        self.assertEqual(self.resilient.breaker.state, resilience.CircuitBreaker.OPEN)
+
+    def test_no_retry_once_cancelled(self):
+        token = utils.CancelToken()
+        self.call(cancel_token=token)
+        self.calls[0][1](utils.UpstreamError(503, 'unavailable'))
+        token.cancel()
+        self.io_loop.run_timeouts()
+        self.assertEqual(len(self.calls), 1)
+
+    def test_open_circuit_serves_stale_or_fails_fast(self):
+        self.resilient.breaker._open()
+        self.resilient.breaker.cooldown = 60
+        self.call(fallback=lambda: 'stale listing')
+        self.call()
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.results[0], 'stale listing')
+        self.assertTrue(isinstance(self.results[1][1], resilience.CircuitOpen))
+
+    def test_hedge_after_the_p95(self):
+        self.resilient.hedge = True
+        for i in range(20):
+            self.resilient.latency.setdefault('get_photos', resilience.LatencyTracker()).add(0.1)
+        self.call()
+        self.assertEqual(len(self.io_loop.timeouts), 1)
+        self.io_loop.run_timeouts()
+        self.assertEqual(len(self.calls), 2)
+
+        # the hedge answers first; the original's late answer is dropped
+        self.calls[1][0]('hedged')
+        self.calls[0][0]('original')
+        self.assertEqual(self.results, ['hedged'])
+        self.assertEqual(self.resilient.stats['hedge_wins'], 1)
+
+    def test_one_failed_leg_waits_for_the_other(self):
+        self.resilient.hedge = True
+        for i in range(20):
+            self.resilient.latency.setdefault('get_photos', resilience.LatencyTracker()).add(0.1)
+        self.resilient.attempts = 1
+        self.call()
+        self.io_loop.run_timeouts()
+        self.calls[0][1](utils.UpstreamError(503, 'unavailable'))
+        self.assertEqual(self.results, [])
+        self.calls[1][0]('listing')
+        self.assertEqual(self.results, ['listing'])
+
+if __name__ == '__main__':
+    unittest.main()
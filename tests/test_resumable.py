@@ -0,0 +1,74 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import support
+
+import resumable
+
+CREDENTIALS = {'oauth_token': 'token', 'oauth_token_secret': 'secret'}
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+class UploadSessionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sessions = resumable.UploadSessions(self.dir)
+        self.upload_id = self.sessions.create('user', CREDENTIALS)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, offset, data, checksum=None):
+        return self.sessions.write(self.upload_id, 'user', CREDENTIALS, offset, data, checksum or sha1(data))
+
+    def test_chunks_make_up_the_photo(self):
+        self.assertEqual(self.write(0, 'pho'), 3)
+        self.assertEqual(self.write(3, 'to'), 5)
+        self.assertEqual(self.sessions.offset(self.upload_id, 'user', CREDENTIALS), 5)
+        photo = self.sessions.finish(self.upload_id, 'user', CREDENTIALS, sha1('photo').upper())
+        self.assertEqual(open(photo.path, 'rb').read(), 'photo')
+        self.assertEqual(photo.sha1, sha1('photo'))
+
+    def test_resent_chunk_replaces_what_followed(self):
+        self.write(0, 'pho')
+        self.write(3, 'XX')
+        self.assertEqual(self.write(3, 'to'), 5)
+        self.assertEqual(self.write(0, 'ph'), 2)
+        self.assertEqual(self.sessions.offset(self.upload_id, 'user', CREDENTIALS), 2)
+
+    def test_bad_chunks(self):
+        self.assertRaises(resumable.BadChunk, self.write, 0, 'photo', sha1('other'))
+        self.assertRaises(resumable.BadChunk, self.write, 1, 'photo')
+        self.assertRaises(resumable.BadChunk, self.write, -1, 'photo')
+        self.assertRaises(resumable.BadChunk, self.sessions.finish, self.upload_id, 'user', CREDENTIALS,
+                          sha1(''))
+        self.write(0, 'photo')
+        self.assertRaises(resumable.BadChunk, self.sessions.finish, self.upload_id, 'user', CREDENTIALS,
+                          sha1('other'))
+
+    def test_only_the_owner_sees_a_session(self):
+        for upload_id, user_id, credentials in [
+                (self.upload_id, 'other', CREDENTIALS),
+                (self.upload_id, 'user', {'oauth_token': 'other'}),
+                ('0' * 32, 'user', CREDENTIALS),
+                ('../' + self.upload_id, 'user', CREDENTIALS)]:
+            self.assertRaises(resumable.UploadNotFound, self.sessions.offset, upload_id, user_id, credentials)
+
+    def test_abandoned_sessions_expire(self):
+        old = time.time() - 2 * 24 * 3600
+        os.utime(os.path.join(self.dir, 'sessions', self.upload_id), (old, old))
+        kept = self.sessions.create('user', CREDENTIALS)
+        self.assertRaises(resumable.UploadNotFound, self.sessions.offset, self.upload_id, 'user', CREDENTIALS)
+        self.assertEqual(self.sessions.offset(kept, 'user', CREDENTIALS), 0)
+
+        self.sessions.discard(kept)
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'sessions')), [])
+
+if __name__ == '__main__':
+    unittest.main()
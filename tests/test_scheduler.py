@@ -0,0 +1,99 @@
+import time
+import unittest
+
+from support import FakeIOLoop
+
+import scheduler
+import utils
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = FakeIOLoop()
+        # one token to start with, and (as far as a test can tell) no more after it
+        self.scheduler = scheduler.Scheduler('test', rate=0.001, burst=1, io_loop=self.io_loop,
+                                             queues={scheduler.BULK: (2, 60)})
+        self.ran = []
+        self.rejected = []
+
+    def submit(self, priority, name, cancel_token=None, deadline=None):
+        self.scheduler.submit(priority, lambda: self.ran.append(name),
+                              lambda error: self.rejected.append((name, error)),
+                              cancel_token, deadline)
+
+    def grant(self, tokens=1):
+        self.scheduler.bucket.burst = self.scheduler.bucket.tokens = tokens
+        self.scheduler._drain()
+
+    def test_runs_at_once_while_there_are_tokens(self):
+        self.submit(scheduler.INTERACTIVE, 'a')
+        self.submit(scheduler.INTERACTIVE, 'b')
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual(self.scheduler.queue_length(scheduler.INTERACTIVE), 1)
+        self.assertTrue(self.io_loop.timeouts)
+
+    def test_higher_priority_goes_first(self):
+        self.submit(scheduler.INTERACTIVE, 'first')
+        self.submit(scheduler.PREFETCH, 'prefetch')
+        self.submit(scheduler.BULK, 'bulk')
+        self.submit(scheduler.INTERACTIVE, 'interactive')
+        self.grant(3)
+        self.assertEqual(self.ran, ['first', 'interactive', 'bulk', 'prefetch'])
+
+    def test_waits_behind_queued_calls_of_its_priority(self):
+        self.submit(scheduler.BULK, 'a')
+        self.submit(scheduler.BULK, 'b')
+        self.scheduler.bucket.tokens = 1
+        # b is queued, so c doesn't get to jump it with the new token
+        self.submit(scheduler.BULK, 'c')
+        self.assertEqual(self.ran, ['a'])
+        self.grant(2)
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+    def test_full_queue_is_busy(self):
+        for name in 'abcd':
+            self.submit(scheduler.BULK, name)
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual([name for name, _ in self.rejected], ['d'])
+        error = self.rejected[0][1]
+        self.assertTrue(isinstance(error, scheduler.Busy))
+        self.assertTrue(error.retry_after >= 1)
+
+    def test_waiting_too_long_is_busy(self):
+        self.scheduler.limits[scheduler.INTERACTIVE] = (10, 0)
+        self.submit(scheduler.INTERACTIVE, 'a')
+        self.submit(scheduler.INTERACTIVE, 'b')
+        self.scheduler._drain()
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual(len(self.rejected), 1)
+        self.assertTrue(isinstance(self.rejected[0][1], scheduler.Busy))
+        self.assertEqual(self.scheduler.stats[scheduler.INTERACTIVE]['expired'], 1)
+
+    def test_deadline_cuts_the_wait_short(self):
+        self.submit(scheduler.INTERACTIVE, 'a')
+        self.submit(scheduler.INTERACTIVE, 'b', deadline=utils.Deadline(0))
+        self.assertTrue(isinstance(self.rejected[0][1], utils.DeadlineExceeded))
+
+        self.submit(scheduler.INTERACTIVE, 'c', deadline=utils.Deadline(0.01))
+        time.sleep(0.02)
+        self.scheduler._drain()
+        self.assertEqual([name for name, _ in self.rejected], ['b', 'c'])
+        self.assertTrue(isinstance(self.rejected[1][1], utils.DeadlineExceeded))
+
+    def test_cancelled_call_is_dropped_without_a_token(self):
+        self.submit(scheduler.INTERACTIVE, 'a')
+        token = utils.CancelToken()
+        self.submit(scheduler.INTERACTIVE, 'b', cancel_token=token)
+        self.submit(scheduler.INTERACTIVE, 'c')
+        token.cancel()
+        self.grant(1)
+        self.assertEqual(self.ran, ['a', 'c'])
+        self.assertEqual(self.rejected, [])
+        self.assertEqual(self.scheduler.stats[scheduler.INTERACTIVE]['cancelled'], 1)
+
+        self.submit(scheduler.INTERACTIVE, 'd', cancel_token=token)
+        self.grant(1)
+        self.assertEqual(self.ran, ['a', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
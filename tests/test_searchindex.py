@@ -0,0 +1,73 @@
+import unittest
+
+import support
+
+import searchindex
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = searchindex.SearchIndex()
+        self.index.add_photosets('user', [{'id': 's1', 'name': 'Holiday in Rome'}, {'id': 's2', 'name': 'Work'}])
+        pasta = {'id': 2, 'name': 'Pasta', 'description': 'dinner, New-York style'}
+        self.index.add_photos('user', 's1', [{'id': 1, 'name': 'Colosseum at night', 'tags': ['ruins']}, pasta])
+        self.index.add_photos('user', 's2', [pasta, {'id': 3, 'name': 'Desk'}])
+
+    def ids(self, query, **kwargs):
+        return [photo['id'] for photo in self.index.search('user', query, **kwargs)]
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.ids('colosseum'), [1])
+        self.assertEqual(self.ids('NIGHT ruins'), [1])
+        self.assertEqual(self.ids('night desk'), [])
+        self.assertEqual(self.ids('nothing'), [])
+
+    def test_photoset_names_are_searched(self):
+        self.assertEqual(self.ids('rome'), [1, 2])
+        self.assertEqual(self.ids('work'), [2, 3])
+
+    def test_prefix(self):
+        self.assertEqual(self.ids('col*'), [1])
+        self.assertEqual(self.ids('col'), [])
+        self.assertEqual(self.ids('new-yo*'), [2])
+
+    def test_photoset_filter_limit_and_memberships(self):
+        results = self.index.search('user', 'pasta')
+        self.assertEqual(results[0]['photoset_ids'], ['s1', 's2'])
+        self.assertEqual(self.ids('rome', photoset_id='s2'), [2])
+        self.assertEqual(self.ids('rome', limit=1), [1])
+
+    def test_relisting_replaces_the_photoset(self):
+        self.index.add_photos('user', 's1', [{'id': 1, 'name': 'Forum'}])
+        self.assertEqual(self.ids('colosseum'), [])
+        self.assertEqual(self.ids('forum'), [1])
+        # still in s2
+        self.assertEqual(self.ids('pasta'), [2])
+        self.assertEqual(self.ids('rome'), [1])
+        self.index.add_photos('user', 's2', [])
+        self.assertEqual(self.ids('pasta'), [])
+        self.assertEqual(self.index.size()['photos'], 1)
+
+    def test_renamed_photoset(self):
+        self.index.add_photosets('user', [{'id': 's1', 'name': 'Italy'}])
+        self.assertEqual(self.ids('rome'), [])
+        self.assertEqual(self.ids('italy'), [1, 2])
+
+    def test_users_are_apart_and_evicted_least_recently_used(self):
+        index = searchindex.SearchIndex(max_users=2)
+        for user in ['a', 'b']:
+            index.add_photos(user, 's', [{'id': 1, 'name': user}])
+        self.assertEqual(index.search('a', 'b'), [])
+        index.search('a', 'a')
+        index.add_photos('c', 's', [{'id': 1, 'name': 'c'}])
+        self.assertEqual(index.search('b', 'b'), [])
+        self.assertEqual(len(index.search('a', 'a')), 1)
+        self.assertEqual(index.stats['evicted_users'], 1)
+
+        index = searchindex.SearchIndex(max_photos=2)
+        index.add_photos('a', 's', [{'id': 1}, {'id': 2}])
+        index.add_photos('b', 's', [{'id': 1}])
+        self.assertEqual(index.size(), {'users': 1, 'photos': 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+import support
+
+import simplejson
+
+import sessions
+import upstream
+
+def credentials_json(token):
+    return simplejson.dumps({'oauth_token': token, 'oauth_token_secret': 'secret'})
+
+class Closable(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class SessionRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = sessions.SessionRegistry(upstream.credentials_fingerprint, max_sessions=2, max_idle=3)
+
+    def test_same_credentials_same_session(self):
+        session = self.registry.get('user', credentials_json('a'))
+        self.assertTrue(self.registry.get('user', credentials_json('a')) is session)
+        self.assertFalse(self.registry.get('user', credentials_json('b')) is session)
+        self.assertEqual(session.credentials['oauth_token'], 'a')
+        self.assertTrue(session.credentials.session is session)
+        # the same fingerprint whether the credentials come from a session or not
+        self.assertEqual(session.credentials.fingerprint,
+                         upstream.credentials_fingerprint(simplejson.loads(credentials_json('a'))))
+
+    def test_bad_json(self):
+        self.assertRaises(ValueError, self.registry.get, 'user', '{')
+
+    def test_borrow_gives_back_what_was_given_back(self):
+        credentials = self.registry.get('user', credentials_json('a')).credentials
+        client = sessions.borrow(credentials, 'client', Closable)
+        sessions.give_back(credentials, 'client', client, Closable.close)
+        self.assertTrue(sessions.borrow(credentials, 'client', Closable) is client)
+        self.assertFalse(client.closed)
+
+        # without a session, everything is made afresh and closed
+        client = sessions.borrow({}, 'client', Closable)
+        sessions.give_back({}, 'client', client, Closable.close)
+        self.assertTrue(client.closed)
+
+    def test_idle_objects_are_capped_overall(self):
+        clients = []
+        for token in 'ab':
+            credentials = self.registry.get('user', credentials_json(token)).credentials
+            for i in range(2):
+                clients.append(Closable())
+            for client in clients[-2:]:
+                sessions.give_back(credentials, 'client', client, Closable.close)
+        self.assertEqual([client.closed for client in clients], [False, False, False, True])
+        self.assertEqual(self.registry.idle(), 3)
+
+    def test_evicted_session_closes_its_idle_objects(self):
+        first = self.registry.get('user', credentials_json('a'))
+        client = Closable()
+        first.give_back('client', client, Closable.close)
+        self.registry.get('user', credentials_json('b'))
+        self.registry.get('user', credentials_json('c'))
+        self.assertTrue(client.closed)
+        self.assertEqual(self.registry.idle(), 0)
+
+        # and anything given back to it later
+        late = Closable()
+        first.give_back('client', late, Closable.close)
+        self.assertTrue(late.closed)
+
+    def test_invalidate_by_fingerprint(self):
+        session = self.registry.get('user', credentials_json('a'))
+        other = self.registry.get('user', credentials_json('b'))
+        self.registry.invalidate(fingerprint=session.fingerprint)
+        self.assertFalse(self.registry.get('user', credentials_json('a')) is session)
+        self.assertTrue(self.registry.get('user', credentials_json('b')) is other)
+        self.assertTrue(session.closed)
+        self.assertEqual(self.registry.stats['invalidated'], 1)
+
+    def test_invalidate_by_user_id(self):
+        # the old credentials are gone, so only the user_id ties them to
+        # the new ones
+        session = self.registry.get('user', credentials_json('a'))
+        other = self.registry.get('other', credentials_json('b'))
+        self.registry.invalidate(user_id='user')
+        self.assertTrue(session.closed)
+        self.assertFalse(other.closed)
+        self.assertEqual(self.registry.size(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
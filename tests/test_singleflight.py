@@ -0,0 +1,84 @@
+import unittest
+
+import support
+
+import utils
+from singleflight import SingleFlight
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+        self.results = []
+
+    def fn(self, on_success, on_error, cancel_token, deadline):
+        self.calls.append((on_success, on_error, cancel_token, deadline))
+
+    def do(self, key, name, cancel_token=None, deadline=None):
+        self.flights.do(key, self.fn,
+                        lambda value: self.results.append((name, value)),
+                        lambda error: self.results.append((name, 'error', error)),
+                        cancel_token, deadline)
+
+    def test_same_key_shares_one_call(self):
+        self.do('k', 'a')
+        self.do('k', 'b')
+        self.do('other', 'c')
+        self.assertEqual(len(self.calls), 2)
+        self.assertTrue(self.flights.has('k'))
+
+        self.calls[0][0]('listing')
+        self.assertEqual(self.results, [('a', 'listing'), ('b', 'listing')])
+        self.assertFalse(self.flights.has('k'))
+        self.assertEqual(self.flights.stats['coalesced'], 1)
+
+        # called back twice: ignored
+        self.calls[0][0]('again')
+        self.assertEqual(len(self.results), 2)
+
+    def test_errors_are_shared_not_kept(self):
+        self.do('k', 'a')
+        self.do('k', 'b')
+        error = Exception('failed')
+        self.calls[0][1](error)
+        self.assertEqual(self.results, [('a', 'error', error), ('b', 'error', error)])
+        self.do('k', 'c')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_fn_raising_is_an_error(self):
+        def fn(on_success, on_error, cancel_token, deadline):
+            raise ValueError('broken')
+        self.flights.do('k', fn, None, lambda error: self.results.append(error))
+        self.assertTrue(isinstance(self.results[0], ValueError))
+        self.assertEqual(self.flights.in_flight(), 0)
+
+    def test_call_is_cancelled_once_every_caller_has_gone(self):
+        first, second = utils.CancelToken(), utils.CancelToken()
+        self.do('k', 'a', first)
+        self.do('k', 'b', second)
+        shared = self.calls[0][2]
+        first.cancel()
+        self.assertFalse(shared.cancelled)
+        self.calls[0][0]('listing')
+        self.assertEqual(self.results, [('b', 'listing')])
+
+        first, second = utils.CancelToken(), utils.CancelToken()
+        self.do('k', 'a', first)
+        self.do('k', 'b', second)
+        first.cancel()
+        second.cancel()
+        self.assertTrue(self.calls[1][2].cancelled)
+        self.assertFalse(self.flights.has('k'))
+        self.assertEqual(self.flights.stats['abandoned'], 1)
+
+    def test_shared_call_runs_to_the_latest_deadline(self):
+        early, late = utils.Deadline(1), utils.Deadline(10)
+        self.do('k', 'a', deadline=early)
+        self.do('k', 'b', deadline=late)
+        self.assertEqual(self.calls[0][3].expires, late.expires)
+        # a copy: the first caller's own deadline is left alone
+        self.assertTrue(early.expires < late.expires)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import gzip
+import zlib
+import threading
+import StringIO
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+import support
+
+import oauth2 as oauth
+import simplejson
+
+import sessions
+import streamjson
+import utils
+
+FEED = simplejson.dumps({
+    'feed': {
+        'title': 'a "feed", with [brackets] and {braces}',
+        'link': [{'entry': 'not this one'}],
+        'entry': [{'id': i, 'title': 'photo ]}, "%d"' % i, 'tags': ['a', {'b': []}]} for i in range(100)],
+        'after': {'entry': []},
+    }
+})
+
+def parse(document, path=('feed', 'entry'), chunk_size=None, required=True):
+    parser = streamjson.ItemParser(path, lambda entry: entry['id'], required)
+    chunk_size = chunk_size or len(document)
+    for start in range(0, len(document), chunk_size):
+        parser.feed(document[start:start + chunk_size])
+    return parser.close()
+
+class ItemParserTest(unittest.TestCase):
+
+    def test_items_at_the_path(self):
+        self.assertEqual(parse(FEED), range(100))
+
+    def test_any_chunking(self):
+        for chunk_size in [1, 2, 3, 7, 64]:
+            self.assertEqual(parse(FEED, chunk_size=chunk_size), range(100), chunk_size)
+
+    def test_whitespace_and_escapes(self):
+        document = '{ "feed" : {"x\\"y": "\\\\", "entry" : [ {"id": 1} ,\n {"id": 2} ] } }'
+        self.assertEqual(parse(document, chunk_size=1), [1, 2])
+
+    def test_missing_array(self):
+        self.assertRaises(ValueError, parse, '{"feed": {"title": "empty"}}')
+        self.assertEqual(parse('{"feed": {"title": "empty"}}', required=False), [])
+
+    def test_document_cut_short(self):
+        self.assertRaises(ValueError, parse, FEED[:len(FEED) / 2])
+        self.assertRaises(ValueError, parse, FEED[:-2])
+
+    def test_parse_items_cancelled(self):
+        token = utils.CancelToken()
+        token.cancel()
+        self.assertEqual(streamjson.parse_items(StringIO.StringIO(FEED), ['feed', 'entry'], lambda e: e,
+                                                cancel_token=token), None)
+        self.assertEqual(streamjson.parse_items(StringIO.StringIO(FEED), ['feed', 'entry'], lambda e: e['id'],
+                                                chunk_size=10), range(100))
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address, self.path, self.headers.get('accept-encoding')))
+        if self.path.startswith('/missing'):
+            self.reply(404, 'no such album')
+        elif self.path.startswith('/deflate'):
+            self.reply(200, zlib.compress(FEED), 'deflate')
+        else:
+            compressed = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=compressed, mode='wb')
+            f.write(FEED)
+            f.close()
+            self.reply(200, compressed.getvalue(), 'gzip')
+
+    def reply(self, code, body, encoding=None):
+        self.send_response(code)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that hang up on purpose
+        pass
+
+class InPlacePool(object):
+    "runs the work straight away, as a utils.WorkerPool would on a thread"
+
+    def submit(self, fn, on_success, on_error, cancel_token=None):
+        try:
+            result = fn()
+        except Exception, e:
+            on_error(e)
+        else:
+            if not utils.is_cancelled(cancel_token):
+                on_success(result)
+
+class GetItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FeedServer(('127.0.0.1', 0), FeedHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+        self.credentials = sessions.Credentials({'oauth_token': 'token', 'oauth_token_secret': 'secret'},
+                                                sessions.Session('user'), 'fingerprint')
+        self.clients = []
+        self.results = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.credentials.session.close()
+
+    def new_client(self, credentials):
+        token = oauth.Token(credentials['oauth_token'], credentials['oauth_token_secret'])
+        self.clients.append(oauth.Client(oauth.Consumer('key', 'secret'), token))
+        return self.clients[-1]
+
+    def get_items(self, path, cancel_token=None):
+        streamjson.get_items(InPlacePool(), self.credentials, self.new_client, self.url + path, {'alt': 'json'},
+                             ['feed', 'entry'], lambda entry: entry['id'],
+                             on_success=lambda items: self.results.append(('items', items)),
+                             on_error=lambda error: self.results.append(('error', error)),
+                             cancel_token=cancel_token, deadline=utils.Deadline(10))
+
+    def test_signed_gzipped_and_kept_alive(self):
+        self.get_items('/feed')
+        self.get_items('/deflate')
+        self.assertEqual(self.results, [('items', range(100))] * 2)
+
+        (first, path, encoding), (second, _, _) = self.server.requests
+        self.assertTrue('oauth_signature=' in path and 'alt=json' in path)
+        self.assertTrue('gzip' in encoding)
+        # one client from the session, and one connection
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(first, second)
+
+    def test_error_response_body(self):
+        self.get_items('/missing')
+        error = self.results[0][1]
+        self.assertTrue(isinstance(error, utils.UpstreamError))
+        self.assertEqual((error.code, str(error)), (404, 'no such album'))
+        self.get_items('/feed')
+        self.assertEqual(self.results[1], ('items', range(100)))
+        self.assertEqual(len(self.clients), 1)
+
+    def test_cancelled_read_closes_the_connection(self):
+        token = utils.CancelToken()
+        token.cancel()
+        self.get_items('/feed', token)
+        self.assertEqual(self.results, [])
+        client = self.clients[0]
+        self.assertTrue(all(connection.sock is None for connection in client.connections.values()))
+
+    def test_no_server(self):
+        self.url = 'http://127.0.0.1:1'
+        self.get_items('/feed')
+        self.assertEqual(self.results[0][0], 'error')
+        self.assertTrue(isinstance(self.results[0][1], Exception))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import base64
+import shutil
+import tempfile
+import unittest
+
+from support import FakeIOLoop
+
+import admission
+import scheduler
+import upstream
+import uploadqueue
+
+CREDENTIALS = {'oauth_token': 'token', 'oauth_token_secret': 'secret'}
+
+class UploadQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.io_loop = FakeIOLoop()
+        self.stored = []
+        self.store_photo = upstream.store_photo
+        upstream.store_photo = self.fake_store_photo
+
+    def tearDown(self):
+        upstream.store_photo = self.store_photo
+        shutil.rmtree(self.dir)
+
+    def fake_store_photo(self, user_id, credentials, photoset_id, photo, title, description, tags,
+                         on_success, on_error, deadline=None):
+        self.stored.append((photoset_id, open(photo.path, 'rb').read(), on_success, on_error))
+
+    def queue(self, **kwargs):
+        queue = uploadqueue.UploadQueue(os.path.join(self.dir, 'uploads.db'), os.path.join(self.dir, 'spool'),
+                                        io_loop=self.io_loop, **kwargs)
+        queue.start()
+        return queue
+
+    def enqueue(self, queue):
+        return queue.enqueue('user', CREDENTIALS, 'set', 'title', '', '', photo=base64.b64encode('photo'))
+
+    def state(self, queue, job_id):
+        return queue.status(job_id, 'user', CREDENTIALS)['state']
+
+    def test_uploads_a_job(self):
+        queue = self.queue()
+        job_id = self.enqueue(queue)
+        self.assertEqual(self.state(queue, job_id), uploadqueue.UPLOADING)
+        photoset_id, photo, on_success, on_error = self.stored[0]
+        self.assertEqual((photoset_id, photo), ('set', 'photo'))
+
+        on_success({'id': 'p1'})
+        status = queue.status(job_id, 'user', CREDENTIALS)
+        self.assertEqual(status['state'], uploadqueue.DONE)
+        self.assertEqual(status['result'], {'id': 'p1'})
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'spool')), [])
+        self.assertEqual(queue.active, 0)
+
+    def test_busy_job_waits_for_its_retry_time(self):
+        queue = self.queue()
+        job_id = self.enqueue(queue)
+        self.stored[0][3](scheduler.Busy("busy", 30))
+        self.io_loop.run_callbacks()
+
+        status = queue.status(job_id, 'user', CREDENTIALS)
+        self.assertEqual(status['state'], uploadqueue.PENDING)
+        self.assertTrue('retry_at' in status)
+        # not tried again straight away, but a timer is set for it
+        self.assertEqual(len(self.stored), 1)
+        self.assertEqual(len(self.io_loop.timeouts), 1)
+        self.assertEqual(queue.active, 0)
+
+        queue.db.execute("update jobs set retry_at = 0")
+        self.io_loop.run_timeouts()
+        self.assertEqual(len(self.stored), 2)
+        self.assertEqual(self.state(queue, job_id), uploadqueue.UPLOADING)
+
+    def test_gives_up_on_a_job_that_is_always_busy(self):
+        queue = self.queue(max_busy=1)
+        job_id = self.enqueue(queue)
+        self.stored[0][3](scheduler.Busy("busy", 1))
+        queue.db.execute("update jobs set retry_at = 0")
+        self.io_loop.run_timeouts()
+        self.stored[1][3](scheduler.Busy("busy", 1))
+
+        status = queue.status(job_id, 'user', CREDENTIALS)
+        self.assertEqual(status['state'], uploadqueue.FAILED)
+        self.assertTrue('turned away' in status['error'])
+
+    def test_many_jobs_turned_away_at_once(self):
+        def store_photo(user_id, credentials, photoset_id, photo, title, description, tags,
+                        on_success, on_error, deadline=None):
+            on_error(scheduler.Busy("busy", 30))
+        upstream.store_photo = store_photo
+
+        queue = self.queue(workers=0)
+        for i in range(300):
+            self.enqueue(queue)
+        queue.workers = 4
+        queue._pump()
+        self.io_loop.run_callbacks()
+        self.assertEqual(queue.counts(), {uploadqueue.PENDING: 300})
+        self.assertEqual(queue.active, 0)
+
+    def test_memory_rejection_puts_the_job_back(self):
+        memory = admission.MemoryBudget(10, max_waiting=0, io_loop=self.io_loop)
+        memory.in_use = 5
+        queue = self.queue(memory=memory)
+        job_id = self.enqueue(queue)
+        self.assertEqual(self.stored, [])
+        self.assertEqual(self.state(queue, job_id), uploadqueue.PENDING)
+        self.assertEqual(queue.active, 0)
+
+    def test_start_picks_up_interrupted_jobs(self):
+        queue = self.queue()
+        job_id = self.enqueue(queue)
+        queue.db.close()
+
+        queue = self.queue()
+        self.assertEqual(len(self.stored), 2)
+        self.assertEqual(queue.status(job_id, 'user', CREDENTIALS)['attempts'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
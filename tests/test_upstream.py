@@ -0,0 +1,61 @@
+import unittest
+
+import support
+
+import listingcache
+import upstream
+
+CREDENTIALS = {'oauth_token': 'token', 'oauth_token_secret': 'secret'}
+
+class FakeProvider(object):
+
+    def __init__(self):
+        self.stored = []
+
+    def store_photo(self, user_id, credentials, photoset_id, photo, title, description, tags,
+                    on_success, on_error, cancel_token=None, deadline=None):
+        self.stored.append((on_success, on_error))
+
+class StorePhotoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = upstream.photosite, upstream.listing_cache, upstream.dedup_index
+        upstream.photosite = self.provider = FakeProvider()
+        upstream.listing_cache = self.cache = listingcache.ListingCache(60)
+        upstream.dedup_index = None
+        self.results = []
+
+    def tearDown(self):
+        upstream.photosite, upstream.listing_cache, upstream.dedup_index = self.saved
+
+    def cache_listings(self):
+        self.cache.set(upstream._key('get_photosets', 'user', CREDENTIALS), [{'id': '1', 'num_photos': 1}])
+        for photoset_id in ['1', '2']:
+            self.cache.set(upstream._key('get_photos', 'user', CREDENTIALS, photoset_id), [{'id': 'p'}])
+
+    def cached(self):
+        keys = [upstream._key('get_photosets', 'user', CREDENTIALS)]
+        keys += [upstream._key('get_photos', 'user', CREDENTIALS, photoset_id) for photoset_id in ['1', '2']]
+        return [self.cache.fresh(key) is not None for key in keys]
+
+    def store(self, photoset_id):
+        upstream.store_photo('user', CREDENTIALS, photoset_id, 'cGhvdG8=', 'title', '', '',
+                             self.results.append, self.results.append)
+
+    def test_upload_drops_the_listings_it_changes(self):
+        self.cache_listings()
+        self.store(1)
+        self.assertEqual(self.cached(), [True, True, True])
+        self.provider.stored[0][0]({'id': 'new'})
+        self.assertEqual(self.results, [{'id': 'new'}])
+        # the photoset listing (for its counts) and this photoset's photos
+        self.assertEqual(self.cached(), [False, False, True])
+
+    def test_failed_upload_leaves_them(self):
+        self.cache_listings()
+        self.store('1')
+        self.provider.stored[0][1]('failed')
+        self.assertEqual(self.cached(), [True, True, True])
+
+if __name__ == '__main__':
+    unittest.main()
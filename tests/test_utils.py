@@ -0,0 +1,120 @@
+import unittest
+
+import support
+
+import utils
+
+class CancelTokenTest(unittest.TestCase):
+
+    def test_callbacks_run_once_on_cancel(self):
+        token = utils.CancelToken()
+        called = []
+        token.add_callback(lambda: called.append('a'))
+        removed = lambda: called.append('removed')
+        token.add_callback(removed)
+        token.remove_callback(removed)
+        self.assertFalse(utils.is_cancelled(token))
+
+        token.cancel()
+        token.cancel()
+        self.assertEqual(called, ['a'])
+        self.assertTrue(utils.is_cancelled(token))
+        self.assertFalse(utils.is_cancelled(None))
+
+        # too late to wait for it: called straight away
+        token.add_callback(lambda: called.append('late'))
+        self.assertEqual(called, ['a', 'late'])
+
+    def test_broken_callback_doesnt_stop_the_others(self):
+        token = utils.CancelToken()
+        called = []
+        token.add_callback(lambda: 1 / 0)
+        token.add_callback(lambda: called.append('a'))
+        token.cancel()
+        self.assertEqual(called, ['a'])
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_timeouts_from_what_is_left(self):
+        deadline = utils.Deadline(10, connect_timeout=2)
+        connect_timeout, request_timeout = deadline.timeouts()
+        self.assertEqual(connect_timeout, 2)
+        self.assertTrue(9 < request_timeout <= 10)
+        self.assertEqual(utils.timeout_args(None), {})
+        self.assertEqual(sorted(utils.timeout_args(deadline)), ['connect_timeout', 'request_timeout'])
+
+        short = utils.Deadline(1, connect_timeout=2)
+        self.assertTrue(short.timeouts()[0] <= 1)
+
+    def test_expired(self):
+        deadline = utils.Deadline(0)
+        self.assertTrue(deadline.expired())
+        self.assertRaises(utils.DeadlineExceeded, deadline.timeouts)
+        self.assertRaises(utils.DeadlineExceeded, utils.timeout_args, deadline)
+
+    def test_copy_and_extend(self):
+        deadline = utils.Deadline(1)
+        copy = deadline.copy()
+        copy.extend_to(utils.Deadline(10))
+        self.assertTrue(copy.remaining() > 9)
+        self.assertTrue(deadline.remaining() <= 1)
+        copy.extend_to(deadline)
+        self.assertTrue(copy.remaining() > 9)
+
+    def test_error_prefix_leaves_exceptions_alone(self):
+        errors = []
+        on_error = utils.with_error_prefix(errors.append, "couldn't get photos: ")
+        on_error("bad album")
+        exceeded = utils.DeadlineExceeded("timed out")
+        on_error(exceeded)
+        self.assertEqual(errors, ["couldn't get photos: bad album", exceeded])
+
+        on_error(utils.UpstreamError(404, "no such album"))
+        self.assertEqual((errors[-1].code, str(errors[-1])), (404, "couldn't get photos: no such album"))
+
+class SplitTagsTest(unittest.TestCase):
+
+    def test_commas_and_semicolons(self):
+        self.assertEqual(utils.split_tags("beach, sunset;; dog "), ["beach", "sunset", "dog"])
+        self.assertEqual(utils.split_tags(None), [])
+
+class JoinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+        self.cancel_token = utils.CancelToken()
+        self.steps = utils.Join(lambda results: self.results.append(results),
+                                lambda error: self.results.append(('error', error)), self.cancel_token)
+
+    def test_carries_on_once_every_step_is_done(self):
+        one = self.steps.add('one')
+        other = self.steps.add('other')
+        self.steps.start()
+        other[0](2)
+        self.assertEqual(self.results, [])
+        one[0](1)
+        one[0]('twice')
+        self.assertEqual(self.results, [{'one': 1, 'other': 2}])
+
+    def test_steps_done_before_start(self):
+        self.steps.add('one')[0](1)
+        self.assertEqual(self.results, [])
+        self.steps.start()
+        self.assertEqual(self.results, [{'one': 1}])
+
+        steps = utils.Join(self.results.append, None)
+        steps.start()
+        self.assertEqual(self.results[-1], {})
+
+    def test_first_error_cancels_the_rest(self):
+        one = self.steps.add('one')
+        other = self.steps.add('other')
+        self.steps.start()
+        one[1]('failed')
+        other[1]('failed too')
+        other[0](2)
+        self.assertEqual(self.results, [('error', 'failed')])
+        self.assertTrue(self.cancel_token.cancelled)
+
+if __name__ == '__main__':
+    unittest.main()
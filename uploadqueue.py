@@ -0,0 +1,309 @@
+"""
+durable background uploads
+
+In background mode /post/photo writes the photo to a local spool
+directory, records a job in SQLite and answers with the job id right
+away. A fixed number of upload slots drain the pending jobs through
+upstream.store_photo, looking up the default photoset first if the job
+has none. Job state survives a restart: anything that was uploading
+when the process went down is simply picked up again.
+
+Jobs hold the user's credentials, so the database and spool directory
+should be readable by this service only.
+"""
+
+import os
+import time
+import uuid
+import base64
+import sqlite3
+import logging
+
+import simplejson
+import tornado.ioloop
+import tornado.httpclient
+
+import scheduler
+import upstream
+import utils
+
+PENDING = 'pending'
+UPLOADING = 'uploading'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+create table if not exists jobs (
+  id text primary key,
+  state text not null,
+  user_id text not null,
+  credentials text not null,
+  fingerprint text not null,
+  photoset_id text,
+  title text,
+  description text,
+  tags text,
+  photo_url text,
+  spool_path text,
+  result text,
+  error text,
+  attempts integer not null default 0,
+  busy integer not null default 0,
+  retry_at real not null default 0,
+  created real not null,
+  updated real not null
+)
+"""
+
+class UploadQueue(object):
+
+    def __init__(self, db_path, spool_dir, workers=4, upload_seconds=120, max_busy=20, memory=None,
+                 io_loop=None):
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.upload_seconds = upload_seconds
+        # times a job may be turned away as busy before it is given up on
+        self.max_busy = max_busy
+        # an admission.MemoryBudget each upload is charged against while it runs
+        self.memory = memory
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.active = 0
+        self._pump_timeout = None
+        self._pump_at = None
+
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(SCHEMA)
+        # databases from before jobs could be put back for later
+        columns = [row['name'] for row in self.db.execute("pragma table_info(jobs)")]
+        if 'retry_at' not in columns:
+            self.db.execute("alter table jobs add column busy integer not null default 0")
+            self.db.execute("alter table jobs add column retry_at real not null default 0")
+        self.db.execute("create index if not exists jobs_state on jobs (state, created)")
+        self.db.commit()
+
+    def start(self):
+        "pick up whatever was left pending or half-done by the last run"
+        self.db.execute("update jobs set state = ?, updated = ? where state = ?", (PENDING, time.time(), UPLOADING))
+        self.db.commit()
+        self._pump()
+
+    def enqueue(self, user_id, credentials, photoset_id, title, description, tags, photo=None, photo_url=None):
+        """
+        record an upload job and return its id. photo is base64, as with
+        store_photo, and is spooled to disk decoded; a utils.SpooledPhoto is
+        moved into the spool as it is. A photo_url is fetched by the worker
+        instead.
+        """
+        job_id = uuid.uuid4().hex
+        spool_path = None
+        if isinstance(photo, utils.SpooledPhoto):
+            spool_path = os.path.join(self.spool_dir, job_id)
+            os.rename(photo.path, spool_path)
+        elif photo is not None:
+            spool_path = os.path.join(self.spool_dir, job_id)
+            _write_durably(spool_path, base64.b64decode(photo))
+
+        now = time.time()
+        self.db.execute("insert into jobs (id, state, user_id, credentials, fingerprint, photoset_id, title, "
+                        "description, tags, photo_url, spool_path, created, updated) "
+                        "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (job_id, PENDING, user_id, simplejson.dumps(credentials),
+                         upstream.credentials_fingerprint(credentials), photoset_id, title, description,
+                         tags, photo_url, spool_path, now, now))
+        self.db.commit()
+        self._pump()
+        return job_id
+
+    def status(self, job_id, user_id, credentials):
+        "the job as a dictionary, or None if there is no such job for this user"
+        row = self.db.execute("select * from jobs where id = ? and user_id = ? and fingerprint = ?",
+                              (job_id, user_id, upstream.credentials_fingerprint(credentials))).fetchone()
+        if row is None:
+            return None
+
+        status = {'job_id': row['id'],
+                  'state': row['state'],
+                  'attempts': row['attempts'],
+                  'created': row['created'],
+                  'updated': row['updated']}
+        if row['state'] == PENDING:
+            status['position'] = self.db.execute("select count(*) from jobs where state = ? and created < ?",
+                                                 (PENDING, row['created'])).fetchone()[0]
+            if row['retry_at'] > time.time():
+                status['retry_at'] = row['retry_at']
+        if row['result'] is not None:
+            status['result'] = simplejson.loads(row['result'])
+        if row['error'] is not None:
+            status['error'] = row['error']
+        return status
+
+    def counts(self):
+        return dict(self.db.execute("select state, count(*) from jobs group by state").fetchall())
+
+    def _pump(self):
+        "start pending jobs that are due while there are free upload slots"
+        while self.active < self.workers:
+            row = self.db.execute("select * from jobs where state = ? and retry_at <= ? order by created limit 1",
+                                  (PENDING, time.time())).fetchone()
+            if row is None:
+                self._pump_later()
+                return
+            self._update(row['id'], state=UPLOADING, attempts=row['attempts'] + 1)
+            self.active += 1
+            try:
+                self._run(row)
+            except Exception, e:
+                logging.exception("upload job %s failed to start" % row['id'])
+                self._failed(row['id'], "%s" % e)
+
+    def _pump_later(self):
+        "pump again when the first job put back for later is due"
+        due = self.db.execute("select min(retry_at) from jobs where state = ?", (PENDING,)).fetchone()[0]
+        if due is None or (self._pump_timeout is not None and self._pump_at <= due):
+            return
+        if self._pump_timeout is not None:
+            self.io_loop.remove_timeout(self._pump_timeout)
+        self._pump_at = due
+        self._pump_timeout = self.io_loop.add_timeout(due, self._delayed_pump)
+
+    def _delayed_pump(self):
+        self._pump_timeout = None
+        self._pump()
+
+    def _busy(self, job_id, error):
+        "put a job that was turned away (a scheduler.Busy) back, not to be tried again before it says"
+        busy = self.db.execute("select busy from jobs where id = ?", (job_id,)).fetchone()[0] + 1
+        if busy > self.max_busy:
+            self._failed(job_id, "gave up after being turned away %d times: %s" % (busy - 1, error))
+            return
+        self._update(job_id, state=PENDING, busy=busy, retry_at=time.time() + max(1, error.retry_after))
+        self._finished()
+
+    def _run(self, job):
+        if self.memory is None:
+            self._upload(job, lambda: None)
+            return
+
+        if job['spool_path']:
+            cost = self.memory.cost(os.path.getsize(job['spool_path']))
+        else:
+            cost = self.memory.cost(0, photo_urls=1)
+
+        released = []
+        def release():
+            if not released:
+                released.append(True)
+                self.memory.release(cost)
+
+        def admitted():
+            try:
+                self._upload(job, release)
+            except Exception, e:
+                # admitted later on, so _pump isn't there to catch this
+                logging.exception("upload job %s failed to start" % job['id'])
+                release()
+                self._failed(job['id'], "%s" % e)
+
+        def on_reject(error):
+            # no room: put it back, and try again later
+            self._busy(job['id'], error)
+
+        self.memory.acquire(cost, admitted, on_reject)
+
+    def _upload(self, job, release):
+        "upload the job, then call release"
+        job_id = job['id']
+        credentials = simplejson.loads(job['credentials'])
+        deadline = utils.Deadline(self.upload_seconds)
+        # cancelled when one step fails, so the other can stop
+        cancel_token = utils.CancelToken()
+        state = {}
+
+        def on_error(error):
+            release()
+            if isinstance(error, scheduler.Busy):
+                # over quota: put it back, and try again when the quota allows
+                self._busy(job_id, error)
+            else:
+                self._failed(job_id, "%s" % error)
+
+        def on_success(result):
+            release()
+            self._update(job_id, state=DONE, result=simplejson.dumps(result), error=None)
+            if job['spool_path'] and os.path.exists(job['spool_path']):
+                os.remove(job['spool_path'])
+            self._finished()
+
+        def upload(results):
+            upstream.store_photo(job['user_id'], credentials, job['photoset_id'] or results['photoset_id'],
+                                 state['photo'], job['title'], job['description'], job['tags'],
+                                 on_success=on_success, on_error=on_error, deadline=deadline)
+
+        def fetch_photo(on_fetched, on_fetch_error):
+            def on_response(response):
+                if response.error:
+                    on_fetch_error("couldn't fetch photo_url: %s" % response.error)
+                else:
+                    state['photo'] = base64.b64encode(response.body)
+                    on_fetched(None)
+
+            http = tornado.httpclient.AsyncHTTPClient()
+            http.fetch(tornado.httpclient.HTTPRequest(job['photo_url'], **utils.timeout_args(deadline)),
+                       callback=on_response)
+
+        def get_default_photoset(on_photoset, on_photoset_error):
+            def on_photosets(photosets):
+                if not photosets:
+                    on_photoset_error("no photoset to upload to")
+                else:
+                    on_photoset(photosets[0]['id'])
+
+            upstream.get_photosets(job['user_id'], credentials,
+                                   on_success=on_photosets, on_error=on_photoset_error,
+                                   cancel_token=cancel_token, deadline=deadline)
+
+        # fetching the photo and finding the default photoset can happen at once
+        steps = utils.Join(upload, on_error, cancel_token)
+        if job['spool_path']:
+            state['photo'] = utils.SpooledPhoto(job['spool_path'])
+        else:
+            fetch_photo(*steps.add('photo'))
+        if not job['photoset_id']:
+            get_default_photoset(*steps.add('photoset_id'))
+        steps.start()
+
+    def _failed(self, job_id, error):
+        logging.error("upload job %s failed: %s" % (job_id, error))
+        self._update(job_id, state=FAILED, error=error)
+        row = self.db.execute("select spool_path from jobs where id = ?", (job_id,)).fetchone()
+        if row['spool_path'] and os.path.exists(row['spool_path']):
+            os.remove(row['spool_path'])
+        self._finished()
+
+    def _finished(self):
+        self.active -= 1
+        # not straight away: a job turned away synchronously would otherwise
+        # start the next one inside its own call, and so on down the queue
+        self.io_loop.add_callback(self._pump)
+
+    def _update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        names = fields.keys()
+        self.db.execute("update jobs set %s where id = ?" % ", ".join("%s = ?" % name for name in names),
+                        [fields[name] for name in names] + [job_id])
+        self.db.commit()
+
+def _write_durably(path, data):
+    "write data to path so that it's either all there after a crash, or not there at all"
+    tmp_path = path + ".tmp"
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
@@ -0,0 +1,228 @@
+"""
+front end to the photo provider module
+
+server.py goes through here rather than calling the provider module
+directly, so that behaviour shared by every provider lives in one place.
+The functions mirror the provider interface (see flickr.py).
+"""
+
+import hashlib
+import simplejson
+
+import config
+import scheduler
+import resilience
+import dedup
+import searchindex
+import listingcache
+import utils
+from singleflight import SingleFlight
+
+PROVIDER = config.PHOTO_SITE.lower()
+photosite = __import__(PROVIDER)
+
+if PROVIDER == 'flickr':
+    API_KEY = config.KEYS['flickrAPIKey']
+else:
+    API_KEY = config.KEYS['api_key']
+
+_flights = SingleFlight()
+_scheduler = scheduler.get(PROVIDER, API_KEY)
+_resilient = resilience.Resilient(PROVIDER,
+                                  attempts = getattr(config, 'UPSTREAM_ATTEMPTS', 3),
+                                  breaker = getattr(config, 'UPSTREAM_BREAKER', None),
+                                  hedge = getattr(config, 'UPSTREAM_HEDGE', False))
+
+# optional: listings younger than LISTING_CACHE_TTL seconds are served without
+# calling the provider, and older ones can still answer for an open circuit
+if getattr(config, 'LISTING_CACHE_TTL', 0):
+    if getattr(config, 'LISTING_CACHE_DB', None):
+        # shared by every server process on this host
+        _listing_backend = listingcache.SQLiteBackend(config.LISTING_CACHE_DB,
+                                                      max_bytes = getattr(config, 'LISTING_CACHE_MAX_BYTES',
+                                                                          64 * 1024 * 1024))
+    else:
+        _listing_backend = listingcache.MemoryBackend(getattr(config, 'LISTING_CACHE_MAX_ENTRIES', 10000))
+    listing_cache = listingcache.ListingCache(config.LISTING_CACHE_TTL,
+                                              stale_ttl = getattr(config, 'LISTING_CACHE_STALE_TTL', 3600),
+                                              backend = _listing_backend)
+else:
+    listing_cache = None
+
+# anything with a get(key) method; when set, an open circuit is answered from it
+stale_cache = listing_cache
+
+# optional: uploads of a photo already uploaded to the same photoset are answered from here
+if getattr(config, 'DEDUP_DB', None):
+    dedup_index = dedup.DedupIndex(config.DEDUP_DB, getattr(config, 'DEDUP_MAX_ENTRIES', 100000))
+else:
+    dedup_index = None
+
+# every listing that comes back is added to this, for /search
+search_index = searchindex.SearchIndex(max_users = getattr(config, 'SEARCH_MAX_USERS', 1000),
+                                       max_photos = getattr(config, 'SEARCH_MAX_PHOTOS', 200000))
+
+def credentials_fingerprint(credentials):
+    "a stable digest of a user's credentials, so raw tokens never end up in keys"
+    # sessions.Credentials carry theirs
+    fingerprint = getattr(credentials, 'fingerprint', None)
+    if fingerprint is None:
+        fingerprint = hashlib.sha1(simplejson.dumps(credentials, sort_keys=True)).hexdigest()
+    return fingerprint
+
+def _key(method, user_id, credentials, *params):
+    return (PROVIDER, method, user_id, credentials_fingerprint(credentials)) + params
+
+def _user_key(user_id, credentials):
+    return (user_id, credentials_fingerprint(credentials))
+
+def _scheduled(priority, fn):
+    """
+    wrap fn(on_success, on_error, cancel_token, deadline) so it only runs once
+    the provider quota allows; if it is rejected, on_error gets a scheduler.Busy
+    """
+    def run(on_success, on_error, cancel_token, deadline):
+        _scheduler.submit(priority, lambda: fn(on_success, on_error, cancel_token, deadline), on_error,
+                          cancel_token, deadline)
+    return run
+
+def _resilient_call(method, key, fn, on_fresh=None):
+    """
+    retry / circuit-break / hedge fn(on_success, on_error, cancel_token, deadline); only for idempotent calls.
+    on_fresh, if given, gets the result that is passed on, once, unless it is a stale fallback
+    """
+    def run(on_success, on_error, cancel_token, deadline):
+        state = {'stale': False}
+
+        def stale():
+            if stale_cache is None:
+                return None
+            listing = stale_cache.get(key)
+            state['stale'] = listing is not None
+            return listing
+
+        def success(result):
+            if on_fresh is not None and not state['stale']:
+                on_fresh(result)
+            on_success(result)
+
+        _resilient.call(method, fn, success, on_error, fallback=stale,
+                        cancel_token=cancel_token, deadline=deadline)
+    return run
+
+def _listing(method, key, fetch, on_fetched, on_success, on_error, cancel_token, deadline, prefetch=False):
+    """
+    answer from the listing cache, or else run fetch(success, error, token, deadline)
+    through single flight, retries and the scheduler. What it returns is
+    cached and passed to on_fetched once, however many hedged or retried
+    fetches it took.
+    """
+    if listing_cache is not None:
+        listing = listing_cache.fresh(key)
+        if listing is not None:
+            on_success(listing)
+            return
+
+    def store(listing):
+        if listing_cache is not None:
+            # a prefetch that comes back after an interactive fetch of the
+            # same listing leaves that one be
+            if not (prefetch and listing_cache.contains_fresh(key)):
+                listing_cache.set(key, listing, prefetched=prefetch)
+        on_fetched(listing)
+
+    # interactive callers never wait on a prefetch, which queues behind
+    # everything else for the quota; a prefetch may wait on them, though
+    priority = scheduler.PREFETCH if prefetch else scheduler.INTERACTIVE
+    flight_key = key + (priority,)
+    if prefetch and _flights.has(key + (scheduler.INTERACTIVE,)):
+        flight_key = key + (scheduler.INTERACTIVE,)
+    _flights.do(flight_key, _resilient_call(method, key, _scheduled(priority, fetch), store),
+                on_success, on_error, cancel_token, deadline)
+
+def get_photosets(user_id, credentials, on_success, on_error, cancel_token=None, deadline=None):
+    """
+    identical concurrent calls share one upstream fetch and one parse;
+    transient failures are retried
+    """
+    def fetch(success, error, token, deadline):
+        photosite.get_photosets(user_id, credentials, success, error,
+                                cancel_token=token, deadline=deadline)
+
+    def index(photosets):
+        search_index.add_photosets(_user_key(user_id, credentials), photosets)
+
+    _listing('get_photosets', _key('get_photosets', user_id, credentials), fetch, index,
+             on_success, on_error, cancel_token, deadline)
+
+def get_photos(user_id, credentials, photoset_id, on_success, on_error, cancel_token=None, deadline=None,
+               prefetch=False):
+    """
+    identical concurrent calls share one upstream fetch and one parse;
+    transient failures are retried. With prefetch, the call waits behind
+    everything else for the provider quota, and the result is marked as
+    prefetched in the listing cache.
+    """
+    def fetch(success, error, token, deadline):
+        photosite.get_photos(user_id, credentials, photoset_id, success, error,
+                             cancel_token=token, deadline=deadline)
+
+    def index(photos):
+        search_index.add_photos(_user_key(user_id, credentials), photoset_id, photos)
+
+    _listing('get_photos', _key('get_photos', user_id, credentials, photoset_id), fetch, index,
+             on_success, on_error, cancel_token, deadline, prefetch)
+
+def has_fresh_photos(user_id, credentials, photoset_id):
+    "whether get_photos would be answered from the listing cache"
+    return listing_cache is not None and \
+        listing_cache.contains_fresh(_key('get_photos', user_id, credentials, photoset_id))
+
+def _forget_listings(user_id, credentials, photoset_id):
+    "drop the cached listings an upload to photoset_id has made out of date"
+    if listing_cache is None:
+        return
+    # the photoset count in the photoset listing too
+    listing_cache.delete(_key('get_photosets', user_id, credentials))
+    # the id may be the provider's (say a number) or from a request argument
+    for key_id in set([photoset_id, str(photoset_id)]):
+        listing_cache.delete(_key('get_photos', user_id, credentials, key_id))
+
+def store_photo(user_id, credentials, photoset_id, photo, title, description, tags, on_success, on_error,
+                cancel_token=None, deadline=None):
+    """
+    uploads aren't idempotent, so they are never retried. With the dedup
+    index on, a photo already uploaded to this photoset isn't uploaded again,
+    and identical concurrent uploads share one upload. Once a photo is
+    uploaded, the user's cached listings that it changes are dropped.
+    """
+    def upload(success, error, token, deadline):
+        def stored(result):
+            _forget_listings(user_id, credentials, photoset_id)
+            success(result)
+        photosite.store_photo(user_id, credentials, photoset_id, photo, title, description, tags,
+                              stored, error, cancel_token=token, deadline=deadline)
+
+    if dedup_index is None:
+        _scheduled(scheduler.BULK, upload)(on_success, on_error, cancel_token, deadline)
+        return
+
+    sha1 = utils.photo_sha1(photo)
+    fingerprint = credentials_fingerprint(credentials)
+    previous = dedup_index.lookup(PROVIDER, user_id, fingerprint, photoset_id, sha1)
+    if previous is not None:
+        on_success(previous)
+        return
+
+    def upload_and_record(success, error, token, deadline):
+        def recorded(result):
+            dedup_index.record(PROVIDER, user_id, fingerprint, photoset_id, sha1, result)
+            success(result)
+        _scheduled(scheduler.BULK, upload)(recorded, error, token, deadline)
+
+    _flights.do(_key('store_photo', user_id, credentials, photoset_id, sha1), upload_and_record,
+                on_success, on_error, cancel_token, deadline)
+
+def search(user_id, credentials, query, photoset_id=None, limit=50):
+    "search the user's photos that have been listed here; see searchindex"
+    return search_index.search(_user_key(user_id, credentials), query, photoset_id, limit)
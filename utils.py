@@ -5,6 +5,18 @@ some common utilities
 import mimetools
 import cStringIO
 import os
+import re
+import mmap
+import base64
+import hashlib
+import shutil
+import time
+import threading
+import logging
+import collections
+import Queue
+
+import tornado.ioloop
 
 def multipart_encode(vars, files, vars_with_types= [], boundary = None, buf = None):
     if boundary is None:
@@ -27,8 +39,357 @@ def multipart_encode(vars, files, vars_with_types= [], boundary = None, buf = No
         buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (name, filename))
         buf.write('Content-Type: %s\r\n' % contenttype)
         # buffer += 'Content-Length: %s\r\n' % file_size
-        buf.write('\r\n' + file.read() + '\r\n')
+        buf.write('\r\n')
+        # copy in pieces, rather than making more whole copies of the photo
+        shutil.copyfileobj(file, buf)
+        buf.write('\r\n')
     buf.write('--' + boundary + '--\r\n\r\n')
     buf = buf.getvalue()
     return boundary, buf
 
+
+
+class SpooledPhoto(object):
+    """
+    a photo that is on disk rather than in memory. The provider store_photo
+    functions accept one wherever they take a base64 photo, and read it
+    through a memory map instead of decoding an in-memory copy.
+    """
+
+    def __init__(self, path, sha1=None):
+        self.path = path
+        # hex SHA-1 of the photo, when whoever spooled it already knows it
+        self.sha1 = sha1
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        "a read-only memory map of the photo, which reads like a file"
+        f = open(self.path, 'rb')
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+def photo_file(photo):
+    "a file-like object with the bytes of photo (base64, or a SpooledPhoto)"
+    if isinstance(photo, SpooledPhoto):
+        return photo.open()
+    return cStringIO.StringIO(base64.b64decode(photo))
+
+def photo_sha1(photo):
+    """
+    hex SHA-1 of the bytes of photo (base64, or a SpooledPhoto), hashed a
+    block at a time rather than decoding or reading the whole photo at once
+    """
+    if isinstance(photo, SpooledPhoto) and photo.sha1:
+        return photo.sha1
+
+    digest = hashlib.sha1()
+    if isinstance(photo, SpooledPhoto):
+        f = open(photo.path, 'rb')
+        try:
+            for block in iter(lambda: f.read(64 * 1024), ''):
+                digest.update(block)
+        finally:
+            f.close()
+    else:
+        # whole 4-character groups of base64 decode on their own; whitespace
+        # is dropped a block at a time, and a part group carried over
+        block_size = 64 * 1024
+        rest = ''
+        for start in xrange(0, len(photo), block_size):
+            block = rest + ''.join(photo[start:start + block_size].split())
+            whole = len(block) - len(block) % 4
+            digest.update(base64.b64decode(block[:whole]))
+            rest = block[whole:]
+        if rest:
+            digest.update(base64.b64decode(rest))
+    return digest.hexdigest()
+
+def photo_base64(photo):
+    "photo (base64, or a SpooledPhoto) as base64"
+    if isinstance(photo, SpooledPhoto):
+        photo_map = photo.open()
+        try:
+            return base64.b64encode(photo_map)
+        finally:
+            photo_map.close()
+    return photo
+
+class CancelToken(object):
+    """
+    handed down with a piece of work so it can be abandoned, e.g. when the
+    client that asked for it has gone away.
+
+    code holding work open (queue entries, buffers, timers) registers a
+    callback to release it; code about to start something expensive
+    checks token.cancelled first.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        if self.cancelled:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception("cancel callback failed")
+
+def is_cancelled(cancel_token):
+    return cancel_token is not None and cancel_token.cancelled
+
+class DeadlineExceeded(Exception):
+    "the time budget of a request ran out"
+
+class UpstreamError(Exception):
+    "the provider answered with an error status; the message is its response body"
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+class Deadline(object):
+    """
+    the time budget of one API request, shared by every upstream step it
+    takes: each step gets whatever is left, rather than a timeout of its own.
+    """
+
+    def __init__(self, seconds, connect_timeout=5.0):
+        self.expires = time.time() + seconds
+        self.connect_timeout = connect_timeout
+
+    def copy(self):
+        deadline = Deadline(0, self.connect_timeout)
+        deadline.expires = self.expires
+        return deadline
+
+    def remaining(self):
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def extend_to(self, other):
+        "push this deadline out to other's, if that is later"
+        self.expires = max(self.expires, other.expires)
+
+    def timeouts(self):
+        """
+        (connect_timeout, request_timeout) in seconds for the next upstream
+        request; raises DeadlineExceeded if nothing is left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("timed out")
+        return min(self.connect_timeout, remaining), remaining
+
+def with_error_prefix(on_error, prefix):
+    """
+    on_error, with prefix put in front of error messages. Exceptions (such
+    as DeadlineExceeded) are passed on as they are, so that whoever answers
+    the client can still tell what went wrong; an UpstreamError keeps its
+    code.
+    """
+    def error(e):
+        if isinstance(e, UpstreamError):
+            on_error(UpstreamError(e.code, "%s%s" % (prefix, e)))
+        elif isinstance(e, Exception):
+            on_error(e)
+        else:
+            on_error("%s%s" % (prefix, e))
+    return error
+
+def timeout_args(deadline):
+    "keyword arguments for a tornado HTTPRequest under this deadline, if there is one"
+    if deadline is None:
+        return {}
+    connect_timeout, request_timeout = deadline.timeouts()
+    return {'connect_timeout': connect_timeout, 'request_timeout': request_timeout}
+
+def split_tags(keywords):
+    "a provider's comma or semicolon separated keywords as a list of tags"
+    return [tag.strip() for tag in re.split(r"[,;]", keywords or '') if tag.strip()]
+
+class Join(object):
+    """
+    run independent steps at the same time and carry on once all of them
+    have succeeded:
+
+        steps = Join(on_success, on_error)
+        start_one(*steps.add('one'))
+        start_other(*steps.add('other'))
+        steps.start()
+
+    on_success gets a dictionary of each step's result by name. The first
+    failure goes to on_error, and cancels cancel_token (if given) so the
+    steps still running can stop; anything after that is ignored.
+    """
+
+    def __init__(self, on_success, on_error, cancel_token=None):
+        self.on_success = on_success
+        self.on_error = on_error
+        self.cancel_token = cancel_token
+        self.results = {}
+        self._pending = set()
+        self._started = False
+        self._done = False
+
+    def add(self, name):
+        "(on_success, on_error) callbacks for a step"
+        self._pending.add(name)
+
+        def success(result):
+            if self._done or name not in self._pending:
+                return
+            self._pending.discard(name)
+            self.results[name] = result
+            self._check()
+
+        def error(e):
+            if self._done:
+                return
+            self._done = True
+            self.on_error(e)
+            if self.cancel_token is not None:
+                self.cancel_token.cancel()
+
+        return success, error
+
+    def start(self):
+        "call once every step has been added (and possibly finished)"
+        self._started = True
+        self._check()
+
+    def _check(self):
+        if self._started and not self._pending and not self._done:
+            self._done = True
+            self.on_success(self.results)
+
+class KeyedLimiter(object):
+    """
+    at most limit holders at a time for each key (e.g. a user id); anyone
+    else waits in line and is called back, on the IOLoop, when a slot is
+    handed over to them. Every acquire that got its slot must be released.
+    A waiter whose cancel_token is cancelled never gets a slot, even one
+    already on its way to it.
+    """
+
+    def __init__(self, limit, io_loop=None):
+        self.limit = limit
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._active = {}
+        self._waiting = {}
+
+    def acquire(self, key, callback, cancel_token=None):
+        if self._active.get(key, 0) < self.limit:
+            self._active[key] = self._active.get(key, 0) + 1
+            callback()
+            return
+
+        waiting = self._waiting.setdefault(key, collections.deque())
+        entry = (callback, cancel_token)
+        waiting.append(entry)
+        if cancel_token is not None:
+            cancel_token.add_callback(lambda: self._withdraw(key, entry))
+
+    def release(self, key):
+        waiting = self._waiting.get(key)
+        if waiting:
+            # hand the slot straight over
+            callback, cancel_token = waiting.popleft()
+            if not waiting:
+                del self._waiting[key]
+
+            def hand_over():
+                # cancelled since: pass the slot on to whoever is next
+                if is_cancelled(cancel_token):
+                    self.release(key)
+                else:
+                    callback()
+            self.io_loop.add_callback(hand_over)
+            return
+
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+
+    def active(self, key):
+        return self._active.get(key, 0)
+
+    def _withdraw(self, key, entry):
+        waiting = self._waiting.get(key)
+        if waiting and entry in waiting:
+            waiting.remove(entry)
+            if not waiting:
+                del self._waiting[key]
+
+class WorkerPool(object):
+    """
+    a small pool of threads for provider calls that block (the oauth2 /
+    httplib2 clients), so they don't hold up the IOLoop while they run.
+
+    fn is run on a pool thread; on_success(result) or on_error(exception)
+    is then called back on the IOLoop thread. Work that is cancelled while
+    still queued is never run, and nothing is called back once cancelled.
+    """
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, on_success, on_error, cancel_token=None):
+        self._start()
+        self._queue.put((fn, on_success, on_error, cancel_token))
+
+    def _start(self):
+        if len(self._threads) >= self.num_threads:
+            return
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.num_threads:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            fn, on_success, on_error, cancel_token = self._queue.get()
+            if is_cancelled(cancel_token):
+                continue
+            try:
+                result = fn()
+            except Exception, e:
+                logging.exception("worker pool task failed")
+                self._deliver(on_error, e, cancel_token)
+            else:
+                self._deliver(on_success, result, cancel_token)
+
+    def _deliver(self, callback, value, cancel_token):
+        def deliver():
+            if not is_cancelled(cancel_token):
+                callback(value)
+        # add_callback is the one IOLoop method that is safe from other threads
+        tornado.ioloop.IOLoop.instance().add_callback(deliver)